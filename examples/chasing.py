@@ -169,6 +169,9 @@ class Game(toy.app.IGame):
                 }
                 missile = self.entity_manager.create_entity(Missile, param)
                 missile.position = Vector(0.0, 0.0, -5.0)
+        elif symbol == key.G:
+            self.infinite_grid = not self.infinite_grid
+            self.grid_layer.visible = not self.infinite_grid
 
     def on_mouse_press(self, x, y, button, modifiers):
         if button == pyglet.window.mouse.LEFT:
@@ -197,10 +200,15 @@ class Game(toy.app.IGame):
         plane = self.entity_manager.create_entity(Plane)
         self.current_plane_id = plane.entity_id
 
-    def update(self, dt):
-        draw = self.app.draw
-        draw.draw_grid(1.0, 100, toy.coloring.GRAY)
+        # G switches to the shader grid
+        self.infinite_grid = False
+        self.grid_layer = self.app.batch.create_layer()
+        with self.app.batch.record_layer(self.grid_layer):
+            self.app.draw.draw_grid(1.0, 100, toy.coloring.GRAY)
 
+    def update(self, dt):
+        if self.infinite_grid:
+            self.app.draw.draw_infinite_grid(1.0, toy.coloring.GRAY)
         self.entity_manager.update(dt)
 
     def draw(self):
@@ -5,6 +5,7 @@ import pickle
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+import numpy
 from vmath import Vector, Matrix, Transform, Quaternion
 
 import pyglet
@@ -25,10 +26,13 @@ class Game(toy.app.IGame):
     def on_key_press(self, symbol, modifiers):
         if symbol == key.F5:
             retroreload.retroreload(sys.modules[__name__])
+        elif symbol == key.G:
+            self.infinite_grid = not self.infinite_grid
 
     def init(self, app):
         self.app = app
         self.game_time = 0.0
+        self.infinite_grid = False
 
     def update2(self, dt):
         self.game_time += dt
@@ -48,33 +52,42 @@ class Game(toy.app.IGame):
 
         n = 25
         step = 0.5
-        vortex_origin = Vector(0.0, 0.0, 0.0)
+        vortex_origin = numpy.array((0.0, 0.0, 0.0), dtype=numpy.float32)
         vortex_alpha = 1.0
-        up = Vector(0.0, 1.0, 0.0)
-        for i in range(-n, n):
-            for j in range(-n, n):
-                pos = Vector(i * step, 0.0, j * step)
-                delta = pos - vortex_origin
-                r = delta.length()
-                r_direction = delta.normalized()
-                if r > 0.0:
-
-                    speed = vortex_alpha / r
-                    direction = up.cross(delta).normalized()
-                    draw.draw_line(pos, pos + direction * speed)
-
-                    centri = vortex_alpha / (r**3)
-                    draw.draw_line(pos, pos - r_direction * centri, color=toy.coloring.GREEN)
-
-                    draw.draw_point(pos, color=toy.coloring.BLACK)
+        up = numpy.array((0.0, 1.0, 0.0), dtype=numpy.float32)
+        coords = numpy.arange(-n, n, dtype=numpy.float32) * step
+        xs, zs = numpy.meshgrid(coords, coords, indexing='ij')
+        pos = numpy.zeros((xs.size, 3), dtype=numpy.float32)
+        pos[:, 0] = xs.ravel()
+        pos[:, 2] = zs.ravel()
+        delta = pos - vortex_origin
+        r = numpy.linalg.norm(delta, axis=1)
+        inside = r > 0.0
+        pos = pos[inside]
+        delta = delta[inside]
+        r = r[inside, numpy.newaxis]
+        r_direction = delta / r
+
+        speed = vortex_alpha / r
+        direction = numpy.cross(up, delta)
+        direction /= numpy.linalg.norm(direction, axis=1)[:, numpy.newaxis]
+        draw.draw_lines(pos, pos + direction * speed)
+
+        centri = vortex_alpha / (r**3)
+        draw.draw_lines(pos, pos - r_direction * centri, colors=toy.coloring.GREEN)
+
+        draw.draw_points(pos, colors=toy.coloring.BLACK)
 
     def update3(self, dt):
         # print('game_time', id(self), self.game_time)
         self.game_time += dt
         draw = self.app.draw
         draw.draw_axis(Matrix(), 10.0)
-        draw.draw_grid(10.0, 5, toy.coloring.LIGHT_GRAY)
-        draw.draw_grid(1.0, 10, toy.coloring.GRAY)
+        if self.infinite_grid:
+            draw.draw_infinite_grid(1.0, toy.coloring.GRAY, 2)
+        else:
+            draw.draw_grid(10.0, 5, toy.coloring.LIGHT_GRAY)
+            draw.draw_grid(1.0, 10, toy.coloring.GRAY)
         
         camera = self.app.camera
         p = camera.top_down_screen_to_world(Vector(camera.width / 2.0, camera.height / 2.0, 0.0))
@@ -139,9 +152,7 @@ class Game(toy.app.IGame):
 
         world_p = (model_matrix * sub_model_matrix).transform_point(Vector(0.0, 0.0, 0.0))
         # world_p = Vector()
-        screen_p = camera.world_to_screen(world_p)
-
-        text_batch.draw_text(screen_p, 'Lklm world{}'.format(world_p), toy.coloring.BLACK, 0.5)
+        text_batch.draw_world_text(world_p, 'Lklm world{}'.format(world_p), toy.coloring.BLACK, 0.5)
 
         model_matrix = Transform(
             Vector(),
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+
+if __name__ == '__main__' and len(sys.argv) > 2 and sys.platform.startswith('linux'):
+    # benchmarks render offscreen, pyglet picks EGL only when this is set
+    # before toy is imported, so a display is not needed
+    os.environ.setdefault('TOY_HEADLESS', 'offscreen')
+
+from vmath import Vector
+
+import toy
+import toy.app
+import toy.batching
+import toy.capture
+import toy.coloring
+import toy.mesh
+
+
+class ReplayGame(toy.app.IGame):
+    # feeds captured frames back through the batches without game code,
+    # starts over after the last frame
+    GEOMETRY_NAMES = dict(zip(toy.capture.GEOMETRY_TAGS, toy.capture.GEOMETRY_ATTRIBUTES))
+    LAYER_GEOMETRY_NAMES = dict(zip(toy.capture.LAYER_GEOMETRY_TAGS, toy.capture.GEOMETRY_ATTRIBUTES))
+
+    def __init__(self, path):
+        self.reader = toy.capture.FrameReader(path)
+        self.frame_index = 0
+        self.template_positions = {}
+        self.templates = {}
+        self.layers = {}
+
+    def init(self, app):
+        self.app = app
+        batch = app.batch
+        if (batch.vertex_dtype.itemsize != self.reader.vertex_size or
+                batch.instance_dtype.itemsize != self.reader.instance_size):
+            raise ValueError('Capture {} was made with {}'.format(self.reader.path, self.reader.get_app_options()))
+
+    def _view(self, name, data):
+        if name == 'mesh_indices':
+            return data.view(toy.batching.INDEX_DTYPE)
+        return data.view(self.app.batch.vertex_dtype)
+
+    def _set_camera(self, data):
+        record = data.view(toy.capture.CAMERA_DTYPE)[0]
+        camera = self.app.camera
+        width, height = int(record['width']), int(record['height'])
+        if (width, height) != (camera.width, camera.height):
+            if self.app.window is not None:
+                self.app.window.set_size(width, height)
+            camera.set_new_size(width, height)
+        camera.set_mode(int(record['mode']))
+        camera.set_perspective(float(record['fov']))
+        camera.set_ortho(float(record['extent']))
+        eye, at, up = (Vector(*(float(v) for v in record[name])) for name in ('eye', 'at', 'up'))
+        camera.set_look_at(eye, at, up)
+
+    def _record_layer(self, layer_id, name, data):
+        batch = self.app.batch
+        layer = self.layers.get(layer_id)
+        if layer is None:
+            layer = batch.create_layer()
+            self.layers[layer_id] = layer
+        # the four arrays of a layer are always written together
+        if name == 'point_vertices':
+            layer.clear()
+        arena = getattr(layer, name)
+        vertices = self._view(name, data)
+        start = arena.allocate(len(vertices))
+        arena.vertices[start:start + len(vertices)] = vertices
+        layer.invalidate()
+
+    def update(self, dt):
+        frames = self.reader.frames
+        if not frames:
+            return
+        batch = self.app.batch
+        text_batch = self.app.text_batch
+        for tag, count, data in frames[self.frame_index]:
+            if tag == toy.capture.TAG_CAMERA:
+                self._set_camera(data)
+            elif tag in self.GEOMETRY_NAMES:
+                name = self.GEOMETRY_NAMES[tag]
+                batch.append_vertices(name, self._view(name, data))
+            elif tag == toy.capture.TAG_TEMPLATE_POSITIONS:
+                self.template_positions[count] = data.view('<f4')
+            elif tag == toy.capture.TAG_TEMPLATE_INDICES:
+                self.templates[count] = toy.mesh.LineMesh(
+                    'template{}'.format(count), self.template_positions.pop(count), data.view('<u4'))
+            elif tag == toy.capture.TAG_INSTANCES:
+                batch.append_vertices('instances', data.view(batch.instance_dtype), self.templates[count])
+            elif tag == toy.capture.TAG_GRIDS:
+                for step, color, levels, fade_distance in data.view(toy.capture.GRID_DTYPE):
+                    batch.draw_infinite_grid(float(step), toy.coloring.Color(*(float(v) for v in color)),
+                                             float(levels), float(fade_distance))
+            elif tag == toy.capture.TAG_TRANSFORMS:
+                # index 0 is the identity the batch already holds
+                batch.append_vertices('transform_matrices', data.view('<f4').reshape(-1, 4, 4)[1:])
+            elif tag == toy.capture.TAG_TEXTS:
+                for position, text, scale, color in toy.capture.unpack_texts(data, count):
+                    text_batch.draw_text(position, text, color, scale)
+            elif tag == toy.capture.TAG_WORLD_TEXTS:
+                for position, text, scale, color in toy.capture.unpack_texts(data, count):
+                    text_batch.draw_world_text(position, text, color, scale)
+            elif tag in self.LAYER_GEOMETRY_NAMES:
+                self._record_layer(count, self.LAYER_GEOMETRY_NAMES[tag], data)
+            elif tag == toy.capture.TAG_LAYERS:
+                visible = set(data.view('<u4').tolist())
+                for layer_id, layer in self.layers.items():
+                    layer.visible = layer_id in visible
+        self.frame_index = (self.frame_index + 1) % len(frames)
+
+
+def main():
+    # replay.py capture.bin [frames], with frames it runs headless as a benchmark
+    game = ReplayGame(sys.argv[1])
+    options = game.reader.get_app_options()
+    if len(sys.argv) > 2:
+        frames = int(sys.argv[2])
+        app = toy.app.App(game, headless=toy.app.App.HEADLESS_OFFSCREEN, profile=True, **options)
+        start = time.perf_counter()
+        # every frame waits for the gpu, otherwise only submission is timed
+        app.run(frames=frames, finish=True)
+        elapsed = time.perf_counter() - start
+        print('{} frames in {:.3f} s, {:.3f} ms per frame'.format(frames, elapsed, elapsed * 1000.0 / frames))
+        for name, seconds in app.profiler.get_phase_averages().items():
+            print('{:<8} {:.3f} ms'.format(name, seconds * 1000.0))
+    else:
+        app = toy.app.App(game, **options)
+        app.run()
+
+if __name__ == '__main__':
+    main()
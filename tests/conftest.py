@@ -0,0 +1,84 @@
+import os
+
+# pyglet picks its window platform on import, EGL needs no display
+os.environ.setdefault('TOY_HEADLESS', 'offscreen')
+
+import numpy
+import pytest
+from vmath import Matrix, Vector
+
+import toy.app
+import toy.capture
+import toy.coloring
+import toy.draw
+
+
+class Game(toy.app.IGame):
+    def init(self, app):
+        self.app = app
+
+
+class SceneGame(toy.app.IGame):
+    # a bit of everything a frame can hold, different every frame
+    def init(self, app):
+        self.app = app
+        self.frame = 0
+        self.layer = None
+
+    def update(self, dt):
+        self.frame += 1
+        app = self.app
+        draw = app.draw
+        t = self.frame * 0.25
+        if self.layer is None:
+            self.layer = app.batch.create_layer()
+            with app.batch.record_layer(self.layer):
+                draw.draw_grid(1.0, 3, toy.coloring.GRAY)
+        app.camera.set_look_at(Vector(t, 4.0, -10.0), Vector(0.0, 0.0, 0.0), Vector(0.0, 1.0, 0.0))
+        with app.batch.pick_id(self.frame):
+            draw.draw_point(Vector(t, 0.0, 0.0), toy.coloring.RED)
+            draw.draw_line(Vector(0.0, t, 0.0), Vector(1.0, t, 0.0), toy.coloring.GREEN)
+        draw.draw_points(numpy.array([[0.0, 0.0, t], [1.0, 0.0, t]]), toy.coloring.BLUE)
+        draw.draw_cube(Vector(0.0, 1.0, t), 0.5, toy.coloring.RED)
+        draw.draw_sphere(Vector(1.0, 1.0, t), 0.5, toy.coloring.GREEN)
+        local = toy.draw.LocalDraw(app.batch, Matrix.from_translation(Vector(t, 0.0, 1.0)))
+        local.draw_line(Vector(0.0, 0.0, 0.0), Vector(0.0, 1.0, 0.0), toy.coloring.BLUE)
+        local.draw_point(Vector(0.0, 1.0, 0.0), toy.coloring.RED)
+        draw.draw_infinite_grid(1.0, toy.coloring.Color(0.5, 0.5, 0.5, 0.5))
+        app.text_batch.draw_text(Vector(10.0, 10.0, 0.0), 'frame {}'.format(self.frame), toy.coloring.RED, 0.5)
+        app.text_batch.draw_world_text(Vector(0.0, 0.0, 0.0), 'origin', toy.coloring.BLUE, 0.5)
+
+
+@pytest.fixture(autouse=True)
+def user_cache_directory(tmp_path_factory, monkeypatch):
+    # textures are cached per user, keep them out of the real cache
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path_factory.getbasetemp() / 'cache'))
+
+
+@pytest.fixture
+def scene_game():
+    return SceneGame
+
+
+@pytest.fixture
+def read_frames():
+    def read(path):
+        return [[(tag, count, bytes(data)) for tag, count, data in frame]
+                for frame in toy.capture.FrameReader(path).frames]
+    return read
+
+
+@pytest.fixture
+def make_app():
+    apps = []
+    def make(game=None, **options):
+        app = toy.app.App(game or Game(), **options)
+        if game is None:
+            app.game.init(app)
+        apps.append(app)
+        return app
+    yield make
+    for app in apps:
+        app._end_run()
+        if app.window is not None:
+            app.window.close()
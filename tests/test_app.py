@@ -0,0 +1,79 @@
+import pytest
+
+import toy.app
+
+
+class TickGame(toy.app.IGame):
+    def init(self, app):
+        self.app = app
+        self.steps = []
+
+    def update(self, dt):
+        self.steps.append(dt)
+
+
+def test_fixed_timestep(make_app):
+    # a power of two rate keeps the accumulator exact
+    game = TickGame()
+    app = make_app(game, headless='null', tick_rate=64, max_catch_up=10)
+    game.init(app)
+    app.on_update(0.125)
+    assert app.tick_count == 8
+    assert app.interpolation_alpha == 0.0
+    app.on_update(1.0 / 128.0)
+    assert app.tick_count == 8
+    assert app.interpolation_alpha == 0.5
+    app.on_update(1.0 / 128.0)
+    assert app.tick_count == 9
+    assert game.steps == [1.0 / 64.0] * 9
+
+
+def test_fixed_timestep_catch_up(make_app):
+    game = TickGame()
+    app = make_app(game, headless='null', tick_rate=64, max_catch_up=5)
+    game.init(app)
+    # a long stall runs max_catch_up ticks and drops the rest
+    app.on_update(1.0 + 1.0 / 128.0)
+    assert app.tick_count == 5
+    assert app.interpolation_alpha == 0.5
+    app.on_update(1.0 / 128.0)
+    assert app.tick_count == 6
+
+
+@pytest.mark.parametrize('headless', ('offscreen', 'null'))
+def test_run_steps_ticks(make_app, headless):
+    game = TickGame()
+    app = make_app(game, headless=headless, tick_rate=32)
+    game.init(app)
+    assert app.run_steps(frames=12) == 12
+    assert app.tick_count == 12
+    assert app.run_steps(seconds=0.5) == 16
+    assert app.tick_count == 28
+
+
+def test_run_steps_needs_a_limit(make_app):
+    app = make_app(headless='null')
+    with pytest.raises(ValueError):
+        app.run_steps()
+
+
+@pytest.mark.parametrize('headless', ('offscreen', 'null'))
+def test_headless_run_needs_a_limit(make_app, headless):
+    game = TickGame()
+    app = make_app(game, headless=headless)
+    with pytest.raises(ValueError):
+        app.run()
+    assert not hasattr(game, 'steps')
+
+
+@pytest.mark.parametrize('finish', (False, True))
+def test_run_steps_presents_frames(make_app, monkeypatch, finish):
+    app = make_app(headless='offscreen')
+    flips = []
+    flip = app.window.flip
+    def counted_flip():
+        flips.append(app.batch.frame)
+        flip()
+    monkeypatch.setattr(app.window, 'flip', counted_flip)
+    app.run_steps(frames=3, finish=finish)
+    assert flips == [1, 2, 3]
@@ -0,0 +1,66 @@
+import os
+import shutil
+
+import numpy
+import pytest
+
+import toy.assets
+
+
+def make_asset(directory):
+    os.makedirs(str(directory), exist_ok=True)
+    path = str(directory / 'ascii.png')
+    shutil.copy(toy.assets.resolve_asset('ascii.png'), path)
+    return path
+
+
+def test_texture_cache_round_trip(tmp_path):
+    path = make_asset(tmp_path)
+    built = toy.assets.load_texture_data(path)
+    assert os.path.exists(toy.assets.get_cache_path(path))
+    cached = toy.assets.load_texture_data(path)
+    assert isinstance(cached.levels[0], numpy.memmap)
+    assert (cached.width, cached.height) == (built.width, built.height)
+    for built_level, cached_level in zip(built.levels, cached.levels):
+        assert (built_level == cached_level).all()
+
+
+def test_texture_cache_is_per_user(tmp_path):
+    path = make_asset(tmp_path / 'assets')
+    other_path = make_asset(tmp_path / 'other')
+    cache_path = toy.assets.get_cache_path(path)
+    assert cache_path.startswith(toy.assets.get_user_cache_directory('textures'))
+    assert cache_path != toy.assets.get_cache_path(other_path)
+    toy.assets.load_texture_data(path)
+    assert os.listdir(str(tmp_path / 'assets')) == ['ascii.png']
+
+
+@pytest.mark.parametrize('platform, variable, expected', [
+    ('linux', 'XDG_CACHE_HOME', ('xdg', 'toy', 'programs')),
+    ('linux', None, ('home', '.cache', 'toy', 'programs')),
+    ('darwin', None, ('home', 'Library', 'Caches', 'toy', 'programs')),
+    ('win32', 'LOCALAPPDATA', ('local', 'toy', 'programs')),
+])
+def test_user_cache_directory(monkeypatch, tmp_path, platform, variable, expected):
+    monkeypatch.setattr('sys.platform', platform)
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    monkeypatch.delenv('LOCALAPPDATA', raising=False)
+    if variable is not None:
+        monkeypatch.setenv(variable, str(tmp_path / expected[0]))
+    assert toy.assets.get_user_cache_directory('programs') == os.path.join(str(tmp_path), *expected)
+
+
+def test_bad_texture_cache_is_rebuilt(tmp_path):
+    path = make_asset(tmp_path)
+    cache_path = toy.assets.get_cache_path(path)
+    source_hash = toy.assets.hash_file(path)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    header_size = toy.assets.CACHE_HEADER_DTYPE.itemsize
+    for content in (b'', b'TOYT', b'\0' * header_size, b'garbage' * 100):
+        with open(cache_path, 'wb') as f:
+            f.write(content)
+        assert toy.assets.read_texture_cache(cache_path, source_hash) is None
+    texture_data = toy.assets.load_texture_data(path)
+    assert texture_data.levels[0].shape == (texture_data.height, texture_data.width, 4)
+    assert toy.assets.read_texture_cache(cache_path, source_hash) is not None
@@ -0,0 +1,225 @@
+import itertools
+
+import numpy
+import pytest
+from pyglet.gl import *
+from vmath import Matrix, Vector
+
+import toy.batching
+import toy.coloring
+import toy.mesh
+
+
+def test_arena_growth():
+    arena = toy.batching.VertexArena(toy.batching.INDEX_DTYPE, capacity=4)
+    for value in range(3):
+        arena.vertices[arena.allocate(1)] = value
+    start = arena.allocate(6)
+    arena.vertices[start:start + 6] = numpy.arange(3, 9)
+    assert len(arena.vertices) == 16
+    assert arena.grow_count == 1
+    assert arena.view().tolist() == list(range(9))
+    arena.truncate(5)
+    assert arena.view().tolist() == list(range(5))
+    arena.reset(keep=2)
+    assert arena.view().tolist() == [0, 1]
+    assert arena.get_stats() == {'count': 5, 'capacity': 16, 'high_water': 5, 'grow_count': 1,
+                                 'bytes': 5 * toy.batching.INDEX_DTYPE.itemsize}
+    arena.allocate(10)
+    arena.reset()
+    # the grown capacity is kept for the next frames
+    assert len(arena) == 0
+    assert arena.get_stats()['capacity'] == 16
+    assert arena.get_stats()['grow_count'] == 0
+
+
+@pytest.mark.parametrize('streaming', (False, True))
+def test_batch_flush(make_app, streaming):
+    app = make_app(streaming=streaming, culling=False)
+    batch = app.batch
+    count = 3 * toy.batching.VertexArena.INITIAL_CAPACITY
+    segments = numpy.zeros((count, 2, 3))
+    segments[:, 1, 0] = 1.0
+    for frame in range(2):
+        batch.draw_line_list(segments, numpy.array([[1.0, 0.0, 0.0]]))
+        batch.draw()
+        stats = batch.get_stats()
+        assert len(batch.line_vertices) == 0
+        assert stats['lines']['count'] == 2 * count
+        # the first frame grows the arena, the second reuses it
+        assert (stats['lines']['grow_count'] > 0) == (frame == 0)
+        assert stats['draw_calls'] >= 1
+        assert stats['upload_bytes'] >= 2 * count * batch.vertex_dtype.itemsize
+    assert glGetError() == GL_NO_ERROR
+
+
+@pytest.mark.parametrize('compact, transforms, picking', list(itertools.product((False, True), repeat=3)))
+def test_single_vertices(make_app, compact, transforms, picking):
+    batch = make_app(compact=compact, transforms=transforms, picking=picking).batch
+    color = toy.coloring.with_alpha(toy.coloring.RED, 0.5)
+    with batch.pick_id(7):
+        batch.draw_point(Vector(1.0, 2.0, 3.0), color, 3)
+        batch.draw_line(Vector(1.0, 2.0, 3.0), Vector(4.0, 5.0, 6.0), color, 2)
+        batch.draw_line_mesh([Vector(0.0, 0.0, 1.0), Vector(0.0, 1.0, 0.0)], [0, 1], color)
+    expected = numpy.zeros(5, batch.vertex_dtype)
+    expected['position'] = [(1.0, 2.0, 3.0), (1.0, 2.0, 3.0), (4.0, 5.0, 6.0), (0.0, 0.0, 1.0), (0.0, 1.0, 0.0)]
+    expected['color'] = batch.color_value(color)
+    if transforms:
+        expected['transform'] = (3, 2, 2, 0, 0)
+    if picking:
+        expected['pick_id'] = 7
+    vertices = numpy.concatenate([batch.point_vertices.view(), batch.line_vertices.view(),
+                                  batch.mesh_vertices.view()])
+    assert vertices.tobytes() == expected.tobytes()
+    assert batch.mesh_indices.view().tolist() == [0, 1]
+
+
+@pytest.mark.parametrize('compact, transforms, picking', list(itertools.product((False, True), repeat=3)))
+def test_template_records(make_app, compact, transforms, picking):
+    batch = make_app(compact=compact, transforms=transforms, picking=picking).batch
+    line_mesh = toy.mesh.BOX
+    affine = numpy.array(((2.0, 0.0, 0.0, 1.0), (0.0, 3.0, 0.0, 2.0), (0.0, 0.0, 4.0, 3.0)), dtype=numpy.float32)
+    color = toy.coloring.with_alpha(toy.coloring.GREEN, 0.5)
+    with batch.pick_id(5):
+        batch.draw_mesh_template(line_mesh, affine, color, 2)
+    count = len(line_mesh.positions)
+    expected = numpy.zeros(count, batch.vertex_dtype)
+    expected['position'] = line_mesh.positions * (2.0, 3.0, 4.0) + (1.0, 2.0, 3.0)
+    expected['color'] = batch.color_value(color)
+    if transforms:
+        expected['transform'] = 2
+    if picking:
+        expected['pick_id'] = 5
+    assert batch.mesh_vertices.view().tobytes() == expected.tobytes()
+    assert batch.mesh_indices.view().tolist() == line_mesh.indices.tolist()
+
+
+@pytest.mark.parametrize('compact', (False, True))
+def test_instance_records(make_app, compact):
+    batch = make_app(compact=compact, instancing=True).batch
+    line_mesh = toy.mesh.BOX
+    affine = numpy.array(((2.0, 0.0, 0.0, 1.0), (0.0, 3.0, 0.0, 2.0), (0.0, 0.0, 4.0, 3.0)), dtype=numpy.float32)
+    matrix = Matrix.from_translation(Vector(1.0, 2.0, 3.0)) * Matrix.from_scale(Vector(2.0, 3.0, 4.0))
+    color = toy.coloring.with_alpha(toy.coloring.GREEN, 0.5)
+    batch.draw_instance_affine(line_mesh, affine, color)
+    batch.draw_instance(line_mesh, matrix, color)
+    expected = numpy.zeros(2, batch.instance_dtype)
+    # model is stored as columns
+    expected['model'] = ((2.0, 0.0, 0.0, 0.0), (0.0, 3.0, 0.0, 0.0), (0.0, 0.0, 4.0, 0.0), (1.0, 2.0, 3.0, 1.0))
+    expected['color'] = batch.color_value(color)
+    assert batch.instances[line_mesh].view().tobytes() == expected.tobytes()
+
+
+COLOR_SHAPES = [
+    ('vector', lambda count: toy.coloring.BLUE, 'single'),
+    ('tuple', lambda count: (0.0, 0.0, 1.0), 'single'),
+    ('rgba tuple', lambda count: (0.0, 0.0, 1.0, 1.0), 'single'),
+    ('(3,)', lambda count: numpy.array((0.0, 0.0, 1.0)), 'single'),
+    ('(1, 3)', lambda count: numpy.array([(0.0, 0.0, 1.0)]), 'single'),
+    ('per primitive', lambda count: numpy.linspace(0.0, 1.0, count * 3).reshape(count, 3), 'primitive'),
+    ('per vertex', lambda count: numpy.linspace(0.0, 1.0, count * 6).reshape(count, 2, 3), 'vertex'),
+]
+
+
+def expected_colors(colors, count, vertices_per_primitive, kind, compact):
+    if kind == 'single':
+        if hasattr(colors, 'x'):
+            colors = (colors.x, colors.y, colors.z)
+        rows = numpy.tile(numpy.asarray(colors, numpy.float32).reshape(1, -1), (count * vertices_per_primitive, 1))
+    elif kind == 'primitive':
+        rows = numpy.repeat(numpy.asarray(colors, numpy.float32), vertices_per_primitive, axis=0)
+    else:
+        rows = numpy.asarray(colors, numpy.float32).reshape(-1, 3)
+    return toy.batching.array_colors(rows, compact)
+
+
+@pytest.mark.parametrize('compact', (False, True))
+@pytest.mark.parametrize('name, make_colors, kind', COLOR_SHAPES, ids=[shape[0] for shape in COLOR_SHAPES])
+def test_array_color_shapes(make_app, compact, name, make_colors, kind):
+    batch = make_app(compact=compact).batch
+    count = 5
+    positions0 = numpy.zeros((count, 3))
+    positions1 = numpy.ones((count, 3))
+    if kind != 'vertex':
+        batch.draw_points(positions0, make_colors(count))
+        assert (batch.point_vertices.view()['color'] == expected_colors(
+            make_colors(count), count, 1, kind, compact)).all()
+    batch.draw_lines(positions0, positions1, make_colors(count))
+    batch.draw_line_list(numpy.stack([positions0, positions1], axis=1), make_colors(count))
+    lines = batch.line_vertices.view()['color']
+    expected = expected_colors(make_colors(count), count, 2, kind, compact)
+    assert (lines[:2 * count] == expected).all()
+    assert (lines[2 * count:] == expected).all()
+
+
+def test_array_color_count_mismatch(make_app):
+    batch = make_app().batch
+    with pytest.raises(ValueError):
+        batch.draw_lines(numpy.zeros((5, 3)), numpy.ones((5, 3)), numpy.zeros((3, 3)))
+
+
+def read_pixels(app):
+    width, height = app.window.width, app.window.height
+    pixels = (GLubyte * (width * height * 4))()
+    glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+    return numpy.frombuffer(pixels, numpy.uint8).reshape(height, width, 4)
+
+
+def test_grid_alpha(make_app):
+    darkest = []
+    for alpha in (1.0, 0.2):
+        app = make_app()
+        app.batch.draw_infinite_grid(1.0, toy.coloring.with_alpha(toy.coloring.BLACK, alpha), 2, 200.0)
+        app.on_draw()
+        darkest.append(read_pixels(app)[..., 0].min())
+    assert darkest[1] > darkest[0] + 64
+
+
+def test_packed_color_cache():
+    cache = toy.batching.PackedColorCache()
+    color = toy.coloring.Color(1.0, 0.0, 0.0)
+    assert cache(color) == (255, 0, 0, 255)
+    color.y = 1.0
+    color.w = 0.0
+    assert cache(color) == (255, 255, 0, 0)
+    assert cache(toy.coloring.Color(1.0, 0.0, 0.0)) == (255, 0, 0, 255)
+
+
+def test_text_layout_cache(make_app):
+    app = make_app()
+    text_batch = app.text_batch
+    for _ in range(3):
+        text_batch.draw_text(Vector(10.0, 10.0, 0.0), 'score 10', toy.coloring.RED, 0.5)
+        app.on_draw()
+    assert (text_batch.layout_hits, text_batch.layout_misses) == (2, 1)
+    layout = text_batch.get_layout('score 10', 0.5)
+    assert text_batch.get_layout('score 10', 0.5) is layout
+    assert text_batch.get_layout('score 11', 0.5) is not layout
+    assert text_batch.get_layout('score 10', 1.0) is not layout
+    assert (text_batch.layout_hits, text_batch.layout_misses) == (4, 3)
+
+
+@pytest.mark.parametrize('headless', ('offscreen', 'null'))
+def test_glyph_instances_skip_blanks(make_app, headless):
+    app = make_app(headless=headless, culling=False)
+    text_batch = app.text_batch
+    text = 'a b\n c  d \n'
+    text_batch.draw_text(Vector(10.0, 300.0, 0.0), text, toy.coloring.RED)
+    text_batch.draw_world_text(Vector(0.0, 0.0, 0.0), text, toy.coloring.RED)
+    text_batch.draw()
+    stats = text_batch.get_stats()
+    glyphs = stats['glyphs']['count'] + stats.get('world_glyphs', {'count': 0})['count']
+    assert glyphs == 2 * len(text.replace(' ', '').replace('\n', ''))
+
+
+def test_world_text_behind_camera_is_culled(make_app):
+    covered = []
+    for distance in (10.0, -10.0):
+        app = make_app()
+        eye, at, _ = app.camera.get_look_at()
+        direction = (at - eye).normalized()
+        app.text_batch.draw_world_text(eye + direction * distance, 'WWWW', toy.coloring.BLACK, 2.0)
+        app.on_draw()
+        covered.append(int((read_pixels(app)[..., 0] < 128).sum()))
+    assert covered[0] > 0
+    assert covered[1] == 0
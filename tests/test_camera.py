@@ -0,0 +1,78 @@
+import math
+
+import numpy
+import pytest
+from vmath import Vector
+
+import toy.camera
+
+
+UP = Vector(0.0, 1.0, 0.0)
+SETTERS = {
+    'position': lambda camera: camera.set_look_at(Vector(3.0, 5.0, -8.0), camera.view_at, UP),
+    'rotation': lambda camera: camera.set_look_at(camera.view_eye, Vector(2.0, 1.0, 0.0), UP),
+    'fov': lambda camera: camera.set_perspective(math.radians(40.0)),
+    'size': lambda camera: camera.set_new_size(800, 400),
+    'mode': lambda camera: camera.set_mode(camera.MODE_ORTHO),
+}
+
+
+def derived(camera):
+    return (camera.get_view_projection_array().copy(), camera.get_inverse_view_projection().copy(),
+            camera.get_frustum().plane_array.copy())
+
+
+@pytest.mark.parametrize('name', sorted(SETTERS))
+def test_setters_invalidate_derived_matrices(name):
+    camera = toy.camera.Camera()
+    before = derived(camera)
+    SETTERS[name](camera)
+    after = derived(camera)
+    fresh = toy.camera.Camera()
+    SETTERS[name](fresh)
+    for old, new, expected in zip(before, after, derived(fresh)):
+        assert not numpy.allclose(old, new)
+        numpy.testing.assert_allclose(new, expected)
+
+
+def test_ortho_extent_invalidates_derived_matrices():
+    camera = toy.camera.Camera()
+    camera.set_mode(camera.MODE_ORTHO)
+    before = derived(camera)
+    camera.set_ortho(20.0)
+    for old, new in zip(before, derived(camera)):
+        assert not numpy.allclose(old, new)
+    numpy.testing.assert_allclose(camera.get_view_projection_array()[0, 0] * 2.0, before[0][0, 0])
+
+
+@pytest.mark.parametrize('mode', ('perspective', 'ortho'))
+def test_screen_world_round_trip(mode):
+    camera = toy.camera.Camera()
+    camera.set_new_size(800, 600)
+    if mode == 'ortho':
+        camera.set_mode(camera.MODE_ORTHO)
+    positions = numpy.array(((0.0, 0.0, 0.0), (1.0, 2.0, 3.0), (-4.0, 0.5, 6.0), (2.0, -1.0, -3.0)))
+    screen = camera.world_to_screen_array(positions)
+    for position, expected in zip(positions.tolist(), screen.tolist()):
+        single = camera.world_to_screen(Vector(*position))
+        assert [single.x, single.y, single.z] == pytest.approx(expected, abs=1e-4)
+    numpy.testing.assert_allclose(camera.screen_to_world_array(screen), positions, atol=1e-4)
+    world = camera.screen_to_world(Vector(*screen[1].tolist()))
+    assert [world.x, world.y, world.z] == pytest.approx(positions[1].tolist(), abs=1e-4)
+
+
+def test_projected_radius():
+    camera = toy.camera.Camera()
+    camera.set_new_size(800, 600)
+    eye, at, _ = camera.get_look_at()
+    direction = (at - eye).normalized()
+    for distance in (2.0, 10.0, 50.0):
+        center = eye + direction * distance
+        # a point one radius off the view axis, in window pixels
+        screen = camera.world_to_screen_array(((center.x, center.y, center.z),
+                                               (center.x + 0.5, center.y, center.z)))
+        pixels = abs(screen[1, 0] - screen[0, 0]) * camera.height / camera.SCREEN_HEIGHT
+        assert camera.get_projected_radius(center, 0.5) == pytest.approx(pixels, rel=1e-3)
+    assert camera.get_projected_radius(eye, 0.5) == camera.height
+    camera.set_mode(camera.MODE_ORTHO)
+    assert camera.get_projected_radius(at, 1.0) == camera.height * 0.5 / camera.ortho_extent
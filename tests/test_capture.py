@@ -0,0 +1,37 @@
+import pytest
+
+import replay
+import toy.capture
+
+
+FRAMES = 4
+
+
+OPTIONS = [
+    {},
+    {'compact': True},
+    {'transforms': True},
+    {'picking': True},
+    {'instancing': True},
+    {'compact': True, 'transforms': True, 'picking': True, 'instancing': True},
+    {'pipelined': True},
+]
+
+@pytest.mark.parametrize('options', OPTIONS, ids=lambda options: '-'.join(options) or 'default')
+def test_capture_replay_round_trip(make_app, scene_game, read_frames, tmp_path, options):
+    path = str(tmp_path / 'scene.bin')
+    app = make_app(scene_game(), capture=path, **options)
+    app.run(frames=FRAMES)
+    captured = read_frames(path)
+    assert len(captured) == FRAMES
+    tags = {tag for frame in captured for tag, count, data in frame}
+    assert toy.capture.TAG_LAYER_LINES in tags
+    assert (toy.capture.TAG_TRANSFORMS in tags) == bool(options.get('transforms'))
+    assert (toy.capture.TAG_INSTANCES in tags) == bool(options.get('instancing'))
+
+    # replaying into a capture writes the same frames again
+    game = replay.ReplayGame(path)
+    replayed_path = str(tmp_path / 'replayed.bin')
+    replay_app = make_app(game, capture=replayed_path, **game.reader.get_app_options())
+    replay_app.run(frames=FRAMES)
+    assert read_frames(replayed_path) == captured
@@ -0,0 +1,89 @@
+import numpy
+import pytest
+from vmath import Vector, Matrix
+
+import toy.coloring
+import toy.draw
+import toy.mesh
+
+
+def drawn_segments(batch):
+    return batch.line_vertices.view()['position'].reshape(-1, 2, 3)
+
+
+def grid_segments(step, n):
+    border = n * step
+    segments = []
+    for i in range(-n, n + 1):
+        segments.append(((i * step, 0.0, -border), (i * step, 0.0, border)))
+        segments.append(((-border, 0.0, i * step), (border, 0.0, i * step)))
+    return segments
+
+
+@pytest.mark.parametrize('culling', (False, True))
+def test_grid_culling(make_app, culling):
+    app = make_app(culling=culling)
+    app.camera.set_look_at(Vector(5.0, 3.0, 5.0), Vector(10.0, 0.0, 10.0), Vector(0.0, 1.0, 0.0))
+    app.draw.draw_grid(1.0, 20, toy.coloring.GRAY)
+    frustum = app.camera.get_frustum()
+    expected = set()
+    for low, high in grid_segments(1.0, 20):
+        if not culling or frustum.intersects_aabb(Vector(*low), Vector(*high)):
+            expected.add((low, high))
+    drawn = set(tuple(tuple(float(v) for v in end) for end in segment)
+                for segment in drawn_segments(app.batch))
+    assert drawn == expected
+    if culling:
+        assert 0 < len(drawn) < 4 * 20 + 2
+    else:
+        assert len(drawn) == 4 * 20 + 2
+
+
+def test_grid_axis_colors(make_app):
+    app = make_app(culling=False)
+    app.draw.draw_grid(1.0, 2, toy.coloring.GRAY)
+    segments = drawn_segments(app.batch)
+    colors = app.batch.line_vertices.view()['color'][::2]
+    along_x = (segments[:, 0, 2] == 0.0) & (segments[:, 1, 2] == 0.0)
+    along_z = (segments[:, 0, 0] == 0.0) & (segments[:, 1, 0] == 0.0)
+    assert colors[along_x].tolist() == [[1.0, 0.0, 0.0]]
+    assert colors[along_z].tolist() == [[0.0, 0.0, 1.0]]
+
+
+def test_local_grid_culling(make_app):
+    app = make_app()
+    app.camera.set_look_at(Vector(5.0, 3.0, 5.0), Vector(10.0, 0.0, 10.0), Vector(0.0, 1.0, 0.0))
+    local_draw = toy.draw.LocalDraw(app.batch, Matrix.from_translation(Vector(3.0, 0.0, 0.0)))
+    local_draw.draw_grid(1.0, 20, toy.coloring.GRAY)
+    lows = numpy.array([(-20.0, 0.0, float(z)) for z in range(-20, 21)])
+    highs = numpy.array([(20.0, 0.0, float(z)) for z in range(-20, 21)])
+    expected = [local_draw.is_box_visible(Vector(*low), Vector(*high)) for low, high in zip(lows, highs)]
+    assert local_draw.select_visible_boxes(lows, highs).tolist() == expected
+
+
+@pytest.mark.parametrize('local', (False, True))
+def test_array_polygon(make_app, local):
+    points = numpy.array(((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (1.0, 0.0, 1.0)), dtype=numpy.float32)
+    draws = []
+    for make_points in (lambda: [Vector(*point) for point in points.tolist()], lambda: points):
+        batch = make_app(culling=False).batch
+        draw = toy.draw.LocalDraw(batch, Matrix.from_translation(Vector(3.0, 0.0, 0.0))) if local else toy.draw.Draw(batch)
+        draw.draw_polygon(make_points(), toy.coloring.GREEN)
+        draws.append((batch.mesh_vertices.view().tobytes(), batch.mesh_indices.view().tolist()))
+    assert draws[0] == draws[1]
+    assert draws[0][1] == list(toy.mesh.polygon_indices(3))
+    toy.draw.Draw(batch).draw_polygon(numpy.empty((0, 3)))
+    assert len(batch.mesh_vertices.view()) == 3
+
+
+def test_lod_segments_shrink_with_distance(make_app):
+    lod = toy.mesh.LevelOfDetail()
+    app = make_app(headless='null', lod=lod)
+    eye, at, _ = app.camera.get_look_at()
+    direction = (at - eye).normalized()
+    segments = [app.draw.select_segments(eye + direction * distance, 1.0)
+                for distance in (1.5, 3.0, 10.0, 30.0, 100.0, 1000.0)]
+    assert segments == sorted(segments, reverse=True)
+    assert segments[0] == lod.levels[-1]
+    assert segments[-1] == lod.levels[0]
+    assert len(set(segments)) > 2
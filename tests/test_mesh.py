@@ -0,0 +1,30 @@
+import math
+
+import pytest
+
+import toy.mesh
+
+
+def test_lod_levels_are_clamped():
+    lod = toy.mesh.LevelOfDetail(min_segments=6, max_segments=16)
+    assert lod.levels == [6, 8, 12, 16]
+    assert lod.select_segments(0.0) == 6
+    assert lod.select_segments(10000.0) == 16
+    with pytest.raises(ValueError):
+        toy.mesh.LevelOfDetail(min_segments=40)
+
+
+def test_lod_segment_length():
+    lod = toy.mesh.LevelOfDetail(min_segments=4, max_segments=32, pixels_per_segment=8.0)
+    levels = toy.mesh.LOD_SEGMENTS
+    for segments, next_segments in zip(levels, levels[1:] + levels[-1:]):
+        # the largest radius a level covers at 8 pixels per segment
+        radius = segments * 8.0 / (2.0 * math.pi)
+        assert lod.select_segments(radius) == segments
+        assert lod.select_segments(radius * 1.01) == next_segments
+
+
+def test_default_lod_stays_close_to_fixed_tessellation():
+    lod = toy.mesh.LevelOfDetail()
+    assert max(lod.levels) <= 2 * toy.mesh.CIRCLE_SEGMENTS
+    assert lod.select_segments(1000.0) == max(lod.levels)
@@ -0,0 +1,126 @@
+import numpy
+import pytest
+from vmath import Matrix, Vector
+
+import toy.batching
+import toy.coloring
+import toy.mesh
+import toy.picking
+
+
+@pytest.mark.parametrize('headless', ('offscreen', 'null'))
+def test_request_pick_without_picking(make_app, headless):
+    app = make_app(headless=headless)
+    picked = []
+    with pytest.raises(ValueError):
+        app.batch.request_pick(10, 10, picked.append)
+    assert picked == []
+
+
+def test_null_request_pick(make_app):
+    app = make_app(headless='null', picking=True)
+    picked = []
+    app.batch.request_pick(10, 10, picked.append)
+    assert picked == [0]
+
+
+def test_select_pick_id():
+    ids = numpy.zeros((5, 5), numpy.uint32)
+    assert toy.picking.select_pick_id(ids, 2, 2) == 0
+    ids[0, 0] = 3
+    ids[2, 4] = 9
+    # rows are y, the nearest nonzero id wins
+    assert toy.picking.select_pick_id(ids, 3, 2) == 9
+    assert toy.picking.select_pick_id(ids, 0, 1) == 3
+
+
+def pick_center(app, draw_frame):
+    # the camera looks at the origin, it is in the middle of the window
+    batch = app.batch
+    picked = []
+    batch.request_pick(app.window.width // 2, app.window.height // 2, picked.append)
+    for frame in range(5):
+        draw_frame()
+        batch.draw()
+        if picked:
+            break
+    return picked
+
+
+def draw_cross(batch, center, pick_id):
+    with batch.pick_id(pick_id):
+        batch.draw_line(center - Vector(1.0, 0.0, 0.0), center + Vector(1.0, 0.0, 0.0), toy.coloring.RED)
+        batch.draw_line(center - Vector(0.0, 1.0, 0.0), center + Vector(0.0, 1.0, 0.0), toy.coloring.RED)
+
+
+@pytest.mark.parametrize('compact, transforms', [(False, False), (True, True)])
+def test_pick_id_at_cursor(make_app, compact, transforms):
+    app = make_app(picking=True, compact=compact, transforms=transforms)
+    batch = app.batch
+    def draw_frame():
+        draw_cross(batch, Vector(0.0, 0.0, 0.0), 7)
+        with batch.pick_id(3):
+            batch.draw_point(Vector(4.0, 2.0, 0.0), toy.coloring.GREEN)
+    assert pick_center(app, draw_frame) == [7]
+
+
+@pytest.mark.parametrize('near_first', (False, True))
+def test_nearest_pick_id_wins(make_app, near_first):
+    app = make_app(picking=True)
+    batch = app.batch
+    camera = app.camera
+    # further along the ray through the middle of the window
+    behind = (camera.view_at - camera.view_eye).normalized() * 5.0
+    def draw_frame():
+        crosses = [(Vector(0.0, 0.0, 0.0), 7), (behind, 3)]
+        if not near_first:
+            crosses.reverse()
+        for center, pick_id in crosses:
+            draw_cross(batch, center, pick_id)
+    assert pick_center(app, draw_frame) == [7]
+
+
+def test_pick_instances(make_app):
+    app = make_app(picking=True, instancing=True)
+    batch = app.batch
+    cross = toy.mesh.LineMesh('cross', [(-1.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, -1.0, 0.0), (0.0, 1.0, 0.0)],
+                              numpy.array([0, 1, 2, 3], dtype=numpy.uint32))
+    def draw_frame():
+        with batch.pick_id(9):
+            batch.draw_instance(cross, Matrix.from_translation(Vector(0.0, 0.0, 0.0)), toy.coloring.RED)
+        with batch.pick_id(4):
+            batch.draw_instance(cross, Matrix.from_translation(Vector(5.0, 3.0, 0.0)), toy.coloring.RED)
+    assert pick_center(app, draw_frame) == [9]
+
+
+def test_pick_reuses_frame_buffers(make_app, monkeypatch):
+    app = make_app(picking=True)
+    batch = app.batch
+    layer = batch.create_layer()
+    with batch.record_layer(layer):
+        draw_cross(batch, Vector(0.0, 2.0, 0.0), 5)
+    uploads = []
+    for name in ('glBufferData', 'glBufferSubData'):
+        function = getattr(toy.batching, name)
+        def counted(*args, function=function):
+            uploads.append(args[2])
+            return function(*args)
+        monkeypatch.setattr(toy.batching, name, counted)
+    def draw_frame():
+        # the lines under the cursor go out in the first of several chunks
+        draw_cross(batch, Vector(0.0, 0.0, 0.0), 7)
+        segments = numpy.zeros((batch.BATCH_SIZE, 2, 3))
+        segments[:, :, 0] = 20.0
+        segments[:, 1, 1] = 1.0
+        with batch.pick_id(3):
+            batch.draw_line_list(segments, toy.coloring.BLUE)
+        draw_cross(batch, Vector(0.0, -2.0, 0.0), 6)
+    draw_frame()
+    batch.draw()
+    del uploads[:]
+    draw_frame()
+    batch.draw()
+    frame_uploads = list(uploads)
+    del uploads[:]
+    assert pick_center(app, draw_frame) == [7]
+    assert uploads == frame_uploads
@@ -0,0 +1,73 @@
+import threading
+import time
+
+from vmath import Vector
+
+import toy.app
+import toy.batching
+import toy.coloring
+
+
+class LayerGame(toy.app.IGame):
+    # records one more line into a layer every update, slowly, and replaces
+    # the layer every few updates
+    def init(self, app):
+        self.app = app
+        self.update_count = 0
+        self.layer = None
+
+    def update(self, dt):
+        batch = self.app.batch
+        self.update_count += 1
+        if self.layer is None or self.update_count % 4 == 0:
+            if self.layer is not None:
+                batch.remove_layer(self.layer)
+            self.layer = batch.create_layer()
+        with batch.record_layer(self.layer):
+            for i in range(self.update_count):
+                batch.draw_line(Vector(0.0, 0.0, 0.0), Vector(1.0, 0.0, float(i)), toy.coloring.RED)
+                time.sleep(0.0005)
+
+
+def test_layers_from_update_thread(make_app, monkeypatch):
+    gl_threads = set()
+    for name in ('glGenVertexArrays', 'glDeleteVertexArrays'):
+        function = getattr(toy.batching, name)
+        def recorded(*args, function=function):
+            gl_threads.add(threading.get_ident())
+            return function(*args)
+        monkeypatch.setattr(toy.batching, name, recorded)
+    game = LayerGame()
+    app = make_app(game, pipelined=True)
+    game.init(app)
+    for frame in range(1, 12):
+        app.on_update(app.HEADLESS_FRAME_TIME)
+        app.on_draw()
+        layers = app.batch.front.layers
+        if frame > 1:
+            # the front storage is the frame recorded by the previous update
+            assert len(layers) == 1
+            assert layers[0].line_count == 2 * (frame - 1)
+    assert gl_threads == {threading.get_ident()}
+
+
+def test_resize_before_swap(make_app):
+    app = make_app(pipelined=True)
+    app.on_update(app.HEADLESS_FRAME_TIME)
+    app.on_resize(320, 200)
+    app.on_update(app.HEADLESS_FRAME_TIME)
+    camera = app.batch.front.camera
+    assert (camera.width, camera.height) == (320, 200)
+
+
+def test_pipelined_frames_match_direct(make_app, scene_game, read_frames, tmp_path):
+    frames = 5
+    direct_path = str(tmp_path / 'direct.bin')
+    make_app(scene_game(), capture=direct_path).run(frames=frames)
+    pipelined_path = str(tmp_path / 'pipelined.bin')
+    make_app(scene_game(), capture=pipelined_path, pipelined=True).run(frames=frames + 1)
+    # a pipelined app draws each frame one update later, its first is empty
+    direct = read_frames(direct_path)
+    pipelined = read_frames(pipelined_path)
+    assert len(direct) == frames
+    assert pipelined[1:] == direct
@@ -0,0 +1,123 @@
+import json
+
+import pytest
+from pyglet.gl import *
+
+import toy.profiler
+
+
+def record_frame(profiler, phases, counters=None):
+    profiler.begin_frame()
+    for name, (start, end) in phases.items():
+        profiler.add_phase(name, start, end)
+    if counters:
+        profiler.add_counters('batch', counters)
+    profiler.end_frame()
+
+
+def test_disabled_phases_record_nothing():
+    profiler = toy.profiler.Profiler()
+    assert profiler.phase('update') is toy.profiler.NULL_PHASE
+    profiler.begin_frame()
+    with profiler.phase('update'):
+        pass
+    profiler.end_frame()
+    assert not profiler.history
+    assert not profiler.trace_events
+
+
+def test_phases_add_up_per_frame():
+    profiler = toy.profiler.Profiler(True)
+    profiler.begin_frame()
+    with profiler.phase('update'):
+        pass
+    profiler.add_phase('draw', 1.0, 1.25)
+    profiler.add_phase('draw', 2.0, 2.5)
+    profiler.end_frame()
+    frame, = profiler.history
+    assert sorted(frame.phases) == ['draw', 'update']
+    assert frame.phases['draw'] == 0.75
+    assert 0.0 <= frame.phases['update'] <= frame.duration
+
+
+def test_history_is_bounded():
+    profiler = toy.profiler.Profiler(True, history_size=3)
+    for i in range(5):
+        record_frame(profiler, {'draw': (0.0, 0.001 * (i + 1))})
+    assert len(profiler.history) == 3
+    assert [frame.phases['draw'] for frame in profiler.history] == [0.003, 0.004, 0.005]
+    assert profiler.get_phase_averages()['draw'] == pytest.approx(0.004)
+    for frame in profiler.history:
+        frame.end = frame.start + 0.02
+    assert profiler.get_frame_average() == pytest.approx(0.02)
+    assert profiler.get_hud_text().startswith('frame 20.00 ms  50 fps')
+
+
+def test_write_trace(tmp_path):
+    profiler = toy.profiler.Profiler(True)
+    start = profiler.origin
+    record_frame(profiler, {'update': (start + 1.0, start + 1.5)},
+                 {'lines': {'count': 4, 'capacity': 1024}, 'draw_calls': 2, 'culled': True})
+    path = tmp_path / 'trace.json'
+    profiler.write_trace(str(path))
+    with open(path) as f:
+        trace = json.load(f)
+    assert trace['displayTimeUnit'] == 'ms'
+    phase, counters = trace['traceEvents']
+    assert phase['name'] == 'update' and phase['ph'] == 'X'
+    assert phase['ts'] == pytest.approx(1000000.0)
+    assert phase['dur'] == pytest.approx(500000.0)
+    assert counters['ph'] == 'C'
+    assert counters['args'] == {'batch.lines': 4, 'batch.draw_calls': 2}
+
+
+def test_hud_fits_the_screen(make_app):
+    app = make_app(profile=True, culling=False)
+    profiler = app.profiler
+    profiler.toggle_hud()
+    record_frame(profiler, {'draw': (0.0, 0.001)})
+    text_batch = app.text_batch
+    profiler.draw_hud(text_batch)
+    (position, text, scale, _), = text_batch.textinfos
+    line_height = text_batch.GLYPH_HEIGHT * scale
+    _, height = app.camera.get_screen_size()
+    assert position.x == profiler.HUD_MARGIN
+    assert position.y + line_height == pytest.approx(height - profiler.HUD_MARGIN)
+    assert position.y - text.count('\n') * line_height > 0.0
+
+
+def time_frames(timer, count):
+    for _ in range(count):
+        with timer.scope('clear'):
+            glClear(GL_COLOR_BUFFER_BIT)
+        glFinish()
+        timer.end_frame()
+
+
+def test_gpu_times_arrive_after_latency(make_app):
+    make_app()
+    timer = toy.profiler.GpuTimer()
+    time_frames(timer, timer.LATENCY - 1)
+    assert timer.times == {}
+    assert len(timer.pending) == timer.LATENCY - 1
+    time_frames(timer, 1)
+    assert list(timer.times) == ['clear']
+    assert timer.times['clear'] >= 0.0
+    assert len(timer.pending) == timer.LATENCY - 1
+    # resolved queries are reused
+    time_frames(timer, 10)
+    assert len(timer.queries) == 2 * timer.LATENCY
+    timer.delete()
+    assert glGetError() == GL_NO_ERROR
+
+
+def test_gpu_timer_drops_late_frames(make_app, monkeypatch):
+    make_app()
+    timer = toy.profiler.GpuTimer()
+    monkeypatch.setattr(timer, '_is_available', lambda frame: False)
+    for _ in range(3 * timer.MAX_PENDING):
+        time_frames(timer, 1)
+        assert len(timer.pending) < timer.MAX_PENDING
+    assert timer.times == {}
+    assert len(timer.queries) == 2 * timer.MAX_PENDING
+    timer.delete()
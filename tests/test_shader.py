@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+import toy.shader
+
+
+def list_cache(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if name.endswith('.bin'))
+
+
+def test_program_cache_is_opt_in(make_app, tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    make_app()
+    assert toy.shader.program_cache_directory is None
+    assert not os.path.exists(str(tmp_path / 'toy' / 'programs'))
+
+
+@pytest.mark.parametrize('use_user_directory', [False, True])
+def test_program_cache_round_trip(make_app, tmp_path, monkeypatch, use_user_directory):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    if use_user_directory:
+        program_cache = True
+        directory = os.path.join(str(tmp_path), 'toy', 'programs')
+    else:
+        program_cache = directory = str(tmp_path / 'programs')
+    make_app(program_cache=program_cache)
+    if not toy.shader.has_program_binary():
+        pytest.skip('no program binary formats')
+    cached = list_cache(directory)
+    assert cached
+
+    # a second app loads the binaries and writes nothing new
+    mtimes = [os.path.getmtime(os.path.join(directory, name)) for name in cached]
+    app = make_app(program_cache=program_cache)
+    assert list_cache(directory) == cached
+    assert [os.path.getmtime(os.path.join(directory, name)) for name in cached] == mtimes
+    app.batch.draw()
+
+
+def test_rejected_program_binary_is_rebuilt(make_app, tmp_path):
+    directory = str(tmp_path)
+    make_app(program_cache=directory)
+    if not toy.shader.has_program_binary():
+        pytest.skip('no program binary formats')
+    cached = list_cache(directory)
+    # a valid header with a binary no driver accepts
+    header_size = toy.shader.PROGRAM_CACHE_HEADER_DTYPE.itemsize
+    for name in cached:
+        path = os.path.join(directory, name)
+        with open(path, 'rb') as f:
+            blob = bytearray(f.read())
+        blob[header_size:] = b'\xff' * (len(blob) - header_size)
+        with open(path, 'wb') as f:
+            f.write(blob)
+    app = make_app(program_cache=directory)
+    app.batch.draw()
+    for name in cached:
+        path = os.path.join(directory, name)
+        with open(path, 'rb') as f:
+            assert f.read()[header_size:header_size + 16] != b'\xff' * 16
+
+
+def test_unreadable_program_cache_is_a_miss(make_app, tmp_path):
+    directory = str(tmp_path)
+    make_app(program_cache=directory)
+    if not toy.shader.has_program_binary():
+        pytest.skip('no program binary formats')
+    # a directory in place of an entry cannot be opened as a file
+    for name in list_cache(directory):
+        path = os.path.join(directory, name)
+        os.remove(path)
+        os.mkdir(path)
+    assert toy.shader.read_program_cache(os.path.join(directory, 'missing.bin')) is None
+    app = make_app(program_cache=directory)
+    app.batch.draw()
@@ -1 +1,10 @@
-from . import app
\ No newline at end of file
+import os
+
+import pyglet
+# must be set before pyglet.gl is imported. App windows create their own
+# context, without the shadow window importing toy needs no display
+pyglet.options['shadow_window'] = False
+if os.environ.get('TOY_HEADLESS') == 'offscreen':
+    pyglet.options['headless'] = True
+
+from . import app
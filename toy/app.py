@@ -4,15 +4,23 @@ Main.
 
 import logging
 logger = logging.getLogger(__name__)
+import concurrent.futures
+import os
+import sys
 
 import pyglet
 from pyglet.window import key
 from pyglet.gl import *
 
 import toy
+import toy.assets
 import toy.camera
 import toy.batching
+import toy.capture
 import toy.draw
+import toy.null
+import toy.profiler
+import toy.shader
 
 
 class IGame(object):
@@ -39,14 +47,68 @@ class IGame(object):
 
 
 class App(object):
-    def __init__(self, game):
-        config = pyglet.gl.Config(major_version=4, minor_version=6, alpha_size=8, forward_compatible=True)
+    # offscreen renders into a hidden window, with PYGLET_HEADLESS or
+    # TOY_HEADLESS=offscreen that is an EGL context without a display.
+    # pyglet picks its window platform on import, so an offscreen argument
+    # alone needs a display. null never touches GL and only counts the
+    # submitted geometry, it runs anywhere.
+    HEADLESS_OFFSCREEN = 'offscreen'
+    HEADLESS_NULL = 'null'
+    HEADLESS_FRAME_TIME = 1.0 / 60.0
+    def __init__(self, game, *, streaming=False, instancing=False, compact=False, culling=True, lod=None,
+                 transforms=False, picking=False, tick_rate=None, max_catch_up=5, max_fps=None, headless=None,
+                 profile=False, gpu_timing=False, pipelined=False, capture=None, program_cache=False):
+        if pipelined and tick_rate:
+            raise ValueError('Pipelined update does not support a fixed tick rate')
+        if headless is None:
+            headless = os.environ.get('TOY_HEADLESS') or None
+        if headless not in (None, self.HEADLESS_OFFSCREEN, self.HEADLESS_NULL):
+            raise ValueError('Unknown headless mode {!r}'.format(headless))
+        if (headless == self.HEADLESS_OFFSCREEN and not pyglet.options['headless'] and
+                sys.platform.startswith('linux') and not os.environ.get('DISPLAY')):
+            raise ValueError('Offscreen without a display needs TOY_HEADLESS=offscreen '
+                             'set before toy is imported')
+        self.headless = headless
         self.game = game
-        self.window = pyglet.window.Window(resizable=True, config=config)
+        # with a tick rate game.update runs at fixed steps, game.draw runs
+        # every frame and can blend with interpolation_alpha
+        self.tick_time = 1.0 / tick_rate if tick_rate else None
+        self.max_catch_up = max_catch_up
+        self.max_fps = max_fps
+        self.tick_accumulator = 0.0
+        self.tick_count = 0
+        self.interpolation_alpha = 1.0
+        self.profiler = toy.profiler.Profiler(profile)
+        # pipelined runs update and tessellation of the next frame on a
+        # worker thread while this one is drawn, input is handed over per frame
+        self.executor = None
+        self.pending_update = None
+        self.pending_events = []
+        self.pending_size = None
+        self.capture = None
+
+        self.keys = key.KeyStateHandler()
+        self.camera = toy.camera.Camera()
+        self.freeview = toy.camera.FreeviewCameraController(self, self.camera)
+        if headless == self.HEADLESS_NULL:
+            self.window = None
+            self.batch = toy.null.NullPrimitiveBatch(self, self.camera, culling=culling, lod=lod, picking=picking)
+            self.text_batch = toy.null.NullTextBatch(self, self.camera, culling=culling)
+            self.draw = toy.draw.Draw(self.batch)
+            if pipelined:
+                logger.info('Null headless mode draws nothing, run without pipelining')
+            if capture:
+                logger.info('Null headless mode keeps no geometry, nothing to capture')
+            return
+
+        # 3.3 core is all the shaders need, drivers hand out their newest core
+        # profile anyway. 4.x paths check gl_info for what was actually created
+        config = pyglet.gl.Config(major_version=3, minor_version=3, alpha_size=8, forward_compatible=True)
+        self.window = pyglet.window.Window(resizable=True, config=config, visible=headless is None)
+        self.camera.set_new_size(self.window.width, self.window.height)
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-        self.keys = key.KeyStateHandler()
         self.window.push_handlers(self.keys)
 
         self.window.push_handlers(on_key_press=self.on_key_press)
@@ -57,52 +119,202 @@ class App(object):
         self.window.push_handlers(on_mouse_drag=self.on_mouse_drag)
         self.window.push_handlers(on_draw=self.on_draw)
         self.window.push_handlers(on_mouse_scroll=self.on_mouse_scroll)
+        self._profile_flip()
 
-        self.camera = toy.camera.Camera()
-        self.freeview = toy.camera.FreeviewCameraController(self, self.camera)
-        self.batch = toy.batching.PrimitiveBatch(self, self.camera)
-        self.text_batch = toy.batching.TextBatch(self, self.camera)
+        # linked programs are kept as driver binaries in the user cache
+        # directory with True, or in the given directory
+        if program_cache is True:
+            program_cache = toy.assets.get_user_cache_directory('programs')
+        toy.shader.set_program_cache_directory(program_cache or None)
+
+        self.batch = toy.batching.PrimitiveBatch(
+            self, self.camera, streaming=streaming, instancing=instancing, compact=compact, culling=culling,
+            lod=lod, transforms=transforms, picking=picking, gpu_timing=gpu_timing, pipelined=pipelined)
+        self.text_batch = toy.batching.TextBatch(
+            self, self.camera, streaming=streaming, culling=culling, gpu_timing=gpu_timing, pipelined=pipelined)
         self.draw = toy.draw.Draw(self.batch)
+        if pipelined:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='toy-update')
+        # capture is a path, every drawn frame is appended for replay.py
+        if capture:
+            self.capture = toy.capture.FrameWriter(capture, self.batch)
+
+    def _profile_flip(self):
+        # the event loop flips right after on_draw, time the swap there
+        flip = self.window.flip
+        def profiled_flip():
+            with self.profiler.phase('swap'):
+                flip()
+        self.window.flip = profiled_flip
+
+    def _dispatch(self, handler, *args):
+        if self.executor is None:
+            handler(*args)
+        else:
+            self.pending_events.append((handler, args))
 
     def on_resize(self, width, height):
         glViewport(0, 0, width, height)
-        self.camera.set_new_size(width, height)
+        if self.executor is None:
+            self.camera.set_new_size(width, height)
+        else:
+            # applied by the next swap, a recorded frame would be a frame late
+            self.pending_size = (width, height)
         return True
 
     def on_key_press(self, symbol, modifiers):
-        self.freeview.on_key_press(symbol, modifiers)
-        self.game.on_key_press(symbol, modifiers)
+        if symbol == key.F3:
+            self.profiler.toggle_hud()
+        self._dispatch(self.freeview.on_key_press, symbol, modifiers)
+        self._dispatch(self.game.on_key_press, symbol, modifiers)
 
     def on_key_release(self, symbol, modifiers):
-        self.game.on_key_release(symbol, modifiers)
+        self._dispatch(self.game.on_key_release, symbol, modifiers)
 
     def on_mouse_press(self, x, y, button, modifiers):
-        self.game.on_mouse_press(x, y, button, modifiers)
+        self._dispatch(self.game.on_mouse_press, x, y, button, modifiers)
 
     def on_mouse_release(self, x, y, button, modifiers):
-        self.game.on_mouse_release(x, y, button, modifiers)
+        self._dispatch(self.game.on_mouse_release, x, y, button, modifiers)
 
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
-        self.game.on_mouse_drag(x, y, dx, dy, buttons, modifiers)
-        self.freeview.on_mouse_drag(x, y, dx, dy, buttons, modifiers)
+        self._dispatch(self.game.on_mouse_drag, x, y, dx, dy, buttons, modifiers)
+        self._dispatch(self.freeview.on_mouse_drag, x, y, dx, dy, buttons, modifiers)
 
     def on_mouse_scroll(self, x, y, scroll_x, scroll_y):
-        self.freeview.on_mouse_scroll(x, y, scroll_x, scroll_y)
+        self._dispatch(self.freeview.on_mouse_scroll, x, y, scroll_x, scroll_y)
 
     def on_draw(self):
-        glClearColor(1.0, 1.0, 1.0, 1.0)
-        glClear(GL_COLOR_BUFFER_BIT)
-        self.game.draw()
-        self.batch.draw()
-        self.text_batch.draw()
+        if self.window is not None:
+            glClearColor(1.0, 1.0, 1.0, 1.0)
+            glClear(GL_COLOR_BUFFER_BIT)
+        profiler = self.profiler
+        if self.executor is None:
+            with profiler.phase('draw'):
+                self.game.draw()
+            profiler.draw_hud(self.text_batch)
+        if self.capture is not None:
+            self.capture.write_frame(self.batch, self.text_batch)
+        with profiler.phase('batch'):
+            self.batch.draw()
+        with profiler.phase('text'):
+            self.text_batch.draw()
+        if profiler.enabled:
+            profiler.add_counters('batch', self.batch.get_stats())
+            profiler.add_counters('text', self.text_batch.get_stats())
 
     def on_update(self, dt):
+        if self.executor is not None:
+            self._update_pipelined(dt)
+            return
+        self.profiler.begin_frame()
         self.freeview.update(dt)
-        self.game.update(dt)
+        with self.profiler.phase('update'):
+            self._update(dt)
+
+    def _update_pipelined(self, dt):
+        # the frame recorded by the worker is swapped to the front and drawn
+        # by on_draw while the worker records the next one
+        self._wait_update()
+        self.profiler.begin_frame()
+        if self.pending_size is not None:
+            self.camera.set_new_size(*self.pending_size)
+            self.pending_size = None
+        self.batch.swap_storage()
+        self.text_batch.swap_storage()
+        events = self.pending_events
+        self.pending_events = []
+        self.pending_update = self.executor.submit(self._record_frame, events, dt)
+
+    def _record_frame(self, events, dt):
+        for handler, args in events:
+            handler(*args)
+        self.freeview.update(dt)
+        profiler = self.profiler
+        with profiler.phase('update'):
+            self.game.update(dt)
+        with profiler.phase('draw'):
+            self.game.draw()
+        profiler.draw_hud(self.text_batch)
+
+    def _wait_update(self):
+        if self.pending_update is None:
+            return
+        with self.profiler.phase('wait'):
+            self.pending_update.result()
+        self.pending_update = None
 
-    def run(self):
+    def _update(self, dt):
+        if self.tick_time is None:
+            self.game.update(dt)
+            return
+        self.tick_accumulator += dt
+        steps = 0
+        while self.tick_accumulator >= self.tick_time:
+            if steps == self.max_catch_up:
+                # too far behind, drop the backlog instead of spiralling
+                logger.debug('Drop %.3f seconds of ticks', self.tick_accumulator)
+                self.tick_accumulator %= self.tick_time
+                break
+            self.tick()
+            self.tick_accumulator -= self.tick_time
+            steps += 1
+        self.interpolation_alpha = self.tick_accumulator / self.tick_time
+
+    def tick(self):
+        self.batch.begin_tick()
+        self.text_batch.begin_tick()
+        self.game.update(self.tick_time)
+        self.batch.end_tick()
+        self.text_batch.end_tick()
+        self.tick_count += 1
+
+    def _end_run(self):
+        self._wait_update()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def run(self, frames=None, seconds=None, finish=False):
+        limited = frames is not None or seconds is not None
+        if self.headless and not limited:
+            # nothing would ever close a headless app
+            raise ValueError('Headless run needs frames or seconds')
         logger.info('Init')
         self.game.init(self)
         logger.info('Run')
-        pyglet.clock.schedule(self.on_update)
-        pyglet.app.run()
+        if limited:
+            self.run_steps(frames, seconds, finish)
+            return
+        if self.max_fps:
+            interval = 1.0 / self.max_fps
+            pyglet.clock.schedule_interval(self.on_update, interval)
+            pyglet.app.run(interval)
+        else:
+            pyglet.clock.schedule(self.on_update)
+            pyglet.app.run()
+        self._end_run()
+
+    def run_steps(self, frames=None, seconds=None, finish=False):
+        # as fast as possible with simulated time, until either limit is hit.
+        # finish waits for the gpu every frame, frame times then include it
+        if frames is None and seconds is None:
+            raise ValueError('run_steps needs frames or seconds')
+        dt = self.tick_time or self.HEADLESS_FRAME_TIME
+        frame = 0
+        elapsed = 0.0
+        while (frames is None or frame < frames) and (seconds is None or elapsed < seconds):
+            if self.window is not None:
+                self.window.dispatch_events()
+            self.on_update(dt)
+            self.on_draw()
+            if self.window is not None:
+                self.window.flip()
+                if finish:
+                    with self.profiler.phase('finish'):
+                        glFinish()
+            frame += 1
+            elapsed += dt
+        self._end_run()
+        logger.info('Ran %d frames, %.3f simulated seconds', frame, elapsed)
+        return frame
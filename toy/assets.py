@@ -0,0 +1,148 @@
+"""
+Assets.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+import hashlib
+import os
+import sys
+import tempfile
+
+import numpy
+import pyglet
+
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ASSET_DIRECTORY = os.path.dirname(PACKAGE_DIRECTORY)
+CACHE_MAGIC = b'TOYT'
+CACHE_VERSION = 1
+# raw RGBA8 mip levels follow the header, largest first
+CACHE_HEADER_DTYPE = numpy.dtype([('magic', 'S4'), ('version', '<u4'),
+                                  ('width', '<u4'), ('height', '<u4'), ('levels', '<u4'),
+                                  ('source_hash', 'S40')])
+
+
+def resolve_asset(path):
+    if os.path.isabs(path):
+        return path
+    return os.path.join(ASSET_DIRECTORY, path)
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest().encode('ascii')
+
+def get_user_cache_directory(name):
+    # per user and machine, the asset and package tree may be read only
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'toy', name)
+
+def get_cache_path(path):
+    # assets with the same name in different directories get their own entry
+    directory, filename = os.path.split(os.path.abspath(path))
+    key = hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(get_user_cache_directory('textures'), '{}-{}.rgba'.format(filename, key))
+
+
+def decode_image(path):
+    image = pyglet.image.load(path)
+    image_data = image.get_image_data().get_data('RGBA', image.width * 4)
+    return numpy.frombuffer(image_data, dtype=numpy.uint8).reshape(image.height, image.width, 4)
+
+def _halve(pixels, axis):
+    size = pixels.shape[axis] // 2 * 2
+    if size == 0:
+        return pixels
+    even = pixels.take(range(0, size, 2), axis=axis).astype(numpy.uint16)
+    odd = pixels.take(range(1, size, 2), axis=axis).astype(numpy.uint16)
+    return ((even + odd + 1) // 2).astype(numpy.uint8)
+
+def build_mipmaps(pixels):
+    levels = [pixels]
+    while pixels.shape[0] > 1 or pixels.shape[1] > 1:
+        pixels = _halve(_halve(pixels, 0), 1)
+        levels.append(pixels)
+    return levels
+
+
+class TextureData(object):
+    def __init__(self, width, height, levels):
+        self.width = width
+        self.height = height
+        # list of (height, width, 4) uint8 arrays
+        self.levels = levels
+
+    def __repr__(self):
+        return '<TextureData {}x{} levels={}>'.format(self.width, self.height, len(self.levels))
+
+
+def read_texture_cache(cache_path, source_hash):
+    # missing, short or foreign files are a miss and get rebuilt, memmap
+    # itself refuses empty files
+    header_size = CACHE_HEADER_DTYPE.itemsize
+    try:
+        if os.path.getsize(cache_path) < header_size:
+            return None
+        blob = numpy.memmap(cache_path, dtype=numpy.uint8, mode='r')
+    except (OSError, ValueError):
+        return None
+    header = blob[:header_size].view(CACHE_HEADER_DTYPE)[0]
+    if header['magic'] != CACHE_MAGIC or header['version'] != CACHE_VERSION:
+        return None
+    if header['source_hash'] != source_hash:
+        return None
+    width, height = int(header['width']), int(header['height'])
+    levels = []
+    offset = header_size
+    level_width, level_height = width, height
+    for _ in range(int(header['levels'])):
+        size = level_width * level_height * 4
+        if offset + size > len(blob):
+            return None
+        levels.append(blob[offset:offset + size].reshape(level_height, level_width, 4))
+        offset += size
+        level_width, level_height = max(level_width // 2, 1), max(level_height // 2, 1)
+    return TextureData(width, height, levels)
+
+def write_texture_cache(cache_path, source_hash, texture_data):
+    header = numpy.zeros(1, dtype=CACHE_HEADER_DTYPE)
+    header['magic'] = CACHE_MAGIC
+    header['version'] = CACHE_VERSION
+    header['width'] = texture_data.width
+    header['height'] = texture_data.height
+    header['levels'] = len(texture_data.levels)
+    header['source_hash'] = source_hash
+    directory = os.path.dirname(cache_path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write aside and rename, concurrent apps never see a partial blob
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.tobytes())
+            for level in texture_data.levels:
+                f.write(numpy.ascontiguousarray(level).tobytes())
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning('Write texture cache %s failed: %s', cache_path, e)
+
+def load_texture_data(path, cache=True):
+    path = resolve_asset(path)
+    if not cache:
+        pixels = decode_image(path)
+        return TextureData(pixels.shape[1], pixels.shape[0], build_mipmaps(pixels))
+    source_hash = hash_file(path)
+    cache_path = get_cache_path(path)
+    texture_data = read_texture_cache(cache_path, source_hash)
+    if texture_data is not None:
+        return texture_data
+    logger.info('Build texture cache for %s', path)
+    pixels = decode_image(path)
+    texture_data = TextureData(pixels.shape[1], pixels.shape[0], build_mipmaps(pixels))
+    write_texture_cache(cache_path, source_hash, texture_data)
+    return texture_data
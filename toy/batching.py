@@ -2,25 +2,31 @@
 Batching.
 """
 
-import array
+import contextlib
+import copy
+import struct
 from ctypes import *
 
-import pyglet
+import numpy
 from pyglet.gl import *
 
 from vmath import Matrix
 
 import toy
+import toy.assets
 import toy.shader
 import toy.coloring
+import toy.picking
+import toy.profiler
+import toy.streaming
 
 
 vertex_shader_source = """
 #version 330 core
 layout(location=0) in vec3 Position;
-layout(location=1) in vec3 Color;
+layout(location=1) in vec4 Color;
 uniform mat4 ModelViewProjection;
-out vec3 VertexColor;
+out vec4 VertexColor;
 
 void main() {
     vec4 world_position = ModelViewProjection * vec4(Position, 1.0f);
@@ -31,94 +37,1156 @@ void main() {
 
 fragment_shader_source = """
 #version 330 core
-in vec3 VertexColor;
+in vec4 VertexColor;
 out vec4 FragColor;
 
 void main() {
-    FragColor = vec4(VertexColor, 1.0f);
+    FragColor = VertexColor;
+}
+"""
+
+instance_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec3 Position;
+layout(location=1) in vec4 Color;
+layout(location=2) in mat4 Model;
+uniform mat4 ModelViewProjection;
+out vec4 VertexColor;
+
+void main() {
+    vec4 world_position = ModelViewProjection * Model * vec4(Position, 1.0f);
+    gl_Position = world_position;
+    VertexColor = Color;
+}
+"""
+
+# model matrices fetched from a texture buffer, four texels per matrix
+transform_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec3 Position;
+layout(location=1) in vec4 Color;
+layout(location=2) in uint Transform;
+uniform mat4 ModelViewProjection;
+uniform samplerBuffer Transforms;
+out vec4 VertexColor;
+
+void main() {
+    int base = int(Transform) * 4;
+    mat4 model = mat4(texelFetch(Transforms, base), texelFetch(Transforms, base + 1),
+                      texelFetch(Transforms, base + 2), texelFetch(Transforms, base + 3));
+    vec4 world_position = ModelViewProjection * model * vec4(Position, 1.0f);
+    gl_Position = world_position;
+    VertexColor = Color;
+}
+"""
+
+# pick pass, writes the primitive id into an unsigned integer target
+pick_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec3 Position;
+layout(location=3) in uint PickId;
+uniform mat4 ModelViewProjection;
+flat out uint VertexPickId;
+
+void main() {
+    gl_Position = ModelViewProjection * vec4(Position, 1.0f);
+    VertexPickId = PickId;
+}
+"""
+
+pick_transform_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec3 Position;
+layout(location=2) in uint Transform;
+layout(location=3) in uint PickId;
+uniform mat4 ModelViewProjection;
+uniform samplerBuffer Transforms;
+flat out uint VertexPickId;
+
+void main() {
+    int base = int(Transform) * 4;
+    mat4 model = mat4(texelFetch(Transforms, base), texelFetch(Transforms, base + 1),
+                      texelFetch(Transforms, base + 2), texelFetch(Transforms, base + 3));
+    gl_Position = ModelViewProjection * model * vec4(Position, 1.0f);
+    VertexPickId = PickId;
+}
+"""
+
+pick_instance_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec3 Position;
+layout(location=2) in mat4 Model;
+layout(location=6) in uint PickId;
+uniform mat4 ModelViewProjection;
+flat out uint VertexPickId;
+
+void main() {
+    gl_Position = ModelViewProjection * Model * vec4(Position, 1.0f);
+    VertexPickId = PickId;
+}
+"""
+
+pick_fragment_shader_source = """
+#version 330 core
+flat in uint VertexPickId;
+out uint PickId;
+
+void main() {
+    PickId = VertexPickId;
+}
+"""
+
+# full screen triangle, the grid is computed per fragment on the y=0 plane
+grid_vertex_shader_source = """
+#version 330 core
+uniform mat4 ModelViewProjection;
+out vec3 NearPoint;
+out vec3 FarPoint;
+
+const vec2 Corners[3] = vec2[3](vec2(-1.0, -1.0), vec2(3.0, -1.0), vec2(-1.0, 3.0));
+
+vec3 unproject(vec2 ndc, float depth, mat4 inverse_vp) {
+    vec4 world_position = inverse_vp * vec4(ndc, depth, 1.0);
+    return world_position.xyz / world_position.w;
+}
+
+void main() {
+    mat4 inverse_vp = inverse(ModelViewProjection);
+    vec2 corner = Corners[gl_VertexID];
+    NearPoint = unproject(corner, -1.0, inverse_vp);
+    FarPoint = unproject(corner, 1.0, inverse_vp);
+    gl_Position = vec4(corner, 0.0, 1.0);
+}
+"""
+
+grid_fragment_shader_source = """
+#version 330 core
+uniform vec4 Color;
+uniform float Step;
+uniform float Levels;
+uniform float FadeDistance;
+in vec3 NearPoint;
+in vec3 FarPoint;
+out vec4 FragColor;
+
+const float LevelRatio = 10.0;
+
+// antialiased line coverage, 1 on a line and 0 one pixel away
+float line_coverage(vec2 coord) {
+    vec2 distance_in_pixels = abs(fract(coord - 0.5) - 0.5) / fwidth(coord);
+    return 1.0 - min(min(distance_in_pixels.x, distance_in_pixels.y), 1.0);
+}
+
+void main() {
+    float height = FarPoint.y - NearPoint.y;
+    float t = height == 0.0 ? -1.0 : -NearPoint.y / height;
+    if (t <= 0.0 || t > 1.0) {
+        discard;
+    }
+    vec3 position = mix(NearPoint, FarPoint, t);
+    vec2 coord = position.xz;
+
+    float coverage = 0.0;
+    float level_step = Step;
+    for (float level = 0.0; level < Levels; level += 1.0) {
+        vec2 cell = coord / level_step;
+        // fade out levels whose cells shrink to a few pixels
+        float cell_pixels = 1.0 / max(length(fwidth(cell)), 1e-6);
+        float level_alpha = clamp((cell_pixels - 4.0) / 12.0, 0.0, 1.0);
+        coverage = max(coverage, line_coverage(cell) * level_alpha * (0.5 + 0.5 * level / max(Levels - 1.0, 1.0)));
+        level_step *= LevelRatio;
+    }
+    vec4 color = vec4(Color.rgb, Color.a * coverage);
+
+    vec2 axis_pixels = abs(coord) / fwidth(coord);
+    if (axis_pixels.y < 1.0) {
+        color = vec4(1.0, 0.0, 0.0, 1.0 - axis_pixels.y);
+    } else if (axis_pixels.x < 1.0) {
+        color = vec4(0.0, 0.0, 1.0, 1.0 - axis_pixels.x);
+    }
+
+    float fade = 1.0 - smoothstep(0.0, FadeDistance, length(position - NearPoint));
+    color.a *= fade;
+    if (color.a <= 0.0) {
+        discard;
+    }
+    FragColor = color;
 }
 """
 
 SIZEOF_FLOAT = sizeof(GLfloat)
 
+VERTEX_DTYPE = numpy.dtype([('position', numpy.float32, 3), ('color', numpy.float32, 3)])
+COMPACT_VERTEX_DTYPE = numpy.dtype([('position', numpy.float32, 3), ('color', numpy.uint8, 4)])
+INDEX_DTYPE = numpy.dtype(numpy.uint32)
+# model matrix stored column by column, as a mat4 attribute expects
+INSTANCE_DTYPE = numpy.dtype([('model', numpy.float32, (4, 4)), ('color', numpy.float32, 3)])
+COMPACT_INSTANCE_DTYPE = numpy.dtype([('model', numpy.float32, (4, 4)), ('color', numpy.uint8, 4)])
+TRANSFORM_DTYPE = numpy.dtype((numpy.float32, (4, 4)))
+IDENTITY_COLUMNS = numpy.identity(4, dtype=numpy.float32)
+TRANSFORM_TEXTURE_UNIT = 1
+
+# (size, type, normalized) of the color attribute
+FLOAT_COLOR_FORMAT = (3, GL_FLOAT, GL_FALSE)
+COMPACT_COLOR_FORMAT = (4, GL_UNSIGNED_BYTE, GL_TRUE)
+
+
+def with_uint_field(dtype, name):
+    return numpy.dtype(dtype.descr + [(name, numpy.uint32)])
+
+def vertex_struct(dtype, count=1):
+    # count packed records, single vertices are written with pack_into
+    record = ''
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        record += '{}{}'.format(field.itemsize // field.base.itemsize, field.base.char)
+    return struct.Struct('<' + record * count)
+
+
+def float_color(color):
+    return (color.x, color.y, color.z)
+
+def pack_color(color):
+    alpha = getattr(color, 'w', 1.0)
+    return tuple(int(min(max(c, 0.0), 1.0) * 255.0 + 0.5) for c in (color.x, color.y, color.z, alpha))
+
+
+def as_positions(positions):
+    # any buffer of floats, float32 contiguous input is not copied
+    return numpy.asarray(positions, dtype=numpy.float32).reshape(-1, 3)
+
+def array_colors(colors, compact):
+    # rows of rgb or rgba in [0, 1], a single color is one row
+    colors = numpy.asarray(colors, dtype=numpy.float32)
+    colors = colors.reshape(-1, colors.shape[-1])
+    if not compact:
+        return colors[:, :3]
+    packed = numpy.empty((len(colors), 4), dtype=numpy.uint8)
+    channels = colors.shape[1]
+    scaled = colors * 255.0 + 0.5
+    numpy.clip(scaled, 0.0, 255.0, out=scaled)
+    packed[:, :channels] = scaled
+    if channels < 4:
+        packed[:, 3] = 255
+    return packed
+
+
+class PackedColorCache(object):
+    # keyed by component values, colors changed in place pack anew
+    MAX_SIZE = 1024
+
+    def __init__(self):
+        self._packed = {}
+
+    def __call__(self, color):
+        key = (color.x, color.y, color.z, getattr(color, 'w', 1.0))
+        try:
+            return self._packed[key]
+        except KeyError:
+            if len(self._packed) >= self.MAX_SIZE:
+                self._packed.clear()
+            packed = pack_color(color)
+            self._packed[key] = packed
+            return packed
+
+
+class VertexArena(object):
+    # capacity never shrinks, get_stats describes the last reset frame
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, dtype, capacity=INITIAL_CAPACITY):
+        self.dtype = dtype
+        self.vertices = numpy.empty(capacity, dtype)
+        self.count = 0
+        self.grow_count = 0
+        self.high_water = 0
+        self.last_count = 0
+        self.last_grow_count = 0
+
+    def __len__(self):
+        return self.count
+
+    def allocate(self, count):
+        start = self.count
+        end = start + count
+        if end > len(self.vertices):
+            self._grow(end)
+        self.count = end
+        return start
+
+    def _grow(self, required):
+        capacity = len(self.vertices)
+        while capacity < required:
+            capacity *= 2
+        vertices = numpy.empty(capacity, self.dtype)
+        vertices[:self.count] = self.vertices[:self.count]
+        self.vertices = vertices
+        self.grow_count += 1
+
+    def view(self):
+        return self.vertices[:self.count]
+
+    def truncate(self, count):
+        self.count = min(self.count, count)
+
+    def reset(self, keep=0):
+        # keep the first vertices, used for geometry retained across frames
+        if self.count > self.high_water:
+            self.high_water = self.count
+        self.last_count = self.count
+        self.last_grow_count = self.grow_count
+        self.count = min(self.count, keep)
+        self.grow_count = 0
+
+    def get_stats(self):
+        return {
+            'count': self.last_count,
+            'capacity': len(self.vertices),
+            'high_water': self.high_water,
+            'grow_count': self.last_grow_count,
+            'bytes': self.last_count * self.dtype.itemsize,
+        }
+
+
+class PrimitiveLayer(object):
+    # gl objects are created by the first draw, so a pipelined update thread
+    # can create layers. it records into the layer's arenas, swap_storage
+    # freezes them and the draw thread uploads the frozen ones
+    def __init__(self, batch):
+        self.batch = batch
+        self.visible = True
+        self.dirty = True
+        self.frozen = None
+        self.point_vertices = VertexArena(batch.vertex_dtype)
+        self.line_vertices = VertexArena(batch.vertex_dtype)
+        self.mesh_vertices = VertexArena(batch.vertex_dtype)
+        self.mesh_indices = VertexArena(INDEX_DTYPE)
+        self.point_count = 0
+        self.line_count = 0
+        self.mesh_index_count = 0
+        self.vao = None
+
+    def _create_objects(self):
+        self.vao = GLuint()
+        glGenVertexArrays(1, byref(self.vao))
+        glBindVertexArray(self.vao)
+        self.vbo = GLuint()
+        glGenBuffers(1, byref(self.vbo))
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        self.ebo = GLuint()
+        glGenBuffers(1, byref(self.ebo))
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        self.batch._setup_attributes()
+
+    def clear(self):
+        if self.batch.front is None:
+            for name in self.batch.GEOMETRY_ATTRIBUTES:
+                getattr(self, name).count = 0
+        else:
+            # the frozen arenas may still be uploading
+            self.renew()
+        self.dirty = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    def freeze(self):
+        # pipelined swap, the recorded arenas are handed over to draw
+        if self.dirty:
+            self.frozen = [getattr(self, name) for name in self.batch.GEOMETRY_ATTRIBUTES]
+            self.dirty = False
+
+    def get_pending_geometry(self):
+        # the arenas the next draw uploads, None when the upload is current
+        if self.frozen is not None:
+            return self.frozen
+        if self.dirty and self.batch.front is None:
+            return [getattr(self, name) for name in self.batch.GEOMETRY_ATTRIBUTES]
+        return None
+
+    def _upload(self, geometry):
+        points, lines, mesh_vertices, mesh_indices = (arena.view() for arena in geometry)
+        total_bytes = points.nbytes + lines.nbytes + mesh_vertices.nbytes
+        glBufferData(GL_ARRAY_BUFFER, total_bytes, None, GL_STATIC_DRAW)
+        offset = 0
+        for vertices in (points, lines, mesh_vertices):
+            if len(vertices):
+                glBufferSubData(GL_ARRAY_BUFFER, offset, vertices.nbytes, vertices.ctypes.data)
+            offset += vertices.nbytes
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, mesh_indices.nbytes, mesh_indices.ctypes.data, GL_STATIC_DRAW)
+        self.point_count = len(points)
+        self.line_count = len(lines)
+        self.mesh_index_count = len(mesh_indices)
+
+    def draw(self):
+        if self.vao is None:
+            self._create_objects()
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        geometry = self.get_pending_geometry()
+        if geometry is not None:
+            self.frozen = None
+            # a pipelined update thread may already be recording again
+            if self.batch.front is None:
+                self.dirty = False
+            self._upload(geometry)
+        if self.point_count:
+            glDrawArrays(GL_POINTS, 0, self.point_count)
+        if self.line_count:
+            glDrawArrays(GL_LINES, self.point_count, self.line_count)
+        if self.mesh_index_count:
+            base_vertex = self.point_count + self.line_count
+            glDrawElementsBaseVertex(GL_LINES, self.mesh_index_count, GL_UNSIGNED_INT, None, base_vertex)
+
+    def renew(self):
+        # fresh empty arenas, the previous ones may still be uploading
+        for name in self.batch.GEOMETRY_ATTRIBUTES:
+            setattr(self, name, VertexArena(getattr(self, name).dtype))
+
+    def delete(self):
+        if self.vao is None:
+            return
+        glDeleteBuffers(1, byref(self.vbo))
+        glDeleteBuffers(1, byref(self.ebo))
+        glDeleteVertexArrays(1, byref(self.vao))
+        self.vao = None
+
+
+class FrameStorage(object):
+    # cpu side geometry of one frame, a pipelined batch records into its own
+    # attributes while the storage handed out by swap_storage is drawn
+    def __init__(self, batch):
+        self.point_vertices = VertexArena(batch.vertex_dtype)
+        self.line_vertices = VertexArena(batch.vertex_dtype)
+        self.mesh_vertices = VertexArena(batch.vertex_dtype)
+        self.mesh_indices = VertexArena(INDEX_DTYPE)
+        self.instances = {}
+        self.grids = []
+        self.pick_request = None
+        self.layers = []
+        if batch.transforms:
+            self.transform_matrices = VertexArena(TRANSFORM_DTYPE)
+            self.transform_matrices.vertices[self.transform_matrices.allocate(1)] = IDENTITY_COLUMNS
+        self.camera = batch.camera
+
 
 class PrimitiveBatch(object):
-    VERTEX_SIZE = 6
-    VERTEX_SIZE_BYTES = VERTEX_SIZE * SIZEOF_FLOAT
+    GEOMETRY_ATTRIBUTES = ('point_vertices', 'line_vertices', 'mesh_vertices', 'mesh_indices')
+    STORAGE_ATTRIBUTES = GEOMETRY_ATTRIBUTES + ('instances', 'grids', 'pick_request')
     BATCH_SIZE = 6 * 1000
-    BATCH_SIZE_FLOATS = VERTEX_SIZE * BATCH_SIZE
-    BATCH_SIZE_BYTES = BATCH_SIZE_FLOATS * SIZEOF_FLOAT
-    def __init__(self, app, camera):
+    INSTANCE_BATCH_SIZE = 1000
+    def __init__(self, app, camera, *, streaming=False, instancing=False, compact=False, culling=True, lod=None,
+                 transforms=False, picking=False, gpu_timing=False, pipelined=False):
         self.app = app
         self.camera = camera
-        self.shader = toy.shader.Shader(vertex_shader_source, fragment_shader_source)
-        self.point_vertices = array.array('f')
-        self.line_vertices = array.array('f')
+        self.streaming = streaming
+        self.instancing = instancing
+        self.culling = culling
+        self.lod = lod
+        self.compact = compact
+        if compact:
+            self.vertex_dtype = COMPACT_VERTEX_DTYPE
+            self.instance_dtype = COMPACT_INSTANCE_DTYPE
+            self.color_format = COMPACT_COLOR_FORMAT
+            self.color_value = PackedColorCache()
+        else:
+            self.vertex_dtype = VERTEX_DTYPE
+            self.instance_dtype = INSTANCE_DTYPE
+            self.color_format = FLOAT_COLOR_FORMAT
+            self.color_value = float_color
+        # vertices carry an index into the per frame model matrices
+        self.transforms = transforms
+        self.local_transforms = transforms
+        self.frame = 0
+        if transforms:
+            self.vertex_dtype = with_uint_field(self.vertex_dtype, 'transform')
+            self.shader = toy.shader.Shader(transform_vertex_shader_source, fragment_shader_source)
+            self.transform_matrices = VertexArena(TRANSFORM_DTYPE)
+            self.transform_matrices.vertices[self.transform_matrices.allocate(1)] = IDENTITY_COLUMNS
+            self.transform_upload_bytes = 0
+            self.transform_buffer = GLuint()
+            glGenBuffers(1, byref(self.transform_buffer))
+            glBindBuffer(GL_TEXTURE_BUFFER, self.transform_buffer)
+            glBufferData(GL_TEXTURE_BUFFER, TRANSFORM_DTYPE.itemsize, None, GL_STREAM_DRAW)
+            self.transform_texture = GLuint()
+            glGenTextures(1, byref(self.transform_texture))
+            glBindTexture(GL_TEXTURE_BUFFER, self.transform_texture)
+            glTexBuffer(GL_TEXTURE_BUFFER, GL_RGBA32F, self.transform_buffer)
+        else:
+            self.shader = toy.shader.Shader(vertex_shader_source, fragment_shader_source)
+        # vertices carry a user id, rendered by the pick pass on request
+        self.picking = picking
+        self.current_pick_id = 0
+        self.pick_request = None
+        self.pick_buffer = None
+        self.pick_shader = None
+        self.pick_instance_shader = None
+        self.drawing_pick = False
+        if picking:
+            self.vertex_dtype = with_uint_field(self.vertex_dtype, 'pick_id')
+            self.instance_dtype = with_uint_field(self.instance_dtype, 'pick_id')
+        # single vertices are packed straight into the arena bytes
+        self.vertex_stride = self.vertex_dtype.itemsize
+        self.vertex_struct = vertex_struct(self.vertex_dtype)
+        self.vertex_ids = transforms or picking
+        self.line_struct = vertex_struct(self.vertex_dtype, 2)
+        self.template_record = numpy.zeros(1, self.vertex_dtype)
+        self.instance_stride = self.instance_dtype.itemsize
+        self.instance_struct = vertex_struct(self.instance_dtype)
+        self.point_vertices = VertexArena(self.vertex_dtype)
+        self.line_vertices = VertexArena(self.vertex_dtype)
+        self.mesh_vertices = VertexArena(self.vertex_dtype)
+        self.mesh_indices = VertexArena(INDEX_DTYPE)
+        self.layers = []
+        self.mesh_draw_calls = 0
+        self.mesh_upload_bytes = 0
         self.vao = GLuint()
         glGenVertexArrays(1, byref(self.vao))
         glBindVertexArray(self.vao)
-        self.vbo = GLuint()
-        glGenBuffers(1, byref(self.vbo))
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.BATCH_SIZE_BYTES, None, GL_STREAM_DRAW)
-        stride = self.VERTEX_SIZE_BYTES
+        self.stream = toy.streaming.create_stream(
+            self.vertex_dtype.itemsize, self.BATCH_SIZE, self._setup_attributes, streaming)
+
+        self.mesh_vao = GLuint()
+        glGenVertexArrays(1, byref(self.mesh_vao))
+        glBindVertexArray(self.mesh_vao)
+        self.mesh_vbo = GLuint()
+        glGenBuffers(1, byref(self.mesh_vbo))
+        glBindBuffer(GL_ARRAY_BUFFER, self.mesh_vbo)
+        self.mesh_ebo = GLuint()
+        glGenBuffers(1, byref(self.mesh_ebo))
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.mesh_ebo)
+        self._setup_attributes()
+
+        self.instances = {}
+        self.instance_meshes = []
+        self.instance_mesh_ranges = {}
+        self.instance_vao = None
+        self.grids = []
+        self.grid_count = 0
+        self.grid_vao = None
+        self.tick_marks = None
+        self.gpu_timer = toy.profiler.create_gpu_timer(gpu_timing)
+        self.storage_attributes = self.STORAGE_ATTRIBUTES
+        if transforms:
+            self.storage_attributes += ('transform_matrices',)
+        self.front = FrameStorage(self) if pipelined else None
+        self.deferred_callbacks = []
+        self.removed_layers = []
+        glPointSize(2.0)
+
+    def _create_instance_objects(self):
+        self.instance_shader = toy.shader.Shader(instance_vertex_shader_source, fragment_shader_source)
+        self.instance_vao = GLuint()
+        glGenVertexArrays(1, byref(self.instance_vao))
+        glBindVertexArray(self.instance_vao)
+        self.instance_mesh_vbo = GLuint()
+        glGenBuffers(1, byref(self.instance_mesh_vbo))
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_mesh_vbo)
+        self.instance_mesh_ebo = GLuint()
+        glGenBuffers(1, byref(self.instance_mesh_ebo))
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.instance_mesh_ebo)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 3 * SIZEOF_FLOAT, None)
+        glEnableVertexAttribArray(0)
+        self.instance_stream = toy.streaming.create_stream(
+            self.instance_dtype.itemsize, self.INSTANCE_BATCH_SIZE, self._setup_instance_attributes, self.streaming)
+
+    def _create_grid_objects(self):
+        self.grid_shader = toy.shader.Shader(grid_vertex_shader_source, grid_fragment_shader_source)
+        # attributeless draw, core profile still needs a vertex array bound
+        self.grid_vao = GLuint()
+        glGenVertexArrays(1, byref(self.grid_vao))
+
+    def _setup_attributes(self):
+        stride = self.vertex_dtype.itemsize
+        color_size, color_type, color_normalized = self.color_format
         glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, None)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, stride, 3 * SIZEOF_FLOAT)
+        glVertexAttribPointer(1, color_size, color_type, color_normalized, stride, 3 * SIZEOF_FLOAT)
         glEnableVertexAttribArray(0)
         glEnableVertexAttribArray(1)
-        glPointSize(2.0)
+        if self.transforms:
+            transform_offset = self.vertex_dtype.fields['transform'][1]
+            glVertexAttribIPointer(2, 1, GL_UNSIGNED_INT, stride, transform_offset)
+            glEnableVertexAttribArray(2)
+        if self.picking:
+            pick_id_offset = self.vertex_dtype.fields['pick_id'][1]
+            glVertexAttribIPointer(3, 1, GL_UNSIGNED_INT, stride, pick_id_offset)
+            glEnableVertexAttribArray(3)
+
+    def _set_instance_attribute_offset(self, offset):
+        dtype = self.instance_dtype
+        stride = dtype.itemsize
+        model_offset = offset + dtype.fields['model'][1]
+        color_offset = offset + dtype.fields['color'][1]
+        color_size, color_type, color_normalized = self.color_format
+        glVertexAttribPointer(1, color_size, color_type, color_normalized, stride, color_offset)
+        for column in range(4):
+            glVertexAttribPointer(2 + column, 4, GL_FLOAT, GL_FALSE, stride, model_offset + column * 4 * SIZEOF_FLOAT)
+        if self.picking:
+            pick_id_offset = offset + dtype.fields['pick_id'][1]
+            glVertexAttribIPointer(6, 1, GL_UNSIGNED_INT, stride, pick_id_offset)
+
+    def _setup_instance_attributes(self):
+        self._set_instance_attribute_offset(0)
+        for location in range(1, 7 if self.picking else 6):
+            glEnableVertexAttribArray(location)
+            glVertexAttribDivisor(location, 1)
+
+    def add_transform(self, matrix):
+        # index is valid until the end of the current frame, 0 is identity
+        arena = self.transform_matrices
+        i = arena.allocate(1)
+        m = matrix
+        arena.vertices[i] = ((m.a, m.e, m.i, m.m), (m.b, m.f, m.j, m.n), (m.c, m.g, m.k, m.o), (m.d, m.h, m.l, m.p))
+        return i
+
+    def _vertex_ids(self, transform):
+        # the uint fields after color, in vertex_dtype order
+        ids = ()
+        if self.transforms:
+            ids += (transform,)
+        if self.picking:
+            ids += (self.current_pick_id,)
+        return ids
+
+    def draw_point(self, position, color, transform=0):
+        arena = self.point_vertices
+        i = arena.allocate(1)
+        values = self.color_value(color)
+        if self.vertex_ids:
+            values += self._vertex_ids(transform)
+        self.vertex_struct.pack_into(arena.vertices, i * self.vertex_stride,
+                                     position.x, position.y, position.z, *values)
+
+    def draw_line(self, position0, position1, color, transform=0):
+        arena = self.line_vertices
+        i = arena.allocate(2)
+        values = self.color_value(color)
+        if self.vertex_ids:
+            values += self._vertex_ids(transform)
+        self.line_struct.pack_into(arena.vertices, i * self.vertex_stride,
+                                   position0.x, position0.y, position0.z, *values,
+                                   position1.x, position1.y, position1.z, *values)
+
+    def _draw_vertex_array(self, arena, positions, colors, transform, vertices_per_primitive):
+        count = len(positions)
+        start = arena.allocate(count)
+        vertices = arena.vertices[start:start + count]
+        vertices['position'] = positions
+        if hasattr(colors, 'x'):
+            vertices['color'] = self.color_value(colors)
+        else:
+            # a single color, one per primitive or one per vertex
+            colors = array_colors(colors, self.compact)
+            if len(colors) == 1:
+                vertices['color'] = colors[0]
+            elif len(colors) == count:
+                vertices['color'] = colors
+            elif len(colors) * vertices_per_primitive == count:
+                vertices['color'] = numpy.repeat(colors, vertices_per_primitive, axis=0)
+            else:
+                raise ValueError('{} colors for {} vertices'.format(len(colors), count))
+        if self.transforms:
+            vertices['transform'] = transform
+        if self.picking:
+            vertices['pick_id'] = self.current_pick_id
+
+    def draw_points(self, positions, colors, transform=0):
+        # positions is Nx3, colors a single color or one per point
+        self._draw_vertex_array(self.point_vertices, as_positions(positions), colors, transform, 1)
+
+    def draw_lines(self, positions0, positions1, colors, transform=0):
+        # positions0 and positions1 are Nx3 line ends, colors a single color,
+        # one per line or one per line end
+        positions0 = as_positions(positions0)
+        positions1 = as_positions(positions1)
+        segments = numpy.empty((len(positions0), 2, 3), dtype=numpy.float32)
+        segments[:, 0] = positions0
+        segments[:, 1] = positions1
+        self._draw_vertex_array(self.line_vertices, segments.reshape(-1, 3), colors, transform, 2)
+
+    def draw_line_list(self, segments, colors, transform=0):
+        # segments is Nx2x3, colors a single color, one per line or one per line end
+        self._draw_vertex_array(self.line_vertices, as_positions(segments), colors, transform, 2)
+
+    def _append_mesh_indices(self, indices, base):
+        index_arena = self.mesh_indices
+        start = index_arena.allocate(len(indices))
+        numpy.add(indices, base, out=index_arena.vertices[start:start + len(indices)], casting='unsafe')
+
+    def draw_line_mesh(self, positions, indices, color, transform=0):
+        vertex_arena = self.mesh_vertices
+        base = vertex_arena.allocate(len(positions))
+        vertices = vertex_arena.vertices
+        pack_into = self.vertex_struct.pack_into
+        stride = self.vertex_stride
+        values = self.color_value(color)
+        if self.vertex_ids:
+            values += self._vertex_ids(transform)
+        if isinstance(positions, numpy.ndarray):
+            # rows of xyz are written at once like a template
+            self.vertex_struct.pack_into(self.template_record, 0, 0.0, 0.0, 0.0, *values)
+            count = len(positions)
+            vertices = vertices[base:base + count]
+            vertices[...] = self.template_record
+            vertices['position'] = as_positions(positions)
+        else:
+            for i, position in enumerate(positions, base):
+                pack_into(vertices, i * stride, position.x, position.y, position.z, *values)
+        self._append_mesh_indices(indices, base)
+
+    def draw_mesh_template(self, line_mesh, affine, color, transform=0):
+        # affine is a (3, 4) row major matrix applied to the unit template
+        positions = line_mesh.positions
+        count = len(positions)
+        vertex_arena = self.mesh_vertices
+        base = vertex_arena.allocate(count)
+        vertices = vertex_arena.vertices[base:base + count]
+        # color and ids are the same for every vertex, packed once
+        values = self.color_value(color)
+        if self.vertex_ids:
+            values += self._vertex_ids(transform)
+        self.vertex_struct.pack_into(self.template_record, 0, 0.0, 0.0, 0.0, *values)
+        vertices[...] = self.template_record
+        vertices['position'] = numpy.dot(positions, affine[:, :3].T) + affine[:, 3]
+        self._append_mesh_indices(line_mesh.indices, base)
 
-    def draw_point(self, position, color):
-        self.point_vertices.extend((position.x, position.y, position.z,
-            color.x, color.y, color.z))
+    def draw_infinite_grid(self, step, color, levels, fade_distance):
+        self.grids.append((step, color, levels, fade_distance))
 
-    def draw_line(self, position0, position1, color):
-        self.line_vertices.extend((position0.x, position0.y, position0.z,
-            color.x, color.y, color.z,
-            position1.x, position1.y, position1.z,
-            color.x, color.y, color.z))
+    def _get_instance_arena(self, line_mesh):
+        try:
+            return self.instances[line_mesh]
+        except KeyError:
+            arena = VertexArena(self.instance_dtype)
+            self.instances[line_mesh] = arena
+            # each storage has its own arenas, the mesh is uploaded once
+            if line_mesh not in self.instance_meshes:
+                self.instance_meshes.append(line_mesh)
+            return arena
+
+    def _instance_values(self, color):
+        values = self.color_value(color)
+        if self.picking:
+            values += (self.current_pick_id,)
+        return values
+
+    def draw_instance(self, line_mesh, matrix, color):
+        arena = self._get_instance_arena(line_mesh)
+        i = arena.allocate(1)
+        m = matrix
+        # model is stored as columns
+        self.instance_struct.pack_into(arena.vertices, i * self.instance_stride,
+                                       m.a, m.e, m.i, m.m, m.b, m.f, m.j, m.n,
+                                       m.c, m.g, m.k, m.o, m.d, m.h, m.l, m.p, *self._instance_values(color))
+
+    def draw_instance_affine(self, line_mesh, affine, color):
+        arena = self._get_instance_arena(line_mesh)
+        i = arena.allocate(1)
+        row0, row1, row2 = affine.tolist()
+        self.instance_struct.pack_into(arena.vertices, i * self.instance_stride,
+                                       row0[0], row1[0], row2[0], 0.0, row0[1], row1[1], row2[1], 0.0,
+                                       row0[2], row1[2], row2[2], 0.0, row0[3], row1[3], row2[3], 1.0,
+                                       *self._instance_values(color))
+
+    def begin_tick(self):
+        # geometry drawn during a fixed tick is kept and redrawn every frame
+        # until the next tick, anything drawn after end_tick is per frame
+        self.tick_marks = None
+        for name in self.GEOMETRY_ATTRIBUTES:
+            getattr(self, name).truncate(0)
+        for arena in self.instances.values():
+            arena.truncate(0)
+        self.grids.clear()
+        if self.transforms:
+            self.transform_matrices.truncate(1)
+        self.frame += 1
+
+    def end_tick(self):
+        marks = {name: len(getattr(self, name)) for name in self.GEOMETRY_ATTRIBUTES}
+        for line_mesh, arena in self.instances.items():
+            marks[line_mesh] = len(arena)
+        marks['grids'] = len(self.grids)
+        if self.transforms:
+            marks['transform_matrices'] = len(self.transform_matrices)
+        self.tick_marks = marks
+
+    def _tick_mark(self, key):
+        if self.tick_marks is None:
+            return 0
+        return self.tick_marks.get(key, 0)
+
+    @contextlib.contextmanager
+    def pick_id(self, pick_id):
+        # primitives drawn inside carry pick_id, 0 is reserved for nothing
+        saved = self.current_pick_id
+        self.current_pick_id = pick_id
+        try:
+            yield
+        finally:
+            self.current_pick_id = saved
+
+    def request_pick(self, x, y, callback):
+        # window pixels like mouse events, callback(pick_id) runs a frame or
+        # two later, a newer request replaces a pending one
+        if not self.picking:
+            raise ValueError('request_pick needs a batch created with picking=True')
+        self.pick_request = (x, y, callback)
+
+    def create_layer(self):
+        layer = PrimitiveLayer(self)
+        self.layers.append(layer)
+        return layer
+
+    def remove_layer(self, layer):
+        self.layers.remove(layer)
+        if self.front is None:
+            layer.delete()
+        else:
+            # still in the front storage, deleted by the next swap
+            self.removed_layers.append(layer)
+
+    @contextlib.contextmanager
+    def record_layer(self, layer):
+        layer.clear()
+        saved = [getattr(self, name) for name in self.GEOMETRY_ATTRIBUTES]
+        for name in self.GEOMETRY_ATTRIBUTES:
+            setattr(self, name, getattr(layer, name))
+        # layers keep tessellated geometry, instances and transforms are per
+        # frame only, and a layer must not depend on the camera it was recorded with
+        instancing = self.instancing
+        culling = self.culling
+        lod = self.lod
+        local_transforms = self.local_transforms
+        self.instancing = False
+        self.culling = False
+        self.lod = None
+        self.local_transforms = False
+        try:
+            yield layer
+        finally:
+            for name, arena in zip(self.GEOMETRY_ATTRIBUTES, saved):
+                setattr(self, name, arena)
+            self.instancing = instancing
+            self.culling = culling
+            self.lod = lod
+            self.local_transforms = local_transforms
+            layer.invalidate()
+
+    def swap_storage(self):
+        # pipelined apps call this while the update thread is idle, the
+        # recorded storage becomes front and draw renders it
+        front = self.front
+        for name in self.storage_attributes:
+            recorded = getattr(self, name)
+            setattr(self, name, getattr(front, name))
+            setattr(front, name, recorded)
+        front.camera = copy.copy(self.camera)
+        # layers are drawn as they were when this frame was recorded
+        front.layers = list(self.layers)
+        for layer in front.layers:
+            layer.freeze()
+        for layer in self.removed_layers:
+            layer.delete()
+        self.removed_layers = []
+        self.frame += 1
+        callbacks = self.deferred_callbacks
+        self.deferred_callbacks = []
+        for callback, pick_id in callbacks:
+            callback(pick_id)
+
+    def get_storage(self):
+        # the storage the next draw renders
+        return self if self.front is None else self.front
+
+    def append_vertices(self, name, vertices, line_mesh=None):
+        # raw records in this batch's dtypes, like a captured frame
+        if name == 'instances':
+            arena = self._get_instance_arena(line_mesh)
+        else:
+            arena = getattr(self, name)
+        start = arena.allocate(len(vertices))
+        arena.vertices[start:start + len(vertices)] = vertices
+
+    def _pick_callback(self, callback):
+        if self.front is None:
+            return callback
+        # game code must not run while the update thread is busy, defer to the next swap
+        def deferred(pick_id):
+            self.deferred_callbacks.append((callback, pick_id))
+        return deferred
+
+    def _draw_grids(self, storage):
+        if self.grid_vao is None:
+            self._create_grid_objects()
+        shader = self.grid_shader
+        shader.use()
+        shader.set_uniform_matrix(b'ModelViewProjection', storage.camera.get_view_projection())
+        glBindVertexArray(self.grid_vao)
+        for step, color, levels, fade_distance in storage.grids:
+            shader.set_uniform_color(b'Color', color)
+            shader.set_uniform_float(b'Step', step)
+            shader.set_uniform_float(b'Levels', levels)
+            shader.set_uniform_float(b'FadeDistance', fade_distance)
+            glDrawArrays(GL_TRIANGLES, 0, 3)
+
+    def _upload_transforms(self, storage):
+        arena = storage.transform_matrices
+        matrices = arena.view()
+        glBindBuffer(GL_TEXTURE_BUFFER, self.transform_buffer)
+        glBufferData(GL_TEXTURE_BUFFER, matrices.nbytes, matrices.ctypes.data, GL_STREAM_DRAW)
+        glActiveTexture(GL_TEXTURE0 + TRANSFORM_TEXTURE_UNIT)
+        glBindTexture(GL_TEXTURE_BUFFER, self.transform_texture)
+        glActiveTexture(GL_TEXTURE0)
+        self.transform_upload_bytes = matrices.nbytes
+        arena.reset(max(self._tick_mark('transform_matrices'), 1))
+
+    def _create_pick_objects(self):
+        if self.transforms:
+            vertex_source = pick_transform_vertex_shader_source
+        else:
+            vertex_source = pick_vertex_shader_source
+        self.pick_shader = toy.shader.Shader(vertex_source, pick_fragment_shader_source)
+        self.pick_instance_shader = toy.shader.Shader(pick_instance_vertex_shader_source, pick_fragment_shader_source)
+        self.pick_buffer = toy.picking.PickBuffer()
+
+    def _begin_pick(self, storage):
+        if self.pick_buffer is None:
+            self._create_pick_objects()
+        x, y, _ = storage.pick_request
+        camera = storage.camera
+        self.pick_buffer.begin(x, y, camera.width, camera.height)
+        vp_matrix = camera.get_view_projection()
+        self.pick_shader.use()
+        self.pick_shader.set_uniform_matrix(b'ModelViewProjection', vp_matrix)
+        if self.transforms:
+            self.pick_shader.set_uniform_int(b'Transforms', TRANSFORM_TEXTURE_UNIT)
+        self.pick_instance_shader.use()
+        self.pick_instance_shader.set_uniform_matrix(b'ModelViewProjection', vp_matrix)
+        self.drawing_pick = True
+
+    def _end_pick(self, storage):
+        _, _, callback = storage.pick_request
+        storage.pick_request = None
+        self.drawing_pick = False
+        self.pick_buffer.end(self._pick_callback(callback))
+
+    def _with_pick(self, draw, shader, pick_shader):
+        # while a pick is drawn every draw is repeated into the pick target,
+        # from the buffers it was just uploaded to
+        if not self.drawing_pick:
+            return draw
+        def draw_with_pick(*args):
+            draw(*args)
+            pick_shader.use()
+            self.pick_buffer.bind()
+            draw(*args)
+            self.pick_buffer.unbind()
+            shader.use()
+        return draw_with_pick
 
     def _draw_vertices(self, vertices, primitive_mode):
-        address, length_floats = vertices.buffer_info()
-        batch_count, last_floats = divmod(length_floats, self.BATCH_SIZE_FLOATS)
-        for i in range(batch_count):
-            sub_address = address + i * self.BATCH_SIZE_BYTES
-            glBufferSubData(GL_ARRAY_BUFFER, 0, self.BATCH_SIZE_BYTES, sub_address)
-            glDrawArrays(primitive_mode, 0, self.BATCH_SIZE)
-        if last_floats > 0:
-            sub_address = address + batch_count * self.BATCH_SIZE_BYTES
-            glBufferSubData(GL_ARRAY_BUFFER, 0, last_floats * SIZEOF_FLOAT, sub_address)
-            glDrawArrays(primitive_mode, 0, last_floats // self.VERTEX_SIZE)
+        def draw_arrays(first, count):
+            glDrawArrays(primitive_mode, first, count)
+        draw_arrays = self._with_pick(draw_arrays, self.shader, self.pick_shader)
+        self.stream.draw(vertices.ctypes.data, len(vertices), draw_arrays)
+
+    def _draw_meshes(self, storage):
+        vertices = storage.mesh_vertices.view()
+        indices = storage.mesh_indices.view()
+        glBindVertexArray(self.mesh_vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.mesh_vbo)
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices.ctypes.data, GL_STREAM_DRAW)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices.ctypes.data, GL_STREAM_DRAW)
+        def draw_elements():
+            glDrawElements(GL_LINES, len(indices), GL_UNSIGNED_INT, None)
+        self._with_pick(draw_elements, self.shader, self.pick_shader)()
+        self.mesh_draw_calls = 1
+        self.mesh_upload_bytes = vertices.nbytes + indices.nbytes
+
+    def _upload_instance_meshes(self):
+        # copy, a pipelined update thread may be registering new meshes
+        instance_meshes = list(self.instance_meshes)
+        positions = numpy.concatenate([line_mesh.positions for line_mesh in instance_meshes])
+        indices = numpy.concatenate([line_mesh.indices for line_mesh in instance_meshes])
+        index_offset = 0
+        base_vertex = 0
+        for line_mesh in instance_meshes:
+            index_count = len(line_mesh.indices)
+            self.instance_mesh_ranges[line_mesh] = (index_offset * INDEX_DTYPE.itemsize, index_count, base_vertex)
+            index_offset += index_count
+            base_vertex += len(line_mesh.positions)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_mesh_vbo)
+        glBufferData(GL_ARRAY_BUFFER, positions.nbytes, positions.ctypes.data, GL_STATIC_DRAW)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices.ctypes.data, GL_STATIC_DRAW)
+
+    def _draw_instances(self, storage):
+        if self.instance_vao is None:
+            self._create_instance_objects()
+        self.instance_shader.use()
+        vp_matrix = storage.camera.get_view_projection()
+        self.instance_shader.set_uniform_matrix(b'ModelViewProjection', vp_matrix)
+        glBindVertexArray(self.instance_vao)
+        ranges = self.instance_mesh_ranges
+        if any(line_mesh not in ranges for line_mesh in storage.instances):
+            self._upload_instance_meshes()
+        stream = self.instance_stream
+        stream.bind()
+        stream.begin_frame(sum(len(arena) for arena in storage.instances.values()))
+        stride = self.instance_dtype.itemsize
+        for line_mesh, arena in storage.instances.items():
+            if arena:
+                index_offset, index_count, base_vertex = self.instance_mesh_ranges[line_mesh]
+                def draw_instanced(first, count):
+                    self._set_instance_attribute_offset(first * stride)
+                    glDrawElementsInstancedBaseVertex(
+                        GL_LINES, index_count, GL_UNSIGNED_INT, index_offset, count, base_vertex)
+                draw_instanced = self._with_pick(draw_instanced, self.instance_shader, self.pick_instance_shader)
+                stream.draw(arena.view().ctypes.data, len(arena), draw_instanced)
+            arena.reset(self._tick_mark(line_mesh))
+        stream.end_frame()
+
+    def get_stats(self):
+        storage = self.get_storage()
+        draw_calls = self.stream.draw_calls + self.mesh_draw_calls
+        upload_bytes = self.stream.upload_bytes + self.mesh_upload_bytes
+        if self.transforms:
+            upload_bytes += self.transform_upload_bytes
+        if self.instance_vao is not None:
+            draw_calls += self.instance_stream.draw_calls
+            upload_bytes += self.instance_stream.upload_bytes
+        return {
+            'points': storage.point_vertices.get_stats(),
+            'lines': storage.line_vertices.get_stats(),
+            'mesh_vertices': storage.mesh_vertices.get_stats(),
+            'mesh_indices': storage.mesh_indices.get_stats(),
+            'instances': sum(arena.last_count for arena in storage.instances.values()),
+            'transforms': storage.transform_matrices.get_stats() if self.transforms else None,
+            'layers': len(self.layers),
+            'grids': self.grid_count,
+            'draw_calls': draw_calls,
+            'upload_bytes': upload_bytes,
+            'gpu_times': self.gpu_timer.times,
+        }
 
     def draw(self):
+        # a pipelined batch draws the swapped out front storage
+        storage = self.get_storage()
+        with self.gpu_timer.scope('draw'):
+            self._draw(storage)
+        self.gpu_timer.end_frame()
+        if self.front is None:
+            self.frame += 1
+
+    def _draw(self, storage):
+        timer = self.gpu_timer
+        # grids go first, everything else is drawn on top of them
+        self.grid_count = len(storage.grids)
+        if storage.grids:
+            with timer.scope('grids'):
+                self._draw_grids(storage)
+            del storage.grids[self._tick_mark('grids'):]
+        if self.transforms:
+            self._upload_transforms(storage)
+        if self.pick_buffer is not None:
+            self.pick_buffer.poll()
+        picking = storage.pick_request is not None and not (self.pick_buffer is not None and self.pick_buffer.busy)
+        if picking:
+            self._begin_pick(storage)
         self.shader.use()
-        glBindVertexArray(self.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        vp_matrix = self.camera.get_view_projection()
+        vp_matrix = storage.camera.get_view_projection()
         self.shader.set_uniform_matrix(b'ModelViewProjection', vp_matrix)
-        if self.point_vertices:
-            self._draw_vertices(self.point_vertices, GL_POINTS)
-            del self.point_vertices[:]
-        if self.line_vertices:
-            self._draw_vertices(self.line_vertices, GL_LINES)
-            del self.line_vertices[:]
+        if self.transforms:
+            self.shader.set_uniform_int(b'Transforms', TRANSFORM_TEXTURE_UNIT)
+        with timer.scope('layers'):
+            for layer in storage.layers:
+                if layer.visible:
+                    self._with_pick(layer.draw, self.shader, self.pick_shader)()
+        glBindVertexArray(self.vao)
+        self.stream.bind()
+        self.stream.begin_frame(len(storage.point_vertices) + len(storage.line_vertices))
+        if storage.point_vertices:
+            with timer.scope('points'):
+                self._draw_vertices(storage.point_vertices.view(), GL_POINTS)
+        storage.point_vertices.reset(self._tick_mark('point_vertices'))
+        if storage.line_vertices:
+            with timer.scope('lines'):
+                self._draw_vertices(storage.line_vertices.view(), GL_LINES)
+        storage.line_vertices.reset(self._tick_mark('line_vertices'))
+        self.stream.end_frame()
+        self.mesh_draw_calls = 0
+        self.mesh_upload_bytes = 0
+        if storage.mesh_indices:
+            with timer.scope('meshes'):
+                self._draw_meshes(storage)
+        storage.mesh_vertices.reset(self._tick_mark('mesh_vertices'))
+        storage.mesh_indices.reset(self._tick_mark('mesh_indices'))
+        if storage.instances:
+            with timer.scope('instances'):
+                self._draw_instances(storage)
+        if picking:
+            self._end_pick(storage)
 
 
-texture_vertex_shader_source = """
-#version 330 core
-layout(location=0) in vec2 Position;
-layout(location=1) in vec2 InTexCoord;
-layout(location=2) in vec3 Color;
-uniform mat4 ModelViewProjection;
+glyph_quad_source = """
+const vec2 GlyphSize = vec2(22.0, 41.0);
+const float AtlasSize = 512.0;
+const uint GlyphColumns = 16u;
+const vec2 Corners[6] = vec2[6](
+    vec2(0.0, 0.0), vec2(1.0, 0.0), vec2(0.0, 1.0),
+    vec2(0.0, 1.0), vec2(1.0, 0.0), vec2(1.0, 1.0));
 
 out vec2 TexCoord;
-out vec3 VertexColor;
+out vec4 VertexColor;
 
+// screen offset of the current quad corner, sets texcoord and color
+vec2 emit_glyph(vec2 origin, float scale, uint glyph, vec4 color) {
+    vec2 corner = Corners[gl_VertexID];
+    float col = float(glyph % GlyphColumns);
+    float row = float(glyph / GlyphColumns);
+    vec2 delta_uv = GlyphSize / AtlasSize;
+    TexCoord = vec2((col + corner.x) * delta_uv.x, 1.0 - (row + 1.0 - corner.y) * delta_uv.y);
+    VertexColor = color;
+    return origin + corner * GlyphSize * scale;
+}
+"""
+
+# one instance per glyph, expanded to a quad of 6 vertices
+texture_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec2 Origin;
+layout(location=1) in float Scale;
+layout(location=2) in uint Glyph;
+layout(location=3) in vec4 Color;
+uniform mat4 ModelViewProjection;
+""" + glyph_quad_source + """
 void main() {
-    vec4 world_position = ModelViewProjection * vec4(Position, 0.0, 1.0);
+    vec2 position = emit_glyph(Origin, Scale, Glyph, Color);
+    vec4 world_position = ModelViewProjection * vec4(position, 0.0, 1.0);
     gl_Position = world_position;
-    TexCoord = InTexCoord;
-    VertexColor = Color;
+}
+"""
+
+# anchor projected on the gpu, glyph offsets stay in 600 unit screen space
+world_text_vertex_shader_source = """
+#version 330 core
+layout(location=0) in vec3 Anchor;
+layout(location=1) in vec2 Origin;
+layout(location=2) in float Scale;
+layout(location=3) in uint Glyph;
+layout(location=4) in vec4 Color;
+uniform mat4 ViewProjection;
+uniform mat4 ModelViewProjection;
+""" + glyph_quad_source + """
+void main() {
+    vec2 position = emit_glyph(Origin, Scale, Glyph, Color);
+    vec4 clip_anchor = ViewProjection * vec4(Anchor, 1.0);
+    if (clip_anchor.w <= 0.0) {
+        // behind the camera, outside of the clip volume
+        gl_Position = vec4(0.0, 0.0, 2.0, 1.0);
+        return;
+    }
+    vec2 ndc_anchor = clip_anchor.xy / clip_anchor.w;
+    gl_Position = vec4(ndc_anchor, 0.0, 1.0) + ModelViewProjection * vec4(position, 0.0, 0.0);
 }
 """
 
@@ -127,12 +1195,12 @@ texture_fragment_shader_source = """
 uniform sampler2D Texture;
 
 in vec2 TexCoord;
-in vec3 VertexColor;
+in vec4 VertexColor;
 out vec4 FragColor;
 
 void main() {
     vec4 color = texture(Texture, TexCoord);
-    FragColor = color * vec4(VertexColor, 1.0);
+    FragColor = color * VertexColor;
     // FragColor = vec4(1.0, 0.0, 1.0, 1.0);
 }
 """
@@ -144,111 +1212,279 @@ def create_texture(imagepath):
     glBindTexture(GL_TEXTURE_2D, texture)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-    image = pyglet.image.load(imagepath)
-    image_data = image.get_image_data().get_data('RGBA', image.width * 4)
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, image.width, image.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, image_data)
+    texture_data = toy.assets.load_texture_data(imagepath)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(texture_data.levels) - 1)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    for level, pixels in enumerate(texture_data.levels):
+        height, width = pixels.shape[:2]
+        glTexImage2D(GL_TEXTURE_2D, level, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                     pixels.ctypes.data)
     return texture
 
+
+GLYPH_WIDTH = 22
+GLYPH_HEIGHT = 41
+GLYPH_COLUMNS = 16
+GLYPH_FIRST = ord(' ')
+GLYPH_COUNT = 96
+GLYPH_FALLBACK = ord('?') - GLYPH_FIRST
+ATLAS_SIZE = 512
+
+# atlas coordinates are computed from the glyph index in the vertex shader
+GLYPH_INSTANCE_DTYPE = numpy.dtype([('origin', numpy.float32, 2), ('scale', numpy.float32),
+                                    ('glyph', numpy.uint32), ('color', numpy.uint8, 4)])
+WORLD_GLYPH_INSTANCE_DTYPE = numpy.dtype([('anchor', numpy.float32, 3), ('origin', numpy.float32, 2),
+                                          ('scale', numpy.float32), ('glyph', numpy.uint32),
+                                          ('color', numpy.uint8, 4)])
+TEXT_LAYOUT_DTYPE = numpy.dtype([('origin', numpy.float32, 2), ('glyph', numpy.uint32)])
+
+# (location, field, size, type, normalized)
+GLYPH_ATTRIBUTES = ((0, 'origin', 2, GL_FLOAT, GL_FALSE),
+                    (1, 'scale', 1, GL_FLOAT, GL_FALSE),
+                    (2, 'glyph', 1, GL_UNSIGNED_INT, GL_FALSE),
+                    (3, 'color', 4, GL_UNSIGNED_BYTE, GL_TRUE))
+WORLD_GLYPH_ATTRIBUTES = ((0, 'anchor', 3, GL_FLOAT, GL_FALSE),
+                          (1, 'origin', 2, GL_FLOAT, GL_FALSE),
+                          (2, 'scale', 1, GL_FLOAT, GL_FALSE),
+                          (3, 'glyph', 1, GL_UNSIGNED_INT, GL_FALSE),
+                          (4, 'color', 4, GL_UNSIGNED_BYTE, GL_TRUE))
+
+
+def set_instance_attributes(dtype, attributes, offset):
+    stride = dtype.itemsize
+    for location, name, size, gl_type, normalized in attributes:
+        field_offset = offset + dtype.fields[name][1]
+        if gl_type == GL_UNSIGNED_INT:
+            glVertexAttribIPointer(location, size, gl_type, stride, field_offset)
+        else:
+            glVertexAttribPointer(location, size, gl_type, normalized, stride, field_offset)
+
+def enable_instance_attributes(attributes):
+    for location, _, _, _, _ in attributes:
+        glEnableVertexAttribArray(location)
+        glVertexAttribDivisor(location, 1)
+
+
+def glyph_index(char):
+    index = ord(char) - GLYPH_FIRST
+    if 0 <= index < GLYPH_COUNT:
+        return index
+    return GLYPH_FALLBACK
+
+def build_text_layout(text, scale):
+    # glyph origins relative to the label origin
+    real_delta_x = GLYPH_WIDTH * scale
+    real_delta_y = GLYPH_HEIGHT * scale
+    glyphs = []
+    current_x = 0.0
+    current_y = 0.0
+    for char in text:
+        if char == '\n':
+            current_x = 0.0
+            current_y -= real_delta_y
+            continue
+        # blank cells only advance, they get no instance
+        if char != ' ':
+            glyphs.append(((current_x, current_y), glyph_index(char)))
+        current_x += real_delta_x
+    return numpy.array(glyphs, dtype=TEXT_LAYOUT_DTYPE)
+
+
+class TextFrameStorage(object):
+    def __init__(self, batch):
+        self.textinfos = []
+        self.world_textinfos = []
+        self.camera = batch.camera
+
+
 class TextBatch(object):
-    VERTEX_SIZE = 7
-    VERTEX_SIZE_BYTES = VERTEX_SIZE * SIZEOF_FLOAT
-    BATCH_SIZE = 3 * VERTEX_SIZE * 1000
-    BATCH_SIZE_FLOATS = VERTEX_SIZE * BATCH_SIZE
-    BATCH_SIZE_BYTES = BATCH_SIZE_FLOATS * SIZEOF_FLOAT
-    def __init__(self, app, camera):
+    GLYPH_WIDTH = GLYPH_WIDTH
+    GLYPH_HEIGHT = GLYPH_HEIGHT
+    LAYOUT_CACHE_SIZE = 4096
+    BATCH_SIZE = 4096
+    STORAGE_ATTRIBUTES = ('textinfos', 'world_textinfos')
+    def __init__(self, app, camera, *, streaming=False, culling=True, gpu_timing=False, pipelined=False):
         self.app = app
         self.camera = camera
+        self.culling = culling
         self.shader = toy.shader.Shader(texture_vertex_shader_source, texture_fragment_shader_source)
         self.texture = create_texture('ascii.png')
+        self.world_shader = toy.shader.Shader(world_text_vertex_shader_source, texture_fragment_shader_source)
         self.textinfos = []
+        self.world_textinfos = []
+        self.color_value = PackedColorCache()
+        self.glyphs = VertexArena(GLYPH_INSTANCE_DTYPE)
+        self.world_glyphs = VertexArena(WORLD_GLYPH_INSTANCE_DTYPE)
+        self._layouts = {}
+        self.label_count = 0
+        self.world_label_count = 0
+        self.tick_marks = None
+        self.layout_hits = 0
+        self.layout_misses = 0
+        self.gpu_timer = toy.profiler.create_gpu_timer(gpu_timing)
+        self.front = TextFrameStorage(self) if pipelined else None
 
         self.vao = GLuint()
         glGenVertexArrays(1, byref(self.vao))
         glBindVertexArray(self.vao)
-        self.vbo = GLuint()
-        glGenBuffers(1, byref(self.vbo))
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.BATCH_SIZE_BYTES, None, GL_STREAM_DRAW)
-        stride = self.VERTEX_SIZE_BYTES
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, stride, None)
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, stride, 2 * SIZEOF_FLOAT)
-        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, stride, 4 * SIZEOF_FLOAT)
-        glEnableVertexAttribArray(0)
-        glEnableVertexAttribArray(1)
-        glEnableVertexAttribArray(2)
+        self.stream = toy.streaming.create_stream(
+            GLYPH_INSTANCE_DTYPE.itemsize, self.BATCH_SIZE, self._setup_attributes, streaming)
+
+        self.world_vao = GLuint()
+        glGenVertexArrays(1, byref(self.world_vao))
+        glBindVertexArray(self.world_vao)
+        self.world_stream = toy.streaming.create_stream(
+            WORLD_GLYPH_INSTANCE_DTYPE.itemsize, self.BATCH_SIZE, self._setup_world_attributes, streaming)
+
+    def _setup_attributes(self):
+        set_instance_attributes(GLYPH_INSTANCE_DTYPE, GLYPH_ATTRIBUTES, 0)
+        enable_instance_attributes(GLYPH_ATTRIBUTES)
+
+    def _setup_world_attributes(self):
+        set_instance_attributes(WORLD_GLYPH_INSTANCE_DTYPE, WORLD_GLYPH_ATTRIBUTES, 0)
+        enable_instance_attributes(WORLD_GLYPH_ATTRIBUTES)
+
+    def is_text_visible(self, position, text, scale):
+        # conservative screen rectangle, lines after a newline go downwards
+        width, height = self.camera.get_screen_size()
+        x = position.x
+        y = position.y
+        if x > width or y + self.GLYPH_HEIGHT * scale < 0.0:
+            return False
+        if x + len(text) * self.GLYPH_WIDTH * scale < 0.0:
+            return False
+        if y - text.count('\n') * self.GLYPH_HEIGHT * scale > height:
+            return False
+        return True
 
     def draw_text(self, position, text, color=toy.coloring.RED, scale=1.0):
+        if self.culling and not self.is_text_visible(position, text, scale):
+            return
         info = (position, text, scale, color)
         self.textinfos.append(info)
 
-    def _draw_vertices(self, vertices, primitive_mode):
-        address, length_floats = vertices.buffer_info()
-        batch_count, last_floats = divmod(length_floats, self.BATCH_SIZE_FLOATS)
-        for i in range(batch_count):
-            sub_address = address + i * self.BATCH_SIZE_BYTES
-            glBufferSubData(GL_ARRAY_BUFFER, 0, self.BATCH_SIZE_BYTES, sub_address)
-            glDrawArrays(primitive_mode, 0, self.BATCH_SIZE)
-        if last_floats > 0:
-            sub_address = address + batch_count * self.BATCH_SIZE_BYTES
-            glBufferSubData(GL_ARRAY_BUFFER, 0, last_floats * SIZEOF_FLOAT, sub_address)
-            glDrawArrays(primitive_mode, 0, last_floats // self.VERTEX_SIZE)
-
-    def _draw_texts(self):
-        vertices_array = array.array('f')
-        for textinfo in self.textinfos:
-            vertices = self._build_text(textinfo)
-            vertices_array.extend(vertices)
-        self._draw_vertices(vertices_array, GL_TRIANGLES)
-
-    def _build_text(self, textinfo):
-        position, text, scale, color = textinfo
-        offset = ord(' ')
-        start_x = position.x
-        start_y = position.y
-        current_x = start_x
-        current_y = start_y
-        delta_x = 22
-        delta_y = 41
-        real_delta_x = delta_x * scale
-        real_delta_y = delta_y * scale
-        ncol = 16
-        width = 512
-        delta_u = delta_x / width
-        delta_v = delta_y / width
-        vertices = []
-        for char in text:
-            if char == '\n':
-                current_x = start_x
-                current_y -= real_delta_y
+    def draw_world_text(self, position, text, color=toy.coloring.RED, scale=1.0):
+        # position is a world space anchor, projected in the vertex shader
+        info = (position, text, scale, color)
+        self.world_textinfos.append(info)
+
+    def begin_tick(self):
+        self.tick_marks = None
+        self.textinfos.clear()
+        self.world_textinfos.clear()
+
+    def end_tick(self):
+        self.tick_marks = (len(self.textinfos), len(self.world_textinfos))
+
+    def swap_storage(self):
+        front = self.front
+        for name in self.STORAGE_ATTRIBUTES:
+            recorded = getattr(self, name)
+            setattr(self, name, getattr(front, name))
+            setattr(front, name, recorded)
+        front.camera = copy.copy(self.camera)
+
+    def get_storage(self):
+        return self if self.front is None else self.front
+
+    def get_layout(self, text, scale):
+        key = (text, scale)
+        try:
+            layout = self._layouts[key]
+            self.layout_hits += 1
+        except KeyError:
+            self.layout_misses += 1
+            if len(self._layouts) >= self.LAYOUT_CACHE_SIZE:
+                self._layouts.clear()
+            layout = build_text_layout(text, scale)
+            self._layouts[key] = layout
+        return layout
+
+    def _draw_glyphs(self, stream, glyphs, attributes):
+        stride = glyphs.dtype.itemsize
+        def draw_instanced(first, count):
+            set_instance_attributes(glyphs.dtype, attributes, first * stride)
+            glDrawArraysInstanced(GL_TRIANGLES, 0, 6, count)
+        stream.begin_frame(len(glyphs))
+        if len(glyphs):
+            stream.draw(glyphs.ctypes.data, len(glyphs), draw_instanced)
+        stream.end_frame()
+
+    def _draw_texts(self, storage):
+        arena = self.glyphs
+        for position, text, scale, color in storage.textinfos:
+            layout = self.get_layout(text, scale)
+            count = len(layout)
+            if not count:
                 continue
-            char_index = ord(char) - offset  # build a lookup table would be better
-            char_row, char_col = divmod(char_index, ncol)
-            u_ac = char_col * delta_u
-            u_bd = (char_col + 1) * delta_u
-            v_ab = 1.0 - (char_row + 1) * delta_v
-            v_cd = 1.0 - char_row * delta_v
-            x_ac = current_x
-            x_bd = current_x + real_delta_x
-            y_ab = current_y
-            y_cd = current_y + real_delta_y
-            point_a = (x_ac, y_ab, u_ac, v_ab, color.x, color.y, color.z)
-            point_b = (x_bd, y_ab, u_bd, v_ab, color.x, color.y, color.z)
-            point_c = (x_ac, y_cd, u_ac, v_cd, color.x, color.y, color.z)
-            point_d = (x_bd, y_cd, u_bd, v_cd, color.x, color.y, color.z)
-            quad_vertices = [point_a, point_b, point_c, point_c, point_b, point_d]
-            for vertex in quad_vertices:
-                vertices.extend(vertex)
-            current_x += real_delta_x
-        return vertices
+            start = arena.allocate(count)
+            glyphs = arena.vertices[start:start + count]
+            numpy.add(layout['origin'], (position.x, position.y), out=glyphs['origin'])
+            glyphs['glyph'] = layout['glyph']
+            glyphs['scale'] = scale
+            glyphs['color'] = self.color_value(color)
+        with self.gpu_timer.scope('glyphs'):
+            self._draw_glyphs(self.stream, arena.view(), GLYPH_ATTRIBUTES)
+        arena.reset()
+        self.label_count = len(storage.textinfos)
+
+    def _draw_world_texts(self, storage):
+        arena = self.world_glyphs
+        for position, text, scale, color in storage.world_textinfos:
+            layout = self.get_layout(text, scale)
+            count = len(layout)
+            if not count:
+                continue
+            start = arena.allocate(count)
+            glyphs = arena.vertices[start:start + count]
+            glyphs['anchor'] = (position.x, position.y, position.z)
+            glyphs['origin'] = layout['origin']
+            glyphs['glyph'] = layout['glyph']
+            glyphs['scale'] = scale
+            glyphs['color'] = self.color_value(color)
+        with self.gpu_timer.scope('world_glyphs'):
+            self._draw_glyphs(self.world_stream, arena.view(), WORLD_GLYPH_ATTRIBUTES)
+        arena.reset()
+        self.world_label_count = len(storage.world_textinfos)
+
+    def get_stats(self):
+        return {
+            'glyphs': self.glyphs.get_stats(),
+            'world_glyphs': self.world_glyphs.get_stats(),
+            'labels': self.label_count,
+            'world_labels': self.world_label_count,
+            'layout_hits': self.layout_hits,
+            'layout_misses': self.layout_misses,
+            'draw_calls': self.stream.draw_calls + self.world_stream.draw_calls,
+            'upload_bytes': self.stream.upload_bytes + self.world_stream.upload_bytes,
+            'gpu_times': self.gpu_timer.times,
+        }
 
     def draw(self):
+        storage = self.get_storage()
+        with self.gpu_timer.scope('draw'):
+            self._draw(storage)
+        self.gpu_timer.end_frame()
+
+    def _draw(self, storage):
         self.shader.use()
         glBindVertexArray(self.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        vp_matrix = self.camera.get_screen_view_projection()
+        self.stream.bind()
+        camera = storage.camera
+        vp_matrix = camera.get_screen_view_projection()
         self.shader.set_uniform_matrix(b'ModelViewProjection', vp_matrix)
         glBindTexture(GL_TEXTURE_2D, self.texture)
-        self._draw_texts()
-        self.textinfos.clear()
+        self._draw_texts(storage)
+        text_mark, world_text_mark = self.tick_marks or (0, 0)
+        del storage.textinfos[text_mark:]
+
+        if storage.world_textinfos:
+            self.world_shader.use()
+            glBindVertexArray(self.world_vao)
+            self.world_stream.bind()
+            self.world_shader.set_uniform_matrix(b'ViewProjection', camera.get_view_projection())
+            self.world_shader.set_uniform_matrix(b'ModelViewProjection', vp_matrix)
+            self._draw_world_texts(storage)
+            del storage.world_textinfos[world_text_mark:]
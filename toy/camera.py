@@ -4,6 +4,7 @@ Camera
 
 import math
 
+import numpy
 from vmath import Vector, Matrix, Quaternion
 import pyglet
 from pyglet.window import key
@@ -13,10 +14,63 @@ def transform_point(matrix, v):
     return matrix.transform(v)
 
 
+def matrix_rows(matrix):
+    m = matrix
+    return ((m.a, m.b, m.c, m.d), (m.e, m.f, m.g, m.h), (m.i, m.j, m.k, m.l), (m.m, m.n, m.o, m.p))
+
+
+class Frustum(object):
+    def __init__(self, vp_matrix):
+        # Gribb-Hartmann plane extraction, planes point inwards
+        row0, row1, row2, row3 = matrix_rows(vp_matrix)
+        planes = []
+        for row, sign in ((row0, 1.0), (row0, -1.0), (row1, 1.0), (row1, -1.0), (row2, 1.0), (row2, -1.0)):
+            a, b, c, d = (w + sign * r for w, r in zip(row3, row))
+            length = math.sqrt(a * a + b * b + c * c)
+            if length > 0.0:
+                planes.append((a / length, b / length, c / length, d / length))
+        self.planes = planes
+        self.plane_array = numpy.array(planes, dtype=numpy.float32).reshape(-1, 4)
+
+    def intersects_sphere(self, center, radius):
+        x = center.x
+        y = center.y
+        z = center.z
+        for a, b, c, d in self.planes:
+            if a * x + b * y + c * z + d < -radius:
+                return False
+        return True
+
+    def intersects_aabb(self, low, high):
+        for a, b, c, d in self.planes:
+            x = high.x if a > 0.0 else low.x
+            y = high.y if b > 0.0 else low.y
+            z = high.z if c > 0.0 else low.z
+            if a * x + b * y + c * z + d < 0.0:
+                return False
+        return True
+
+    def intersects_sphere_array(self, centers, radii):
+        # mask of the Nx3 centers with N radii that touch the frustum
+        planes = self.plane_array
+        distances = numpy.dot(centers, planes[:, :3].T) + planes[:, 3]
+        return (distances >= -numpy.reshape(radii, (-1, 1))).all(axis=1)
+
+    def intersects_aabb_array(self, lows, highs):
+        # mask of the Nx3 boxes that touch the frustum, like intersects_aabb
+        planes = self.plane_array
+        normals = planes[:, :3]
+        corners = numpy.where(normals > 0.0, highs[:, numpy.newaxis], lows[:, numpy.newaxis])
+        distances = (corners * normals).sum(axis=2) + planes[:, 3]
+        return (distances >= 0.0).all(axis=1)
+
+
 class Camera(object):
     MODE_PERSPECTIVE = 1
     MODE_ORTHO = 2
+    SCREEN_HEIGHT = 600
     def __init__(self):
+        self._invalidate()
         self.width = 512
         self.height = 512
         self.aspect = 1.0
@@ -41,9 +95,19 @@ class Camera(object):
         self.aspect = width / height
         self.set_perspective(self.perspective_fov)
         self.set_ortho(self.ortho_extent)
+        self._invalidate()
 
     def set_mode(self, mode):
         self.mode = mode
+        self._invalidate()
+
+    def _invalidate(self):
+        # derived matrices are rebuilt on first use
+        self._frustum = None
+        self._view_projection = None
+        self._view_projection_array = None
+        self._inverse_view_projection = None
+        self._screen_view_projection = None
 
     def get_look_at(self):
         return (self.view_eye.copy(), self.view_at.copy(), self.view_up.copy())
@@ -53,10 +117,13 @@ class Camera(object):
         self.view_at = at
         self.view_up = up
         self.view = Matrix.from_look_at(eye, at, up)
+        self._invalidate()
 
     def set_perspective(self, fov):
         self.perspective_fov = fov
+        self._tan_half_fov = math.tan(fov / 2.0)
         self.projection_perspective = Matrix.from_perspective(fov, self.aspect, 0.1, 1000.0)
+        self._invalidate()
 
     def set_ortho(self, extent):
         design_height = 600
@@ -68,6 +135,7 @@ class Camera(object):
         near = 0.0
         far = 1000.0
         self.projection_ortho = Matrix.from_ortho(left, right, bottom, top, near, far)
+        self._invalidate()
 
     def get_projection(self):
         _mode = self.mode
@@ -79,21 +147,83 @@ class Camera(object):
             return self.projection_perspective
 
     def get_view_projection(self):
-        return self.get_projection() * self.view
+        if self._view_projection is None:
+            self._view_projection = self.get_projection() * self.view
+        return self._view_projection
+
+    def get_view_projection_array(self):
+        if self._view_projection_array is None:
+            self._view_projection_array = numpy.array(matrix_rows(self.get_view_projection()))
+        return self._view_projection_array
+
+    def get_inverse_view_projection(self):
+        if self._inverse_view_projection is None:
+            self._inverse_view_projection = numpy.linalg.inv(self.get_view_projection_array())
+        return self._inverse_view_projection
+
+    def get_frustum(self):
+        if self._frustum is None:
+            self._frustum = Frustum(self.get_view_projection())
+        return self._frustum
+
+    def get_projected_radius(self, center, radius):
+        # radius in window pixels of a sphere
+        half_height = self.height * 0.5
+        if self.mode == self.MODE_ORTHO:
+            return radius / self.ortho_extent * half_height
+        distance = (center - self.view_eye).length()
+        if distance <= radius:
+            return float(self.height)
+        return radius / (distance * self._tan_half_fov) * half_height
+
+    def get_screen_size(self):
+        height = self.SCREEN_HEIGHT
+        return (height * self.aspect, height)
 
     def get_screen_view_projection(self):
-        design_height = 600
-        height = design_height
-        width = design_height * self.aspect
-        return Matrix.from_ortho(0.0, width, 0.0, height, -1.0, 1.0)
+        if self._screen_view_projection is None:
+            width, height = self.get_screen_size()
+            self._screen_view_projection = Matrix.from_ortho(0.0, width, 0.0, height, -1.0, 1.0)
+        return self._screen_view_projection
 
     def world_to_screen(self, position):
         vp_matrix = self.get_view_projection()
         clip_position = vp_matrix.project_point(position)
-        height = 600
-        width = height * self.aspect
+        width, height = self.get_screen_size()
         return Vector((clip_position.x + 1.0) * width / 2.0, (clip_position.y + 1.0) * height / 2.0, 1.0 - clip_position.z)
 
+    def world_to_screen_array(self, positions):
+        # Nx3 world positions to Nx3 screen positions, same layout as world_to_screen
+        positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+        vp = self.get_view_projection_array()
+        clip = numpy.dot(positions, vp[:, :3].T) + vp[:, 3]
+        ndc = clip[:, :3] / clip[:, 3:]
+        width, height = self.get_screen_size()
+        screen = numpy.empty_like(ndc)
+        screen[:, 0] = (ndc[:, 0] + 1.0) * width / 2.0
+        screen[:, 1] = (ndc[:, 1] + 1.0) * height / 2.0
+        screen[:, 2] = 1.0 - ndc[:, 2]
+        return screen
+
+    def unproject_array(self, ndc):
+        inverse_vp = self.get_inverse_view_projection()
+        world = numpy.dot(ndc, inverse_vp[:, :3].T) + inverse_vp[:, 3]
+        return world[:, :3] / world[:, 3:]
+
+    def screen_to_world_array(self, positions):
+        # inverse of world_to_screen_array, z is the screen depth it returns
+        positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+        width, height = self.get_screen_size()
+        ndc = numpy.empty_like(positions)
+        ndc[:, 0] = positions[:, 0] * 2.0 / width - 1.0
+        ndc[:, 1] = positions[:, 1] * 2.0 / height - 1.0
+        ndc[:, 2] = 1.0 - positions[:, 2]
+        return self.unproject_array(ndc)
+
+    def screen_to_world(self, position):
+        x, y, z = self.screen_to_world_array((position.x, position.y, position.z))[0].tolist()
+        return Vector(x, y, z)
+
     def top_down_screen_to_world(self, position):
         screen_x = position.x
         screen_y = self.height - position.y
@@ -107,7 +237,14 @@ class Camera(object):
         return Vector(world_x, 0.0, world_z)
 
     def screen_to_ray(self, position):
-        pass
+        # window pixels with the origin at the bottom left, like mouse events,
+        # returns the ray origin on the near plane and its unit direction
+        ndc_x = position.x * 2.0 / self.width - 1.0
+        ndc_y = position.y * 2.0 / self.height - 1.0
+        near, far = self.unproject_array(((ndc_x, ndc_y, -1.0), (ndc_x, ndc_y, 1.0))).tolist()
+        origin = Vector(near[0], near[1], near[2])
+        direction = Vector(far[0] - near[0], far[1] - near[1], far[2] - near[2]).normalized()
+        return origin, direction
 
 class FreeviewCameraController(object):
     def __init__(self, app, camera):
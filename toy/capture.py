@@ -0,0 +1,216 @@
+"""
+Capture.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+from vmath import Vector
+
+import toy.coloring
+
+
+CAPTURE_MAGIC = b'TOYC'
+CAPTURE_VERSION = 2
+FLAG_COMPACT = 1
+FLAG_TRANSFORMS = 2
+FLAG_PICKING = 4
+FILE_HEADER_DTYPE = numpy.dtype([('magic', 'S4'), ('version', '<u4'), ('flags', '<u4'),
+                                 ('vertex_size', '<u4'), ('instance_size', '<u4')])
+# every chunk is a header and size bytes of payload, count is chunk specific
+CHUNK_HEADER_DTYPE = numpy.dtype([('tag', '<u4'), ('count', '<u4'), ('size', '<u8')])
+CAMERA_DTYPE = numpy.dtype([('eye', '<f8', 3), ('at', '<f8', 3), ('up', '<f8', 3), ('mode', '<u4'),
+                            ('fov', '<f8'), ('extent', '<f8'), ('width', '<u4'), ('height', '<u4')])
+GRID_DTYPE = numpy.dtype([('step', '<f4'), ('color', '<f4', 4), ('levels', '<f4'), ('fade_distance', '<f4')])
+# utf-8 texts follow the records, length is in bytes
+TEXT_DTYPE = numpy.dtype([('position', '<f4', 3), ('scale', '<f4'), ('color', '<f4', 4), ('length', '<u4')])
+
+TAG_FRAME = 1
+TAG_CAMERA = 2
+TAG_POINTS = 3
+TAG_LINES = 4
+TAG_MESH_VERTICES = 5
+TAG_MESH_INDICES = 6
+TAG_TEMPLATE_POSITIONS = 7
+TAG_TEMPLATE_INDICES = 8
+TAG_INSTANCES = 9
+TAG_GRIDS = 10
+TAG_TRANSFORMS = 11
+TAG_TEXTS = 12
+TAG_WORLD_TEXTS = 13
+TAG_LAYERS = 14
+TAG_LAYER_POINTS = 15
+TAG_LAYER_LINES = 16
+TAG_LAYER_MESH_VERTICES = 17
+TAG_LAYER_MESH_INDICES = 18
+
+GEOMETRY_ATTRIBUTES = ('point_vertices', 'line_vertices', 'mesh_vertices', 'mesh_indices')
+GEOMETRY_TAGS = (TAG_POINTS, TAG_LINES, TAG_MESH_VERTICES, TAG_MESH_INDICES)
+LAYER_GEOMETRY_TAGS = (TAG_LAYER_POINTS, TAG_LAYER_LINES, TAG_LAYER_MESH_VERTICES, TAG_LAYER_MESH_INDICES)
+
+
+def get_flags(batch):
+    flags = 0
+    if batch.compact:
+        flags |= FLAG_COMPACT
+    if batch.transforms:
+        flags |= FLAG_TRANSFORMS
+    if batch.picking:
+        flags |= FLAG_PICKING
+    return flags
+
+
+def pack_texts(textinfos):
+    records = numpy.empty(len(textinfos), TEXT_DTYPE)
+    encoded = []
+    for i, (position, text, scale, color) in enumerate(textinfos):
+        data = text.encode('utf-8')
+        records[i] = ((position.x, position.y, position.z), scale,
+                      (color.x, color.y, color.z, getattr(color, 'w', 1.0)), len(data))
+        encoded.append(data)
+    return records.tobytes() + b''.join(encoded)
+
+def unpack_texts(data, count):
+    records = numpy.frombuffer(data, TEXT_DTYPE, count)
+    offset = records.nbytes
+    texts = []
+    for record in records:
+        length = int(record['length'])
+        text = bytes(data[offset:offset + length]).decode('utf-8')
+        offset += length
+        position = Vector(*(float(v) for v in record['position']))
+        color = toy.coloring.Color(*(float(v) for v in record['color']))
+        texts.append((position, text, float(record['scale']), color))
+    return texts
+
+
+class FrameWriter(object):
+    # everything PrimitiveBatch and TextBatch draw in a frame, written just
+    # before they draw it. instance templates are written once, layers when
+    # they have geometry waiting for upload
+    def __init__(self, path, batch):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.frame_count = 0
+        self.template_ids = {}
+        self.layer_ids = {}
+        header = numpy.zeros(1, FILE_HEADER_DTYPE)
+        header['magic'] = CAPTURE_MAGIC
+        header['version'] = CAPTURE_VERSION
+        header['flags'] = get_flags(batch)
+        header['vertex_size'] = batch.vertex_dtype.itemsize
+        header['instance_size'] = batch.instance_dtype.itemsize
+        self.file.write(header.tobytes())
+
+    def _write_chunk(self, tag, count, data):
+        header = numpy.zeros(1, CHUNK_HEADER_DTYPE)
+        header['tag'] = tag
+        header['count'] = count
+        header['size'] = len(data)
+        self.file.write(header.tobytes())
+        self.file.write(data)
+
+    def _write_array(self, tag, count, array):
+        self._write_chunk(tag, count, numpy.ascontiguousarray(array).tobytes())
+
+    def _write_camera(self, camera):
+        record = numpy.zeros(1, CAMERA_DTYPE)
+        eye, at, up = camera.view_eye, camera.view_at, camera.view_up
+        record[0] = ((eye.x, eye.y, eye.z), (at.x, at.y, at.z), (up.x, up.y, up.z), camera.mode,
+                     camera.perspective_fov, camera.ortho_extent, camera.width, camera.height)
+        self._write_array(TAG_CAMERA, 1, record)
+
+    def _write_layers(self, storage):
+        visible = []
+        for layer in storage.layers:
+            layer_id = self.layer_ids.get(layer)
+            if layer_id is None:
+                layer_id = len(self.layer_ids)
+                self.layer_ids[layer] = layer_id
+            geometry = layer.get_pending_geometry()
+            if geometry is not None:
+                for tag, arena in zip(LAYER_GEOMETRY_TAGS, geometry):
+                    self._write_array(tag, layer_id, arena.view())
+            if layer.visible:
+                visible.append(layer_id)
+        self._write_array(TAG_LAYERS, len(visible), numpy.array(visible, '<u4'))
+
+    def _write_instances(self, storage):
+        for line_mesh, arena in storage.instances.items():
+            if not arena:
+                continue
+            template_id = self.template_ids.get(line_mesh)
+            if template_id is None:
+                template_id = len(self.template_ids)
+                self.template_ids[line_mesh] = template_id
+                self._write_array(TAG_TEMPLATE_POSITIONS, template_id, line_mesh.positions.astype('<f4'))
+                self._write_array(TAG_TEMPLATE_INDICES, template_id, line_mesh.indices.astype('<u4'))
+            self._write_array(TAG_INSTANCES, template_id, arena.view())
+
+    def write_frame(self, batch, text_batch):
+        storage = batch.get_storage()
+        text_storage = text_batch.get_storage()
+        self._write_chunk(TAG_FRAME, self.frame_count, b'')
+        self._write_camera(storage.camera)
+        for tag, name in zip(GEOMETRY_TAGS, GEOMETRY_ATTRIBUTES):
+            arena = getattr(storage, name)
+            if arena:
+                self._write_array(tag, 0, arena.view())
+        self._write_instances(storage)
+        if storage.grids:
+            grids = numpy.array([(step, (color.x, color.y, color.z, getattr(color, 'w', 1.0)), levels, fade_distance)
+                                 for step, color, levels, fade_distance in storage.grids], GRID_DTYPE)
+            self._write_array(TAG_GRIDS, len(grids), grids)
+        if batch.transforms:
+            self._write_array(TAG_TRANSFORMS, 0, storage.transform_matrices.view())
+        if text_storage.textinfos:
+            self._write_chunk(TAG_TEXTS, len(text_storage.textinfos), pack_texts(text_storage.textinfos))
+        if text_storage.world_textinfos:
+            self._write_chunk(TAG_WORLD_TEXTS, len(text_storage.world_textinfos),
+                              pack_texts(text_storage.world_textinfos))
+        self._write_layers(storage)
+        self.frame_count += 1
+
+    def close(self):
+        self.file.close()
+        logger.info('Captured %d frames to %s', self.frame_count, self.path)
+
+
+class FrameReader(object):
+    # the whole file is mapped, frames are lists of (tag, count, payload)
+    def __init__(self, path):
+        self.path = path
+        blob = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        header_size = FILE_HEADER_DTYPE.itemsize
+        if len(blob) < header_size:
+            raise ValueError('{} is not a capture'.format(path))
+        header = blob[:header_size].view(FILE_HEADER_DTYPE)[0]
+        if header['magic'] != CAPTURE_MAGIC or header['version'] != CAPTURE_VERSION:
+            raise ValueError('{} is not a version {} capture'.format(path, CAPTURE_VERSION))
+        self.flags = int(header['flags'])
+        self.vertex_size = int(header['vertex_size'])
+        self.instance_size = int(header['instance_size'])
+        self.frames = []
+        offset = header_size
+        chunk_size = CHUNK_HEADER_DTYPE.itemsize
+        while offset + chunk_size <= len(blob):
+            chunk = blob[offset:offset + chunk_size].view(CHUNK_HEADER_DTYPE)[0]
+            offset += chunk_size
+            size = int(chunk['size'])
+            if offset + size > len(blob):
+                logger.warning('Capture %s is truncated after %d frames', path, len(self.frames))
+                break
+            tag = int(chunk['tag'])
+            if tag == TAG_FRAME:
+                self.frames.append([])
+            elif self.frames:
+                self.frames[-1].append((tag, int(chunk['count']), blob[offset:offset + size]))
+            offset += size
+
+    def get_app_options(self):
+        return {
+            'compact': bool(self.flags & FLAG_COMPACT),
+            'transforms': bool(self.flags & FLAG_TRANSFORMS),
+            'picking': bool(self.flags & FLAG_PICKING),
+        }
@@ -21,3 +21,21 @@ YELLOW = Vector(1.0, 1.0, 0.0)
 MAGENTA = Vector(1.0, 0.0, 1.0)
 CYAN = Vector(0.0, 1.0, 1.0)
 
+
+class Color(object):
+    __slots__ = ('x', 'y', 'z', 'w')
+
+    def __init__(self, x, y, z, w=1.0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.w = w
+
+    def __repr__(self):
+        return 'Color({}, {}, {}, {})'.format(self.x, self.y, self.z, self.w)
+
+
+def with_alpha(color, alpha):
+    # alpha is only visible with PrimitiveBatch(compact=True)
+    return Color(color.x, color.y, color.z, alpha)
+
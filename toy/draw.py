@@ -4,23 +4,65 @@ Draw.
 
 import math
 
-from vmath import Vector, Matrix, Quaternion, Transform
+import numpy
+from vmath import Vector, Transform
 
 from toy import coloring
+from toy import mesh
 
 
-CIRCLE_SEGMENTS = 8
-CIRCLE_STEP = math.pi * 2.0 / CIRCLE_SEGMENTS
-CIRCLE_POINTS = [Vector(math.cos(i*CIRCLE_STEP), 0.0, math.sin(i*CIRCLE_STEP)) for i in range(CIRCLE_SEGMENTS)]
+CIRCLE_SEGMENTS = mesh.CIRCLE_SEGMENTS
+AXIS_HEAD_RADIUS = 0.1
+AXIS_HEAD_HEIGHT = 0.3
+AXIS_HEAD_ROTATIONS = (
+    ((0.0, 1.0, 0.0), (-1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+    ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)),
+    ((1.0, 0.0, 0.0), (0.0, 0.0, -1.0), (0.0, 1.0, 0.0)),
+)
 
-CUBE_VERTICES = [Vector(-0.5, -0.5, -0.5), Vector(-0.5, -0.5, 0.5), Vector(0.5, -0.5, 0.5), Vector(0.5, -0.5, -0.5),
-                 Vector(-0.5, 0.5, -0.5), Vector(-0.5, 0.5, 0.5), Vector(0.5, 0.5, 0.5), Vector(0.5, 0.5, -0.5)]
+def build_axis_head_affine(rotation):
+    # unit cone placed at the tip of an axis of length 1
+    rotation = numpy.array(rotation, dtype=numpy.float32)
+    affine = numpy.empty((3, 4), dtype=numpy.float32)
+    affine[:, :3] = rotation * (AXIS_HEAD_RADIUS, AXIS_HEAD_HEIGHT, AXIS_HEAD_RADIUS)
+    affine[:, 3] = rotation[:, 1]
+    return affine
+
+# x, y and z heads in the local space of the axis matrix
+AXIS_HEAD_AFFINES = [build_axis_head_affine(rotation) for rotation in AXIS_HEAD_ROTATIONS]
+
+
+def matrix_to_affine(matrix):
+    m = matrix
+    return numpy.array(((m.a, m.b, m.c, m.d), (m.e, m.f, m.g, m.h), (m.i, m.j, m.k, m.l)), dtype=numpy.float32)
+
+def scale_translate_affine(position, scale_x, scale_y, scale_z):
+    return numpy.array(((scale_x, 0.0, 0.0, position.x),
+                        (0.0, scale_y, 0.0, position.y),
+                        (0.0, 0.0, scale_z, position.z)), dtype=numpy.float32)
+
+def compose_affine(affine0, affine1):
+    result = numpy.dot(affine0[:, :3], affine1)
+    result[:, 3] += affine0[:, 3]
+    return result
+
+
+def transform_positions(affine, positions):
+    positions = numpy.asarray(positions, dtype=numpy.float32)
+    return numpy.dot(positions.reshape(-1, 3), affine[:, :3].T) + affine[:, 3]
 
 
 def matrix_position(matrix):
     return Vector(matrix.d, matrix.h, matrix.l)
 
 
+def matrix_max_scale(matrix):
+    m = matrix
+    return math.sqrt(max(m.a * m.a + m.e * m.e + m.i * m.i,
+                         m.b * m.b + m.f * m.f + m.j * m.j,
+                         m.c * m.c + m.g * m.g + m.k * m.k))
+
+
 class Draw(object):
     def __init__(self, batch):
         self.batch = batch
@@ -31,13 +73,25 @@ class Draw(object):
     def draw_line(self, position0, position1, color=coloring.RED):
         self.batch.draw_line(position0, position1, color)
 
+    def draw_line_mesh(self, points, indices, color=coloring.RED):
+        self.batch.draw_line_mesh(points, indices, color)
+
+    def draw_points(self, positions, colors=coloring.RED):
+        self.batch.draw_points(positions, colors)
+
+    def draw_lines(self, positions0, positions1, colors=coloring.RED):
+        self.batch.draw_lines(positions0, positions1, colors)
+
+    def draw_line_list(self, segments, colors=coloring.RED):
+        self.batch.draw_line_list(segments, colors)
+
     def draw_polyline(self, points, color=coloring.RED):
-        for i in range(len(points) - 1):
-            self.draw_line(points[i], points[i+1], color)
+        if len(points) > 1:
+            self.draw_line_mesh(points, mesh.polyline_indices(len(points)), color)
 
     def draw_polygon(self, points, color=coloring.RED):
-        for i in range(len(points)):
-            self.draw_line(points[i-1], points[i], color)
+        if len(points):
+            self.draw_line_mesh(points, mesh.polygon_indices(len(points)), color)
 
     def draw_pair_lines(self, points0, points1, color=coloring.RED):
         for point0, point1 in zip(points0, points1):
@@ -47,90 +101,142 @@ class Draw(object):
         for point in points:
             self.draw_line(tip, point, color)
 
+    def draw_instance(self, line_mesh, matrix, color=coloring.RED):
+        self.batch.draw_instance(line_mesh, matrix, color)
+
+    def get_world_sphere(self, center, radius):
+        return center, radius
+
+    def is_sphere_visible(self, center, radius):
+        batch = self.batch
+        if not batch.culling:
+            return True
+        world_center, world_radius = self.get_world_sphere(center, radius)
+        return batch.camera.get_frustum().intersects_sphere(world_center, world_radius)
+
+    def select_segments(self, center, radius):
+        batch = self.batch
+        if batch.lod is None:
+            return CIRCLE_SEGMENTS
+        world_center, world_radius = self.get_world_sphere(center, radius)
+        return batch.lod.select_segments(batch.camera.get_projected_radius(world_center, world_radius))
+
+    def is_box_visible(self, low, high):
+        batch = self.batch
+        if not batch.culling:
+            return True
+        return batch.camera.get_frustum().intersects_aabb(low, high)
+
+    def select_visible_boxes(self, lows, highs):
+        # is_box_visible for Nx3 arrays of boxes, returns a mask
+        batch = self.batch
+        if not batch.culling:
+            return numpy.ones(len(lows), dtype=bool)
+        return batch.camera.get_frustum().intersects_aabb_array(lows, highs)
+
+    def draw_template(self, line_mesh, affine, color=coloring.RED):
+        # one affine transform of a unit template, instanced when enabled
+        if self.batch.instancing:
+            self.batch.draw_instance_affine(line_mesh, affine, color)
+        else:
+            self.batch.draw_mesh_template(line_mesh, affine, color)
+
     def draw_sphere(self, position, radius, color=coloring.RED):
-        longitude_segments = 8
-        longitude_step = math.pi / longitude_segments
-        sub_circle_points = [position + Vector(0.0, radius, 0.0)] * CIRCLE_SEGMENTS
-        for i in range(1, longitude_segments):
-            phi = i * longitude_step
-            sub_radius = radius * math.sin(phi)
-            sub_height = radius * math.cos(phi)
-            offset = position + Vector(0.0, sub_height, 0.0)
-            next_sub_circle_points = [offset + sub_radius * point for point in CIRCLE_POINTS]
-            self.draw_polygon(next_sub_circle_points, color)
-            self.draw_pair_lines(sub_circle_points, next_sub_circle_points, color)
-            sub_circle_points = next_sub_circle_points
-        next_sub_circle_points = [position + Vector(0.0, -radius, 0.0)] * CIRCLE_SEGMENTS
-        self.draw_pair_lines(sub_circle_points, next_sub_circle_points, color)
+        if not self.is_sphere_visible(position, radius):
+            return
+        segments = self.select_segments(position, radius)
+        self.draw_template(mesh.SPHERES[segments], scale_translate_affine(position, radius, radius, radius), color)
 
     def draw_cone(self, matrix, radius, height, color=coloring.RED):
-        tip = Vector(0.0, height, 0.0)
-        wtip = matrix.transform_point(tip)
-        circle_points = [matrix.transform_point(point * radius) for point in CIRCLE_POINTS]
-        self.draw_polygon(circle_points, color)
-        self.draw_tip_lines(wtip, circle_points, color)
+        scale = matrix_max_scale(matrix)
+        center = matrix.transform_point(Vector(0.0, height * 0.5, 0.0))
+        bound_radius = math.sqrt(radius * radius + height * height * 0.25) * scale
+        if not self.is_sphere_visible(center, bound_radius):
+            return
+        segments = self.select_segments(center, radius * scale)
+        affine = matrix_to_affine(matrix)
+        affine[:, :3] *= (radius, height, radius)
+        self.draw_template(mesh.CONES[segments], affine, color)
 
     def draw_box_vertices(self, vertices, color):
-        lower_half = vertices[:4]
-        upper_half = vertices[4:]
-        self.draw_polygon(lower_half, color)
-        self.draw_polygon(upper_half, color)
-        self.draw_pair_lines(lower_half, upper_half, color)
+        self.draw_line_mesh(vertices, mesh.BOX.indices, color)
 
     def draw_cube(self, position, length, color=coloring.RED):
-        cube_vertices = [position + v * length for v in CUBE_VERTICES]
-        self.draw_box_vertices(cube_vertices, color)
+        if not self.is_sphere_visible(position, length * 0.8660254):
+            return
+        self.draw_template(mesh.BOX, scale_translate_affine(position, length, length, length), color)
         self.draw_point(position, color)
 
     def draw_box(self, matrix, color=coloring.RED):
-        box_vertices = [matrix.transform_point(point) for point in CUBE_VERTICES]
-        self.draw_box_vertices(box_vertices, color)
-        self.draw_point(matrix.decompose().translation, color)
+        m = matrix
+        half_diagonal = 0.5 * math.sqrt(m.a * m.a + m.e * m.e + m.i * m.i + m.b * m.b + m.f * m.f + m.j * m.j +
+                                        m.c * m.c + m.g * m.g + m.k * m.k)
+        position = matrix_position(matrix)
+        if not self.is_sphere_visible(position, half_diagonal):
+            return
+        self.draw_template(mesh.BOX, matrix_to_affine(matrix), color)
+        self.draw_point(position, color)
 
     def draw_cylinder(self, position0, position1, radius, color=coloring.RED):
-        normal = (position1 - position0).normalized()
-        rotation = Quaternion.from_from_to_rotation(Vector(0.0, 1.0, 0.0), normal)
-        transform0 = Transform(position0, rotation, Vector(radius, radius, radius))
-        matrix0 = transform0.to_matrix()
-        circle_points0 = [matrix0.transform_point(point) for point in CIRCLE_POINTS]
-        transform1 = Transform(position1, rotation, Vector(radius, radius, radius))
-        matrix1 = transform1.to_matrix()
-        circle_points1 = [matrix1.transform_point(point) for point in CIRCLE_POINTS]
-        self.draw_polygon(circle_points0, color)
-        self.draw_polygon(circle_points1, color)
-        self.draw_pair_lines(circle_points0, circle_points1, color)
+        axis = position1 - position0
+        length = axis.length()
+        half_length = length * 0.5
+        center = (position0 + position1) * 0.5
+        if not self.is_sphere_visible(center, math.sqrt(half_length * half_length + radius * radius)):
+            return
+        segments = self.select_segments(center, radius)
+        # right handed basis with y along the axis, scaled to radius and length
+        normal_y = numpy.array((axis.x, axis.y, axis.z), dtype=numpy.float32)
+        if length > 0.0:
+            normal_y /= length
+        else:
+            normal_y[:] = (0.0, 1.0, 0.0)
+        helper = (1.0, 0.0, 0.0) if abs(normal_y[0]) < 0.9 else (0.0, 0.0, 1.0)
+        normal_x = numpy.cross(normal_y, helper)
+        normal_x /= numpy.linalg.norm(normal_x)
+        normal_z = numpy.cross(normal_x, normal_y)
+        affine = numpy.empty((3, 4), dtype=numpy.float32)
+        affine[:, 0] = normal_x * radius
+        affine[:, 1] = normal_y * length
+        affine[:, 2] = normal_z * radius
+        affine[:, 3] = (position0.x, position0.y, position0.z)
+        self.draw_template(mesh.CYLINDERS[segments], affine, color)
         self.draw_point(position0, color)
         self.draw_point(position1, color)
 
     def draw_grid(self, step, n, color=coloring.RED):
         self.draw_point(Vector(0.0, 0.0, 0.0), color)
         border = n * step
-        for i in range(1, n + 1):
-            seg = i * step
-            v0 = Vector(-seg, 0.0, -border)
-            v1 = Vector(-seg, 0.0, border)
-            self.draw_line(v0, v1, color)
-            v0 = Vector(seg, 0.0, -border)
-            v1 = Vector(seg, 0.0, border)
-            self.draw_line(v0, v1, color)
-            v0 = Vector(-border, 0.0, -seg)
-            v1 = Vector(border, 0.0, -seg)
-            self.draw_line(v0, v1, color)
-            v0 = Vector(-border, 0.0, seg)
-            v1 = Vector(border, 0.0, seg)
-            self.draw_line(v0, v1, color)
-        v0 = Vector(-border, 0.0, 0.0)
-        v1 = Vector(border, 0.0, 0.0)
-        red = Vector(1.0, 0.0, 0.0)
-        self.draw_line(v0, v1, red)
-        self.draw_point(Vector(border, 0.0, 0.0), red)
-        v0 = Vector(0.0, 0.0, -border)
-        v1 = Vector(0.0, 0.0, border)
-        blue = Vector(0.0, 0.0, 1.0)
-        self.draw_line(v0, v1, blue)
-        self.draw_point(Vector(0.0, 0.0, border), blue)
+        # lines along z at each x offset, then along x at each z offset, the
+        # last one of each is the axis. culled in one go, grid lines are axis
+        # aligned so every segment is its own bounding box
+        offsets = numpy.arange(1, n + 1, dtype=numpy.float32) * step
+        offsets = numpy.concatenate([-offsets, offsets, [0.0]])
+        count = len(offsets)
+        segments = numpy.zeros((2 * count, 2, 3), dtype=numpy.float32)
+        segments[:count, :, 0] = offsets[:, numpy.newaxis]
+        segments[:count, 0, 2] = -border
+        segments[:count, 1, 2] = border
+        segments[count:, 0, 0] = -border
+        segments[count:, 1, 0] = border
+        segments[count:, :, 2] = offsets[:, numpy.newaxis]
+        colors = numpy.empty((2 * count, 4), dtype=numpy.float32)
+        colors[:] = (color.x, color.y, color.z, getattr(color, 'w', 1.0))
+        colors[count - 1] = (0.0, 0.0, 1.0, 1.0)
+        colors[-1] = (1.0, 0.0, 0.0, 1.0)
+        visible = self.select_visible_boxes(segments[:, 0], segments[:, 1])
+        if visible.any():
+            self.draw_line_list(segments[visible], colors[visible])
+        self.draw_point(Vector(border, 0.0, 0.0), coloring.RED)
+        self.draw_point(Vector(0.0, 0.0, border), coloring.BLUE)
+
+    def draw_infinite_grid(self, step=1.0, color=coloring.GRAY, levels=2, fade_distance=200.0):
+        # one full screen pass, each level is LevelRatio times coarser
+        self.batch.draw_infinite_grid(step, color, levels, fade_distance)
 
     def draw_axis(self, matrix, length):
+        if not self.is_sphere_visible(matrix_position(matrix), length * 1.3 * matrix_max_scale(matrix)):
+            return
         transform = matrix.decompose()
         position = transform.translation
         rotation = transform.rotation
@@ -148,26 +254,103 @@ class Draw(object):
         self.draw_point(head_y, green)
         self.draw_point(head_z, blue)
 
-        head_radius = length * 0.1
-        head_height = head_radius * 3.0
-        head_translate_matrix = Matrix.from_translation(Vector(0.0, length, 0.0))
-        head_x_rotate_matrix = Matrix.from_angle_axis(-math.pi / 2.0, Vector(0.0, 0.0, 1.0))
-        self.draw_cone(matrix * head_x_rotate_matrix * head_translate_matrix, head_radius, head_height, red)
-        self.draw_cone(matrix * head_translate_matrix, head_radius, head_height, green)
-        head_z_rotate_matrix = Matrix.from_angle_axis(math.pi / 2.0, Vector(1.0, 0.0, 0.0))
-        self.draw_cone(matrix * head_z_rotate_matrix * head_translate_matrix, head_radius, head_height, blue)
+        affine = matrix_to_affine(matrix)
+        segments = self.select_segments(head_y, length * AXIS_HEAD_RADIUS * matrix_max_scale(matrix))
+        cone = mesh.CONES[segments]
+        for head_affine, color in zip(AXIS_HEAD_AFFINES, (red, green, blue)):
+            self.draw_template(cone, compose_affine(affine, head_affine * length), color)
 
 
 class LocalDraw(Draw):
+    # with batch.local_transforms vertices stay in local space and the
+    # matrix is applied in the vertex shader
     def __init__(self, batch, matrix):
         super().__init__(batch)
+        if isinstance(matrix, Transform):
+            matrix = matrix.to_matrix()
         self.matrix = matrix
+        self.affine = matrix_to_affine(matrix)
+        self._max_scale = None
+        self._transform_frame = None
+        self._transform_index = 0
+
+    def get_transform_index(self):
+        batch = self.batch
+        if self._transform_frame != batch.frame:
+            self._transform_index = batch.add_transform(self.matrix)
+            self._transform_frame = batch.frame
+        return self._transform_index
+
+    def get_world_sphere(self, center, radius):
+        if self._max_scale is None:
+            self._max_scale = matrix_max_scale(self.matrix)
+        return self.matrix.transform_point(center), radius * self._max_scale
+
+    def is_box_visible(self, low, high):
+        # a transformed box is no longer axis aligned, test its bounding sphere
+        return self.is_sphere_visible((low + high) * 0.5, (high - low).length() * 0.5)
+
+    def select_visible_boxes(self, lows, highs):
+        batch = self.batch
+        if not batch.culling:
+            return numpy.ones(len(lows), dtype=bool)
+        if self._max_scale is None:
+            self._max_scale = matrix_max_scale(self.matrix)
+        centers = transform_positions(self.affine, (lows + highs) * 0.5)
+        radii = numpy.linalg.norm(highs - lows, axis=1) * 0.5 * self._max_scale
+        return batch.camera.get_frustum().intersects_sphere_array(centers, radii)
 
     def draw_point(self, position, color=coloring.RED):
+        if self.batch.local_transforms:
+            self.batch.draw_point(position, color, self.get_transform_index())
+            return
         world_position = self.matrix.transform_point(position)
         super().draw_point(world_position, color)
 
     def draw_line(self, position0, position1, color=coloring.RED):
+        if self.batch.local_transforms:
+            self.batch.draw_line(position0, position1, color, self.get_transform_index())
+            return
         world_position0 = self.matrix.transform_point(position0)
         world_position1 = self.matrix.transform_point(position1)
         super().draw_line(world_position0, world_position1, color)
+
+    def draw_line_mesh(self, points, indices, color=coloring.RED):
+        if self.batch.local_transforms:
+            self.batch.draw_line_mesh(points, indices, color, self.get_transform_index())
+            return
+        if isinstance(points, numpy.ndarray):
+            super().draw_line_mesh(transform_positions(self.affine, points), indices, color)
+            return
+        matrix = self.matrix
+        world_points = [matrix.transform_point(point) for point in points]
+        super().draw_line_mesh(world_points, indices, color)
+
+    def draw_points(self, positions, colors=coloring.RED):
+        if self.batch.local_transforms:
+            self.batch.draw_points(positions, colors, self.get_transform_index())
+            return
+        super().draw_points(transform_positions(self.affine, positions), colors)
+
+    def draw_lines(self, positions0, positions1, colors=coloring.RED):
+        if self.batch.local_transforms:
+            self.batch.draw_lines(positions0, positions1, colors, self.get_transform_index())
+            return
+        affine = self.affine
+        super().draw_lines(transform_positions(affine, positions0), transform_positions(affine, positions1), colors)
+
+    def draw_line_list(self, segments, colors=coloring.RED):
+        if self.batch.local_transforms:
+            self.batch.draw_line_list(segments, colors, self.get_transform_index())
+            return
+        super().draw_line_list(transform_positions(self.affine, segments), colors)
+
+    def draw_instance(self, line_mesh, matrix, color=coloring.RED):
+        super().draw_instance(line_mesh, self.matrix * matrix, color)
+
+    def draw_template(self, line_mesh, affine, color=coloring.RED):
+        batch = self.batch
+        if batch.local_transforms and not batch.instancing:
+            batch.draw_mesh_template(line_mesh, affine, color, self.get_transform_index())
+            return
+        super().draw_template(line_mesh, compose_affine(self.affine, affine), color)
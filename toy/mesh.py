@@ -0,0 +1,144 @@
+"""
+Mesh.
+"""
+
+import math
+
+import numpy
+
+
+CIRCLE_SEGMENTS = 8
+SPHERE_LONGITUDE_SEGMENTS = 8
+LOD_SEGMENTS = (4, 6, 8, 12, 16, 24, 32)
+
+
+def polygon_edges(start, count):
+    return [(start + (i - 1) % count, start + i) for i in range(count)]
+
+def polyline_edges(start, count):
+    return [(start + i, start + i + 1) for i in range(count - 1)]
+
+def pair_edges(start0, start1, count):
+    return [(start0 + i, start1 + i) for i in range(count)]
+
+def edges_to_indices(edges):
+    return numpy.array(edges, dtype=numpy.uint32).reshape(-1)
+
+def build_sphere_indices(longitude_segments, circle_segments):
+    # top pole, longitude_segments - 1 rings, bottom pole
+    ring_count = longitude_segments - 1
+    bottom = 1 + ring_count * circle_segments
+    last_ring = 1 + (ring_count - 1) * circle_segments
+    edges = [(0, 1 + i) for i in range(circle_segments)]
+    for ring in range(ring_count):
+        start = 1 + ring * circle_segments
+        edges.extend(polygon_edges(start, circle_segments))
+        if ring + 1 < ring_count:
+            edges.extend(pair_edges(start, start + circle_segments, circle_segments))
+    edges.extend((last_ring + i, bottom) for i in range(circle_segments))
+    return edges_to_indices(edges)
+
+def build_prism_indices(circle_segments):
+    edges = polygon_edges(0, circle_segments)
+    edges.extend(polygon_edges(circle_segments, circle_segments))
+    edges.extend(pair_edges(0, circle_segments, circle_segments))
+    return edges_to_indices(edges)
+
+def build_cone_indices(circle_segments):
+    edges = polygon_edges(0, circle_segments)
+    edges.extend((circle_segments, i) for i in range(circle_segments))
+    return edges_to_indices(edges)
+
+
+def build_circle_positions(circle_segments, radius=1.0, height=0.0):
+    step = math.pi * 2.0 / circle_segments
+    return [(radius * math.cos(i * step), height, radius * math.sin(i * step)) for i in range(circle_segments)]
+
+def build_sphere_positions(longitude_segments, circle_segments):
+    longitude_step = math.pi / longitude_segments
+    positions = [(0.0, 1.0, 0.0)]
+    for i in range(1, longitude_segments):
+        phi = i * longitude_step
+        positions.extend(build_circle_positions(circle_segments, math.sin(phi), math.cos(phi)))
+    positions.append((0.0, -1.0, 0.0))
+    return positions
+
+def build_cylinder_positions(circle_segments):
+    return build_circle_positions(circle_segments) + build_circle_positions(circle_segments, 1.0, 1.0)
+
+def build_cone_positions(circle_segments):
+    return build_circle_positions(circle_segments) + [(0.0, 1.0, 0.0)]
+
+def build_box_positions():
+    return [(-0.5, -0.5, -0.5), (-0.5, -0.5, 0.5), (0.5, -0.5, 0.5), (0.5, -0.5, -0.5),
+            (-0.5, 0.5, -0.5), (-0.5, 0.5, 0.5), (0.5, 0.5, 0.5), (0.5, 0.5, -0.5)]
+
+
+class LineMesh(object):
+    def __init__(self, name, positions, indices):
+        self.name = name
+        self.positions = numpy.array(positions, dtype=numpy.float32).reshape(-1, 3)
+        self.indices = indices
+
+    def __repr__(self):
+        return '<LineMesh {} vertices={} lines={}>'.format(self.name, len(self.positions), len(self.indices) // 2)
+
+
+# one table entry per lod level, keyed by circle segments
+# unit radius, centered at origin
+SPHERES = {segments: LineMesh('sphere{}'.format(segments),
+                              build_sphere_positions(segments, segments),
+                              build_sphere_indices(segments, segments))
+           for segments in LOD_SEGMENTS}
+# unit radius, base at y=0, tip at y=1
+CONES = {segments: LineMesh('cone{}'.format(segments),
+                            build_cone_positions(segments),
+                            build_cone_indices(segments))
+         for segments in LOD_SEGMENTS}
+# unit radius, caps at y=0 and y=1
+CYLINDERS = {segments: LineMesh('cylinder{}'.format(segments),
+                                build_cylinder_positions(segments),
+                                build_prism_indices(segments))
+             for segments in LOD_SEGMENTS}
+
+SPHERE = SPHERES[CIRCLE_SEGMENTS]
+CONE = CONES[CIRCLE_SEGMENTS]
+CYLINDER = CYLINDERS[CIRCLE_SEGMENTS]
+# unit edge length, centered at origin
+BOX = LineMesh('box', build_box_positions(), build_prism_indices(4))
+
+
+class LevelOfDetail(object):
+    def __init__(self, min_segments=4, max_segments=16, pixels_per_segment=8.0):
+        levels = [segments for segments in LOD_SEGMENTS if min_segments <= segments <= max_segments]
+        if not levels:
+            raise ValueError('No lod level between {} and {} segments'.format(min_segments, max_segments))
+        self.levels = levels
+        self.pixels_per_segment = pixels_per_segment
+
+    def select_segments(self, projected_radius):
+        # keep the projected length of a segment around pixels_per_segment
+        wanted = 2.0 * math.pi * projected_radius / self.pixels_per_segment
+        for segments in self.levels:
+            if segments >= wanted:
+                return segments
+        return self.levels[-1]
+
+_polygon_indices = {}
+_polyline_indices = {}
+
+def polygon_indices(count):
+    try:
+        return _polygon_indices[count]
+    except KeyError:
+        indices = edges_to_indices(polygon_edges(0, count))
+        _polygon_indices[count] = indices
+        return indices
+
+def polyline_indices(count):
+    try:
+        return _polyline_indices[count]
+    except KeyError:
+        indices = edges_to_indices(polyline_edges(0, count))
+        _polyline_indices[count] = indices
+        return indices
@@ -0,0 +1,194 @@
+"""
+Null.
+"""
+
+import contextlib
+
+import toy.batching
+import toy.coloring
+
+
+class NullLayer(object):
+    def __init__(self, batch):
+        self.batch = batch
+        self.visible = True
+        self.counts = dict.fromkeys(batch.COUNTERS, 0)
+
+    def clear(self):
+        self.counts = dict.fromkeys(self.batch.COUNTERS, 0)
+
+    def invalidate(self):
+        pass
+
+    def delete(self):
+        pass
+
+
+class NullPrimitiveBatch(object):
+    COUNTERS = ('points', 'lines', 'mesh_vertices', 'mesh_indices', 'instances', 'grids')
+    def __init__(self, app, camera, *, culling=True, lod=None, picking=False):
+        self.app = app
+        self.camera = camera
+        self.streaming = False
+        self.instancing = False
+        self.compact = False
+        self.culling = culling
+        self.lod = lod
+        self.transforms = False
+        self.local_transforms = False
+        self.picking = picking
+        self.current_pick_id = 0
+        self.frame = 0
+        self.layers = []
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.last_counts = dict(self.counts)
+        self.tick_marks = None
+
+    def draw_point(self, position, color, transform=0):
+        self.counts['points'] += 1
+
+    def draw_line(self, position0, position1, color, transform=0):
+        self.counts['lines'] += 2
+
+    def draw_points(self, positions, colors, transform=0):
+        self.counts['points'] += len(toy.batching.as_positions(positions))
+
+    def draw_lines(self, positions0, positions1, colors, transform=0):
+        self.counts['lines'] += 2 * len(toy.batching.as_positions(positions0))
+
+    def draw_line_list(self, segments, colors, transform=0):
+        self.counts['lines'] += len(toy.batching.as_positions(segments))
+
+    def draw_line_mesh(self, positions, indices, color, transform=0):
+        self.counts['mesh_vertices'] += len(positions)
+        self.counts['mesh_indices'] += len(indices)
+
+    def draw_mesh_template(self, line_mesh, affine, color, transform=0):
+        self.counts['mesh_vertices'] += len(line_mesh.positions)
+        self.counts['mesh_indices'] += len(line_mesh.indices)
+
+    def draw_instance(self, line_mesh, matrix, color):
+        self.counts['instances'] += 1
+
+    def draw_instance_affine(self, line_mesh, affine, color):
+        self.counts['instances'] += 1
+
+    def draw_infinite_grid(self, step, color, levels, fade_distance):
+        self.counts['grids'] += 1
+
+    def add_transform(self, matrix):
+        return 0
+
+    @contextlib.contextmanager
+    def pick_id(self, pick_id):
+        saved = self.current_pick_id
+        self.current_pick_id = pick_id
+        try:
+            yield
+        finally:
+            self.current_pick_id = saved
+
+    def request_pick(self, x, y, callback):
+        # nothing is rendered, so nothing is ever hit
+        if not self.picking:
+            raise ValueError('request_pick needs a batch created with picking=True')
+        callback(0)
+
+    def create_layer(self):
+        layer = NullLayer(self)
+        self.layers.append(layer)
+        return layer
+
+    def remove_layer(self, layer):
+        self.layers.remove(layer)
+
+    @contextlib.contextmanager
+    def record_layer(self, layer):
+        layer.clear()
+        counts = self.counts
+        self.counts = layer.counts
+        try:
+            yield layer
+        finally:
+            self.counts = counts
+
+    def begin_tick(self):
+        self.tick_marks = None
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.frame += 1
+
+    def end_tick(self):
+        self.tick_marks = dict(self.counts)
+
+    def get_stats(self):
+        counts = self.last_counts
+        return {
+            'points': {'count': counts['points']},
+            'lines': {'count': counts['lines']},
+            'mesh_vertices': {'count': counts['mesh_vertices']},
+            'mesh_indices': {'count': counts['mesh_indices']},
+            'instances': counts['instances'],
+            'transforms': None,
+            'layers': len(self.layers),
+            'grids': counts['grids'],
+            'draw_calls': 0,
+            'upload_bytes': 0,
+            'gpu_times': {},
+        }
+
+    def draw(self):
+        self.last_counts = self.counts
+        self.counts = dict(self.tick_marks or dict.fromkeys(self.COUNTERS, 0))
+        self.frame += 1
+
+
+class NullTextBatch(object):
+    GLYPH_WIDTH = toy.batching.GLYPH_WIDTH
+    GLYPH_HEIGHT = toy.batching.GLYPH_HEIGHT
+    is_text_visible = toy.batching.TextBatch.is_text_visible
+
+    def __init__(self, app, camera, *, culling=True):
+        self.app = app
+        self.camera = camera
+        self.culling = culling
+        self.counts = (0, 0, 0)
+        self.last_counts = self.counts
+        self.tick_marks = None
+
+    def _count(self, text, world):
+        labels, world_labels, glyphs = self.counts
+        if world:
+            world_labels += 1
+        else:
+            labels += 1
+        self.counts = (labels, world_labels, glyphs + len(text) - text.count('\n') - text.count(' '))
+
+    def draw_text(self, position, text, color=toy.coloring.RED, scale=1.0):
+        if self.culling and not self.is_text_visible(position, text, scale):
+            return
+        self._count(text, False)
+
+    def draw_world_text(self, position, text, color=toy.coloring.RED, scale=1.0):
+        self._count(text, True)
+
+    def begin_tick(self):
+        self.tick_marks = None
+        self.counts = (0, 0, 0)
+
+    def end_tick(self):
+        self.tick_marks = self.counts
+
+    def get_stats(self):
+        labels, world_labels, glyphs = self.last_counts
+        return {
+            'glyphs': {'count': glyphs},
+            'labels': labels,
+            'world_labels': world_labels,
+            'draw_calls': 0,
+            'upload_bytes': 0,
+            'gpu_times': {},
+        }
+
+    def draw(self):
+        self.last_counts = self.counts
+        self.counts = self.tick_marks or (0, 0, 0)
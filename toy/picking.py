@@ -0,0 +1,143 @@
+"""
+Picking.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+from ctypes import *
+
+import numpy
+from pyglet.gl import *
+
+
+def select_pick_id(ids, x, y):
+    # nonzero id closest to (x, y) in the region, 0 means nothing
+    rows, columns = numpy.nonzero(ids)
+    if not len(rows):
+        return 0
+    distances = (columns - x) ** 2 + (rows - y) ** 2
+    nearest = numpy.argmin(distances)
+    return int(ids[rows[nearest], columns[nearest]])
+
+
+class PickBuffer(object):
+    # R32UI color target with a depth buffer so the nearest primitive wins,
+    # only a small region around the cursor is rasterized and read back
+    # through a pixel pack buffer
+    REGION_SIZE = 5
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.region = None
+        self.fence = None
+        self.callback = None
+        self.framebuffer = GLuint()
+        glGenFramebuffers(1, byref(self.framebuffer))
+        self.texture = GLuint()
+        glGenTextures(1, byref(self.texture))
+        self.depth_buffer = GLuint()
+        glGenRenderbuffers(1, byref(self.depth_buffer))
+        self.region_bytes = self.REGION_SIZE * self.REGION_SIZE * sizeof(GLuint)
+        self.pack_buffer = GLuint()
+        glGenBuffers(1, byref(self.pack_buffer))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        glBufferData(GL_PIXEL_PACK_BUFFER, self.region_bytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def _resize(self, width, height):
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_R32UI, width, height, 0, GL_RED_INTEGER, GL_UNSIGNED_INT, None)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth_buffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth_buffer)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            logger.warning('Pick framebuffer incomplete, status 0x%x', status)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        self.width = width
+        self.height = height
+
+    @property
+    def busy(self):
+        return self.fence is not None
+
+    def begin(self, x, y, width, height):
+        if width != self.width or height != self.height:
+            self._resize(width, height)
+        size = self.REGION_SIZE
+        x = int(x)
+        y = int(y)
+        x0 = min(max(x - size // 2, 0), max(width - size, 0))
+        y0 = min(max(y - size // 2, 0), max(height - size, 0))
+        self.region = (x0, y0, x - x0, y - y0)
+        self.bind()
+        clear_value = (GLuint * 4)(0, 0, 0, 0)
+        glClearBufferuiv(GL_COLOR, 0, clear_value)
+        clear_depth = (GLfloat * 1)(1.0)
+        glClearBufferfv(GL_DEPTH, 0, clear_depth)
+        self.unbind()
+
+    def bind(self):
+        # between begin and end, draws go to the pick target while bound
+        size = self.REGION_SIZE
+        x0, y0, _, _ = self.region
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(x0, y0, size, size)
+        glEnable(GL_DEPTH_TEST)
+
+    def unbind(self):
+        glDisable(GL_DEPTH_TEST)
+        glDisable(GL_SCISSOR_TEST)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def end(self, callback):
+        size = self.REGION_SIZE
+        x0, y0, _, _ = self.region
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        glReadPixels(x0, y0, size, size, GL_RED_INTEGER, GL_UNSIGNED_INT, None)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        self.callback = callback
+
+    def poll(self):
+        # never blocks, the callback runs once the readback has landed
+        if self.fence is None:
+            return
+        result = glClientWaitSync(self.fence, 0, 0)
+        if result == GL_WAIT_FAILED:
+            logger.warning('Wait for pick readback failed')
+        elif result != GL_ALREADY_SIGNALED and result != GL_CONDITION_SATISFIED:
+            return
+        glDeleteSync(self.fence)
+        self.fence = None
+        callback = self.callback
+        self.callback = None
+        if result == GL_WAIT_FAILED:
+            return
+        size = self.REGION_SIZE
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        address = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.region_bytes, GL_MAP_READ_BIT)
+        ids = numpy.ctypeslib.as_array(cast(address, POINTER(GLuint)), (size, size)).copy()
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        _, _, x, y = self.region
+        callback(select_pick_id(ids, x, y))
+
+    def delete(self):
+        if self.fence is not None:
+            glDeleteSync(self.fence)
+            self.fence = None
+        glDeleteBuffers(1, byref(self.pack_buffer))
+        glDeleteTextures(1, byref(self.texture))
+        glDeleteRenderbuffers(1, byref(self.depth_buffer))
+        glDeleteFramebuffers(1, byref(self.framebuffer))
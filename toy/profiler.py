@@ -0,0 +1,273 @@
+"""
+Profiler.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+import collections
+import json
+import threading
+import time
+from ctypes import *
+
+from pyglet.gl import *
+from vmath import Vector
+
+import toy.coloring
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_phase(self.name, self.start, time.perf_counter())
+        return False
+
+
+class FrameRecord(object):
+    __slots__ = ('start', 'end', 'phases', 'counters')
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.phases = {}
+        self.counters = {}
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def flatten_stats(prefix, stats, counters):
+    # numbers and arena 'count' entries of a get_stats dict
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            if 'count' in value:
+                counters[prefix + '.' + key] = value['count']
+            else:
+                flatten_stats(prefix + '.' + key, value, counters)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            counters[prefix + '.' + key] = value
+    return counters
+
+
+class GpuTimerScope(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.begin = 0
+
+    def __enter__(self):
+        self.begin = self.timer.timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.current.append((self.name, self.begin, self.timer.timestamp()))
+        return False
+
+
+class GpuTimer(object):
+    # GL_TIMESTAMP pairs rather than GL_TIME_ELAPSED, so scopes can nest.
+    # a frame is read back LATENCY frames after it was submitted and only
+    # once its last query has landed, the pipeline never waits on it
+    LATENCY = 3
+    MAX_PENDING = 8
+
+    def __init__(self):
+        self.pool = []
+        self.queries = []
+        self.current = []
+        self.pending = collections.deque()
+        self.times = {}
+        self.available = GLint()
+        self.result = GLuint64()
+
+    def scope(self, name):
+        return GpuTimerScope(self, name)
+
+    def timestamp(self):
+        if self.pool:
+            query = self.pool.pop()
+        else:
+            query = GLuint()
+            glGenQueries(1, byref(query))
+            self.queries.append(query)
+        glQueryCounter(query, GL_TIMESTAMP)
+        return query
+
+    def _is_available(self, frame):
+        _, _, query = frame[-1]
+        glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, byref(self.available))
+        return bool(self.available.value)
+
+    def _read(self, query):
+        glGetQueryObjectui64v(query, GL_QUERY_RESULT, byref(self.result))
+        return self.result.value
+
+    def _resolve(self, frame):
+        times = {}
+        for name, begin, end in frame:
+            milliseconds = (self._read(end) - self._read(begin)) / 1000000.0
+            times[name] = times.get(name, 0.0) + milliseconds
+        self.times = times
+
+    def end_frame(self):
+        if self.current:
+            self.pending.append(self.current)
+            self.current = []
+        while len(self.pending) >= self.LATENCY:
+            frame = self.pending[0]
+            available = self._is_available(frame)
+            if not available and len(self.pending) < self.MAX_PENDING:
+                break
+            self.pending.popleft()
+            if available:
+                self._resolve(frame)
+            else:
+                logger.debug('Drop gpu timings, results are %d frames late', self.MAX_PENDING)
+            for _, begin, end in frame:
+                self.pool.append(begin)
+                self.pool.append(end)
+
+    def delete(self):
+        for query in self.queries:
+            glDeleteQueries(1, byref(query))
+        self.queries = []
+        self.pool = []
+        self.current = []
+        self.pending.clear()
+
+
+class NullGpuTimer(object):
+    times = {}
+
+    def scope(self, name):
+        return NULL_PHASE
+
+    def end_frame(self):
+        pass
+
+    def delete(self):
+        pass
+
+
+def create_gpu_timer(enabled):
+    if enabled:
+        return GpuTimer()
+    return NullGpuTimer()
+
+
+class Profiler(object):
+    HISTORY_SIZE = 120
+    MAX_TRACE_EVENTS = 200000
+    HUD_MARGIN = 10.0
+    HUD_SCALE = 0.4
+
+    def __init__(self, enabled=False, history_size=HISTORY_SIZE):
+        self.enabled = enabled
+        self.hud_visible = False
+        self.history = collections.deque(maxlen=history_size)
+        self.trace_events = collections.deque(maxlen=self.MAX_TRACE_EVENTS)
+        self.origin = time.perf_counter()
+        self.current = None
+
+    def phase(self, name):
+        # shared no-op when disabled, so a disabled profiler costs one call
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def toggle_hud(self):
+        self.hud_visible = not self.hud_visible
+        if self.hud_visible:
+            self.enabled = True
+
+    def _timestamp(self, seconds):
+        return (seconds - self.origin) * 1000000.0
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.end_frame(now)
+        self.current = FrameRecord(now)
+
+    def end_frame(self, now=None):
+        frame = self.current
+        if frame is None:
+            return
+        frame.end = time.perf_counter() if now is None else now
+        self.history.append(frame)
+        self.current = None
+        if frame.counters:
+            self.trace_events.append({'name': 'counters', 'ph': 'C', 'pid': 0, 'tid': 0,
+                                      'ts': self._timestamp(frame.end), 'args': frame.counters})
+
+    def add_phase(self, name, start, end):
+        frame = self.current
+        if frame is not None:
+            frame.phases[name] = frame.phases.get(name, 0.0) + end - start
+        # pipelined updates show up on their own thread
+        self.trace_events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': threading.get_ident(),
+                                  'ts': self._timestamp(start), 'dur': (end - start) * 1000000.0})
+
+    def add_counters(self, prefix, stats):
+        if self.current is not None:
+            flatten_stats(prefix, stats, self.current.counters)
+
+    def get_phase_averages(self):
+        totals = collections.OrderedDict()
+        for frame in self.history:
+            for name, seconds in frame.phases.items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        count = max(len(self.history), 1)
+        return collections.OrderedDict((name, seconds / count) for name, seconds in totals.items())
+
+    def get_frame_average(self):
+        if not self.history:
+            return 0.0
+        return sum(frame.duration for frame in self.history) / len(self.history)
+
+    def get_hud_text(self):
+        frame_time = self.get_frame_average()
+        fps = 1.0 / frame_time if frame_time > 0.0 else 0.0
+        lines = ['frame {:.2f} ms  {:.0f} fps'.format(frame_time * 1000.0, fps)]
+        for name, seconds in self.get_phase_averages().items():
+            lines.append('{:<8} {:.2f} ms'.format(name, seconds * 1000.0))
+        if self.history:
+            for name, value in sorted(self.history[-1].counters.items()):
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines)
+
+    def draw_hud(self, text_batch):
+        if self.hud_visible:
+            text_batch.draw_text(self.get_hud_position(text_batch), self.get_hud_text(), toy.coloring.BLACK, self.HUD_SCALE)
+
+    def get_hud_position(self, text_batch):
+        # the label origin is the bottom of its first line
+        _, height = text_batch.camera.get_screen_size()
+        line_height = text_batch.GLYPH_HEIGHT * self.HUD_SCALE
+        return Vector(self.HUD_MARGIN, height - self.HUD_MARGIN - line_height, 0.0)
+
+    def write_trace(self, path):
+        # chrome://tracing or perfetto json
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self.trace_events), 'displayTimeUnit': 'ms'}, f)
+        logger.info('Wrote %d trace events to %s', len(self.trace_events), path)
@@ -1,13 +1,29 @@
 
 import logging
 logger = logging.getLogger(__name__)
+import hashlib
+import os
+import tempfile
 from ctypes import *
 
+import numpy
 from pyglet.gl import *
+from pyglet.gl import gl_info
 
 import vmathop
 
 
+PROGRAM_CACHE_MAGIC = b'TOYP'
+PROGRAM_CACHE_VERSION = 1
+# the driver's program binary follows the header
+PROGRAM_CACHE_HEADER_DTYPE = numpy.dtype([('magic', 'S4'), ('version', '<u4'),
+                                          ('format', '<u4'), ('length', '<u4')])
+
+
+# driver binaries are only loaded and written once a directory is set
+program_cache_directory = None
+
+
 class GLError(Exception):
     pass
 
@@ -29,8 +45,10 @@ def compile_shader(source, shader_type):
         raise GLError('Compile shader failed')
     return shader
 
-def link_program(vertex_shader, fragment_shader):
+def link_program(vertex_shader, fragment_shader, retrievable=False):
     program = glCreateProgram()
+    if retrievable:
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
     glAttachShader(program, vertex_shader)
     glAttachShader(program, fragment_shader)
     glLinkProgram(program)
@@ -46,18 +64,112 @@ def link_program(vertex_shader, fragment_shader):
         raise GLError('Link program failed')
     return program
 
-def create_program(vertex_shader_source, fragment_shader_source):
+def create_program(vertex_shader_source, fragment_shader_source, retrievable=False):
     vertex_shader = compile_shader(vertex_shader_source, GL_VERTEX_SHADER)
     fragment_shader = compile_shader(fragment_shader_source, GL_FRAGMENT_SHADER)
-    program = link_program(vertex_shader, fragment_shader)
+    program = link_program(vertex_shader, fragment_shader, retrievable)
     glDeleteShader(vertex_shader)
     glDeleteShader(fragment_shader)
     return program
 
 
+def set_program_cache_directory(directory):
+    # None turns the cache off
+    global program_cache_directory
+    program_cache_directory = directory
+
+def has_program_binary():
+    if not (gl_info.have_version(4, 1) or gl_info.have_extension('GL_ARB_get_program_binary')):
+        return False
+    format_count = GLint()
+    glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, byref(format_count))
+    return format_count.value > 0
+
+def get_program_cache_path(vertex_shader_source, fragment_shader_source):
+    # a driver update or another gpu gets its own entries
+    key = hashlib.sha1()
+    for text in (gl_info.get_vendor(), gl_info.get_renderer(), gl_info.get_version_string(),
+                 vertex_shader_source, fragment_shader_source):
+        key.update(text.encode('utf-8'))
+        key.update(b'\0')
+    return os.path.join(program_cache_directory, key.hexdigest() + '.bin')
+
+def read_program_cache(cache_path):
+    # missing or unreadable entries are a miss, the program is compiled
+    try:
+        with open(cache_path, 'rb') as f:
+            blob = f.read()
+    except OSError as e:
+        if os.path.exists(cache_path):
+            logger.debug('Read program cache %s failed: %s', cache_path, e)
+        return None
+    header_size = PROGRAM_CACHE_HEADER_DTYPE.itemsize
+    if len(blob) < header_size:
+        return None
+    header = numpy.frombuffer(blob, PROGRAM_CACHE_HEADER_DTYPE, 1)[0]
+    if header['magic'] != PROGRAM_CACHE_MAGIC or header['version'] != PROGRAM_CACHE_VERSION:
+        return None
+    length = int(header['length'])
+    if len(blob) != header_size + length:
+        return None
+    program = glCreateProgram()
+    binary = create_string_buffer(blob[header_size:], length)
+    success = GLint()
+    try:
+        glProgramBinary(program, int(header['format']), binary, length)
+        glGetProgramiv(program, GL_LINK_STATUS, byref(success))
+    except GLException:
+        success.value = 0
+    if not success:
+        # rejected by the driver, usually after an update it did not announce
+        logger.debug('Program binary %s rejected', cache_path)
+        glDeleteProgram(program)
+        return None
+    return program
+
+def write_program_cache(cache_path, program):
+    length = GLint()
+    glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH, byref(length))
+    if length.value <= 0:
+        return
+    binary = create_string_buffer(length.value)
+    written = GLsizei()
+    binary_format = GLenum()
+    glGetProgramBinary(program, length, byref(written), byref(binary_format), binary)
+    header = numpy.zeros(1, dtype=PROGRAM_CACHE_HEADER_DTYPE)
+    header['magic'] = PROGRAM_CACHE_MAGIC
+    header['version'] = PROGRAM_CACHE_VERSION
+    header['format'] = binary_format.value
+    header['length'] = written.value
+    directory = os.path.dirname(cache_path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(binary.raw[:written.value])
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning('Write program cache %s failed: %s', cache_path, e)
+
+def load_program(vertex_shader_source, fragment_shader_source):
+    # with a cache directory linked programs are kept as driver binaries,
+    # falls back to source
+    if program_cache_directory is None or not has_program_binary():
+        return create_program(vertex_shader_source, fragment_shader_source)
+    cache_path = get_program_cache_path(vertex_shader_source, fragment_shader_source)
+    program = read_program_cache(cache_path)
+    if program is not None:
+        return program
+    program = create_program(vertex_shader_source, fragment_shader_source, retrievable=True)
+    write_program_cache(cache_path, program)
+    return program
+
+
 class Shader(object):
     def __init__(self, vertex_source, fragment_source):
-        self.program = create_program(vertex_source, fragment_source)
+        self.program = load_program(vertex_source, fragment_source)
         self._uniform_locations = {}
 
     def use(self):
@@ -75,6 +187,14 @@ class Shader(object):
         uniform_location = self.get_uniform_location(uniform_name)
         glUniformMatrix4fv(uniform_location, 1, False, vmathop.matrix_to_ctype(matrix))
 
+    def set_uniform_int(self, uniform_name, value):
+        uniform_location = self.get_uniform_location(uniform_name)
+        glUniform1i(uniform_location, value)
+
+    def set_uniform_float(self, uniform_name, value):
+        uniform_location = self.get_uniform_location(uniform_name)
+        glUniform1f(uniform_location, value)
+
     def set_uniform_color(self, uniform_name, color):
         uniform_location = self.get_uniform_location(uniform_name)
-        glUniform4f(uniform_location, color.x, color.y, color.z, 1.0)
+        glUniform4f(uniform_location, color.x, color.y, color.z, getattr(color, 'w', 1.0))
@@ -0,0 +1,139 @@
+"""
+Streaming.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+from ctypes import *
+
+from pyglet.gl import *
+from pyglet.gl import gl_info
+
+
+def has_persistent_mapping():
+    if gl_info.have_version(4, 4):
+        return True
+    return gl_info.have_extension('GL_ARB_buffer_storage')
+
+
+class ChunkedStream(object):
+    def __init__(self, vertex_size_bytes, chunk_size, setup_attributes):
+        self.vertex_size_bytes = vertex_size_bytes
+        self.chunk_size = chunk_size
+        self.chunk_size_bytes = chunk_size * vertex_size_bytes
+        self.draw_calls = 0
+        self.upload_bytes = 0
+        self.buffer = GLuint()
+        glGenBuffers(1, byref(self.buffer))
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        glBufferData(GL_ARRAY_BUFFER, self.chunk_size_bytes, None, GL_STREAM_DRAW)
+        setup_attributes()
+
+    def bind(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+
+    def begin_frame(self, vertex_count):
+        self.draw_calls = 0
+        self.upload_bytes = 0
+
+    def draw(self, address, vertex_count, draw_func):
+        chunk_count, last_count = divmod(vertex_count, self.chunk_size)
+        for i in range(chunk_count):
+            sub_address = address + i * self.chunk_size_bytes
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.chunk_size_bytes, sub_address)
+            draw_func(0, self.chunk_size)
+        if last_count > 0:
+            sub_address = address + chunk_count * self.chunk_size_bytes
+            glBufferSubData(GL_ARRAY_BUFFER, 0, last_count * self.vertex_size_bytes, sub_address)
+            draw_func(0, last_count)
+        self.draw_calls += chunk_count + (last_count > 0)
+        self.upload_bytes += vertex_count * self.vertex_size_bytes
+
+    def end_frame(self):
+        pass
+
+
+class PersistentStream(object):
+    SECTION_COUNT = 3
+    WAIT_TIMEOUT = 1000000000
+
+    def __init__(self, vertex_size_bytes, capacity, setup_attributes):
+        self.vertex_size_bytes = vertex_size_bytes
+        self.setup_attributes = setup_attributes
+        self.draw_calls = 0
+        self.upload_bytes = 0
+        self.buffer = None
+        self.address = None
+        self.fences = [None] * self.SECTION_COUNT
+        self.section = 0
+        self.cursor = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        if self.buffer is not None:
+            for section in range(self.SECTION_COUNT):
+                self._wait(section)
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+            glUnmapBuffer(GL_ARRAY_BUFFER)
+            glDeleteBuffers(1, byref(self.buffer))
+        self.section_size = capacity
+        self.section_size_bytes = capacity * self.vertex_size_bytes
+        total_bytes = self.section_size_bytes * self.SECTION_COUNT
+        flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        self.buffer = GLuint()
+        glGenBuffers(1, byref(self.buffer))
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        glBufferStorage(GL_ARRAY_BUFFER, total_bytes, None, flags)
+        self.address = glMapBufferRange(GL_ARRAY_BUFFER, 0, total_bytes, flags)
+        self.setup_attributes()
+        logger.debug('Persistent stream section size %d', capacity)
+
+    def _wait(self, section):
+        fence = self.fences[section]
+        if not fence:
+            return
+        while True:
+            result = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, self.WAIT_TIMEOUT)
+            if result == GL_ALREADY_SIGNALED or result == GL_CONDITION_SATISFIED:
+                break
+            if result == GL_WAIT_FAILED:
+                logger.warning('Wait for stream fence failed')
+                break
+        glDeleteSync(fence)
+        self.fences[section] = None
+
+    def bind(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+
+    def begin_frame(self, vertex_count):
+        self.draw_calls = 0
+        self.upload_bytes = 0
+        if vertex_count > self.section_size:
+            capacity = self.section_size
+            while capacity < vertex_count:
+                capacity *= 2
+            self._allocate(capacity)
+        self.section = (self.section + 1) % self.SECTION_COUNT
+        self._wait(self.section)
+        self.cursor = 0
+
+    def draw(self, address, vertex_count, draw_func):
+        length_bytes = vertex_count * self.vertex_size_bytes
+        offset = self.section * self.section_size_bytes + self.cursor * self.vertex_size_bytes
+        memmove(self.address + offset, address, length_bytes)
+        first = self.section * self.section_size + self.cursor
+        self.cursor += vertex_count
+        draw_func(first, vertex_count)
+        self.draw_calls += 1
+        self.upload_bytes += length_bytes
+
+    def end_frame(self):
+        self.fences[self.section] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+
+def create_stream(vertex_size_bytes, chunk_size, setup_attributes, persistent=False):
+    if persistent:
+        if has_persistent_mapping():
+            return PersistentStream(vertex_size_bytes, chunk_size, setup_attributes)
+        logger.info('Persistent mapped buffers unavailable, fall back to chunked upload')
+    return ChunkedStream(vertex_size_bytes, chunk_size, setup_attributes)